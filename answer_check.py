@@ -0,0 +1,72 @@
+import re
+
+# --- Final-answer extraction and comparison ---
+# Shared by generate_traces_and_grade.py (at grading time) and rescore.py (offline re-scoring), so
+# both always agree on is_correct. Patterns are compiled once at import.
+
+BOXED_MARKER = "\\boxed{"
+FRAC_RE = re.compile(r'\\(d?frac)\s*\{([^}]+)\}\s*\{([^}]+)\}')
+LATEX_COMMAND_RE = re.compile(r'\\[a-zA-Z]+')
+WHITESPACE_RE = re.compile(r'\s+')
+EDGE_BRACKETS_RE = re.compile(r'^[(\[{]*|[])}\$]*$')
+
+
+def extract_boxed_answer(trace_text):
+    """
+    Returns the content of the last \\boxed{...} in the trace, matching nested braces
+    (e.g. \\boxed{\\frac{1}{4}} gives "\\frac{1}{4}"), or None if there is no closed box.
+    """
+    if not trace_text: return None
+    start = trace_text.rfind(BOXED_MARKER)
+    while start != -1:
+        content = _balanced_content(trace_text, start + len(BOXED_MARKER))
+        if content is not None:
+            return content.strip()
+        start = trace_text.rfind(BOXED_MARKER, 0, start)  # last box is cut off; fall back to the one before
+    return None
+
+
+def _balanced_content(text, pos):
+    """Text from `pos` up to the brace closing the one just before it; None if it never closes."""
+    depth = 1
+    i = pos
+    while i < len(text):
+        char = text[i]
+        if char == '\\':
+            i += 2  # \{ and \} are literal braces
+            continue
+        if char == '{':
+            depth += 1
+        elif char == '}':
+            depth -= 1
+            if depth == 0:
+                return text[pos:i]
+        i += 1
+    return None
+
+
+def normalize_answer(text):
+    s = str(text).strip().lower()
+    s = FRAC_RE.sub(r'\2/\3', s)
+    s = LATEX_COMMAND_RE.sub('', s)
+    s = WHITESPACE_RE.sub('', s)
+    s = EDGE_BRACKETS_RE.sub('', s)
+    return s
+
+
+def evaluate_numeric(val):
+    if '/' in val:
+        parts = val.split('/'); return float(parts[0]) / float(parts[1])
+    return float(val)
+
+
+def normalize_and_compare_answers(extracted_answer_raw, ground_truth_answers_list):
+    if extracted_answer_raw is None or not ground_truth_answers_list: return False
+    norm_extracted = normalize_answer(extracted_answer_raw)
+    for gt_answer in ground_truth_answers_list:
+        norm_ground_truth = normalize_answer(gt_answer)
+        if norm_extracted == norm_ground_truth: return True
+        try:
+            if abs(evaluate_numeric(norm_extracted) - evaluate_numeric(norm_ground_truth)) < 1e-6: return True
+        except (ValueError, TypeError, ZeroDivisionError): pass
+    return False
@@ -0,0 +1,141 @@
+import argparse
+import asyncio
+import collections
+import json
+import os
+import time
+
+from openai import AsyncOpenAI, APIStatusError
+
+# --- OpenAI batch-file format ---
+# generate_traces_and_grade.py (BATCH_PHASE = "emit") writes its REASONING_PROMPT requests in the OpenAI
+# batch input format, one JSON object per line:
+#   {"custom_id": ..., "method": "POST", "url": "/v1/chat/completions", "body": {<chat completion request>}}
+# and reads results in the batch output format (BATCH_PHASE = "ingest"):
+#   {"id": ..., "custom_id": ..., "response": {"status_code": 200, "request_id": ..., "body": {<chat completion>}}, "error": null}
+# vLLM's offline runner produces exactly this:
+#   python -m vllm.entrypoints.openai.run_batch -i peer_requests.jsonl -o peer_results.jsonl --model Qwen/Qwen2.5-72B-Instruct
+# as does any OpenAI-compatible batch API. Without either, this script is a stand-in batch runner that
+# sends the requests of a batch file to an online endpoint (e.g. mock_llm_server.py):
+#   python batch_files.py results/run_xxx/batch/peer_requests.jsonl --url http://localhost:8000/v1 -c 32
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+
+
+def make_custom_id(problem_id, model_type, trace_nums):
+    """Request id of one batch line, e.g. "<uuid>/peer/1-2": the problem, the reasoner type and the trace numbers its choices fill."""
+    return f"{problem_id}/{model_type}/{'-'.join(str(num) for num in trace_nums)}"
+
+
+def parse_custom_id(custom_id):
+    problem_id, model_type, trace_nums = custom_id.rsplit('/', 2)  # problem ids may contain '/', types do not
+    return problem_id, model_type, [int(num) for num in trace_nums.split('-')]
+
+
+def batch_request(custom_id, model_id, prompt, temperature, max_tokens, n=1):
+    body = {"model": model_id, "messages": [{"role": "user", "content": prompt}], "temperature": temperature, "max_tokens": max_tokens}
+    if n > 1:
+        body["n"] = n
+    return {"custom_id": custom_id, "method": "POST", "url": BATCH_ENDPOINT, "body": body}
+
+
+def iter_jsonl(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def iter_batch_results(path):
+    """
+    Yields (custom_id, {choice index: text} or None, error message, usage) for every line of a batch
+    output file. Lines whose request failed have no texts and an error message.
+    """
+    for result in iter_jsonl(path):
+        response = result.get("response") or {}
+        body = response.get("body") or {}
+        status_code = response.get("status_code")
+        if status_code == 200 and isinstance(body.get("choices"), list):
+            texts = {choice.get("index", i): (choice.get("message") or {}).get("content")
+                     for i, choice in enumerate(body["choices"])}
+            yield result.get("custom_id"), texts, None, body.get("usage")
+            continue
+        error = result.get("error") or (body.get("error") if isinstance(body, dict) else None) or f"HTTP {status_code}"
+        yield result.get("custom_id"), None, str(error.get("message", error) if isinstance(error, dict) else error), None
+
+
+def default_results_file(requests_file):
+    """peer_requests.jsonl -> peer_results.jsonl, the name generate_traces_and_grade.py ingests."""
+    head, _, tail = requests_file.rpartition("_requests")
+    return head + "_results" + tail if head else os.path.splitext(requests_file)[0] + "_results.jsonl"
+
+
+# --- Local stand-in batch runner ---
+
+async def run_batch_file(requests_file, results_file, base_url, api_key="EMPTY", concurrency=32, timeout=600.0, max_retries=3):
+    """
+    Sends every request of a batch input file to `base_url` with up to `concurrency` in flight and
+    writes the batch output file (lines in completion order, as with batch APIs). Returns outcome counts.
+    """
+    client = AsyncOpenAI(api_key=api_key, base_url=base_url, max_retries=max_retries, timeout=timeout)
+    counts = collections.Counter()
+
+    async def run_one(number, request):
+        result = {"id": f"batch_req_{number}", "custom_id": request.get("custom_id"), "response": None, "error": None}
+        if request.get("url") != BATCH_ENDPOINT:
+            result["error"] = {"code": "invalid_url", "message": f"Only {BATCH_ENDPOINT} is supported, got {request.get('url')}"}
+            return result
+        try:
+            completion = await client.chat.completions.create(**request["body"])
+            result["response"] = {"status_code": 200, "request_id": completion.id, "body": completion.model_dump(mode="json")}
+        except APIStatusError as e:
+            result["response"] = {"status_code": e.status_code, "request_id": None, "body": e.body}
+        except Exception as e:
+            result["error"] = {"code": type(e).__name__, "message": str(e)}
+        return result
+
+    if os.path.dirname(results_file):
+        os.makedirs(os.path.dirname(results_file), exist_ok=True)
+    pending = set()
+    with open(results_file, 'w', encoding='utf-8') as f_out:
+        def write_finished(done):
+            for task in done:
+                result = task.result()
+                counts["ok" if (result["response"] or {}).get("status_code") == 200 else "failed"] += 1
+                f_out.write(json.dumps(result, ensure_ascii=False) + '\n')
+
+        for number, request in enumerate(iter_jsonl(requests_file)):
+            pending.add(asyncio.create_task(run_one(number, request)))
+            if len(pending) >= concurrency:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                write_finished(done)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            write_finished(done)
+    await client.close()
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run an OpenAI batch input file against an online OpenAI-compatible endpoint (local stand-in for a batch API).")
+    parser.add_argument("requests_files", nargs='+', help="Batch input files (e.g. results/run_xxx/batch/peer_requests.jsonl).")
+    parser.add_argument("-o", "--output", default=None, help="Results file (single input only; default: <name>_results.jsonl next to the input).")
+    parser.add_argument("--url", default="http://localhost:8000/v1", help="Base URL of the endpoint (default: http://localhost:8000/v1).")
+    parser.add_argument("--api-key", default="EMPTY")
+    parser.add_argument("-c", "--concurrency", type=int, default=32, help="Requests in flight (default: 32).")
+    args = parser.parse_args()
+
+    if args.output and len(args.requests_files) > 1:
+        parser.error("--output only works with a single input file.")
+    for requests_file in args.requests_files:
+        results_file = args.output or default_results_file(requests_file)
+        start = time.monotonic()
+        counts = asyncio.run(run_batch_file(requests_file, results_file, args.url, args.api_key, args.concurrency))
+        elapsed = time.monotonic() - start
+        total = sum(counts.values())
+        print(f"-> {requests_file}: {total} requests in {elapsed:.1f}s ({total / elapsed if elapsed else 0:.1f}/s), "
+              f"{counts['ok']} ok, {counts['failed']} failed. Results: {results_file}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,248 @@
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from urllib.request import urlopen
+
+from mock_llm_server import MockLLMServer, add_profile_arguments, profile_from_args, quiz_reply
+from run_shards import parse_overrides, apply_overrides
+
+# --- End-to-end throughput benchmark ---
+# Runs generate_quizzes.py and/or generate_traces_and_grade.py against a mock OpenAI-compatible
+# server (mock_llm_server.py, started in-process unless --url is given; --replicas N starts N of them
+# and the peer/student clients become replica pools over all of them) for every combination of
+# dataset size and concurrency level, and reports records/sec, peak RSS and request tail latency.
+# Each case runs in a fresh spawned process (clean module state, and its own peak RSS) with the
+# response cache disabled, so every request reaches the server.
+#
+#   python benchmark.py --sizes 100 1000 --concurrency 8 32 --tokens-per-second 60 --straggler-rate 0.01
+#   python benchmark.py --stages grade --sizes 500 --concurrency 16 --set-grade GRADER_BATCH_SIZE=1
+#
+# Results are printed as a table and saved to <output dir>/benchmark_<timestamp>.json; the stage
+# logs and outputs of every case are kept under <output dir>/work/.
+
+STAGES = ("quizzes", "grade")
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def make_synthetic_problems(path, count, seed=0):
+    """
+    Writes `count` OpenR1-shaped records (with a canned quiz and valid_reasoning_traces, so the grading
+    stage can run on them directly). Problem and solution lengths vary like the real data.
+    """
+    rng = random.Random(seed)
+    with open(path, 'w', encoding='utf-8') as f:
+        for i in range(count):
+            a, b = rng.randint(2, 999), rng.randint(2, 999)
+            padding = " Consider the constraints carefully." * rng.randint(0, 40)
+            steps = " ".join(f"Step {k}: we simplify the expression and obtain {rng.randint(1, 999)}." for k in range(rng.randint(5, 80)))
+            generations = [f"<think>{steps}</think> So the answer is \\boxed{{{a + b}}}." for _ in range(rng.randint(1, 4))]
+            record = {
+                "uuid": f"bench-{count}-{i:07d}",
+                "problem": f"Let x = {a} and y = {b}.{padding} What is x + y?",
+                "answer": str(a + b),
+                "solution": f"We add the two numbers. {steps} Therefore x + y = {a + b}.",
+                "generations": generations,
+                "correctness_math_verify": [rng.random() < 0.8 for _ in generations],
+                "valid_reasoning_traces": generations[:2],
+                "quiz": json.loads(quiz_reply(rng))["quiz"],
+            }
+            f.write(json.dumps(record) + '\n')
+
+
+# --- Stage runners (executed in a spawned child process) ---
+
+def configure_quiz_stage(stage, input_file, base_urls, concurrency, overrides):
+    from llm_client import HedgePolicy, LLMClient
+    from rate_limit import AdaptiveLimiter
+
+    stage.INPUT_FILE = input_file
+    stage.INPUT_BYTE_RANGE = None
+    stage.OUTPUT_FILE = os.path.abspath("quizzes.jsonl")
+    stage.RESUME = False
+    stage.CONCURRENT_REQUESTS = concurrency
+    apply_overrides(stage, overrides)
+    # The client and limiter are built at import time from the settings; rebuild them for this case.
+    if stage.LLM_CACHE:
+        stage.LLM_CACHE.close()
+    stage.LLM_CACHE = None
+    stage.RATE_LIMITER = AdaptiveLimiter(
+        initial_concurrency=min(stage.INITIAL_CONCURRENCY, stage.CONCURRENT_REQUESTS),
+        max_concurrency=stage.CONCURRENT_REQUESTS,
+        latency_target=stage.LATENCY_TARGET_SECONDS,
+        requests_per_minute=stage.REQUESTS_PER_MINUTE,
+        tokens_per_minute=stage.TOKENS_PER_MINUTE,
+    ) if stage.ADAPTIVE_CONCURRENCY else None
+    stage.HEDGE_POLICY = HedgePolicy(percentile=stage.HEDGE_PERCENTILE, budget=stage.HEDGE_BUDGET) if stage.HEDGE_REQUESTS else None
+    stage.client = LLMClient(api_key="EMPTY", base_url=base_urls[0], max_retries=2, limiter=stage.RATE_LIMITER,
+                             name="quiz_generator", metrics=stage.METRICS, hedging=stage.HEDGE_POLICY)
+
+
+def configure_grade_stage(stage, input_file, base_urls, concurrency, overrides):
+    from llm_client import HedgePolicy, open_llm_client
+
+    stage.INPUT_FILE = input_file
+    stage.INPUT_BYTE_RANGE = None
+    stage.OUTPUT_BASE_DIR = os.path.abspath("run")
+    stage.OUTPUT_DETAILS_FILE = os.path.join(stage.OUTPUT_BASE_DIR, "run_details.jsonl")
+    stage.OUTPUT_OVERVIEW_FILE = os.path.join(stage.OUTPUT_BASE_DIR, "run_overview.json")
+    stage.RESUME_RUN_DIR = None
+    stage.CONCURRENCY_LIMITS = {key: concurrency for key in stage.CONCURRENCY_LIMITS}
+    stage.MAX_PROBLEMS_IN_FLIGHT = max(stage.MAX_PROBLEMS_IN_FLIGHT, concurrency)
+    apply_overrides(stage, overrides)
+    if stage.LLM_CACHE:
+        stage.LLM_CACHE.close()
+    stage.LLM_CACHE = None
+    stage.RATE_LIMITER_SETTINGS = stage.rate_limiter_settings()
+    stage.HEDGE_POLICIES = {key: HedgePolicy(**settings) for key, settings in stage.HEDGED_REQUESTS.items()}
+    stage.API_CLIENTS = {
+        key: open_llm_client(base_urls[0] if key == "grader" else base_urls, "EMPTY", key, max_retries=3, timeout=300.0,
+                             limiter_settings=stage.RATE_LIMITER_SETTINGS.get(key), hedging=stage.HEDGE_POLICIES.get(key), metrics=stage.METRICS,
+                             **stage.REPLICA_SETTINGS)
+        for key in stage.API_CLIENTS
+    }
+
+
+def run_case(stage_name, input_file, case_dir, base_urls, concurrency, overrides):
+    """Runs one stage over `input_file` inside `case_dir`; returns throughput, memory and latency figures."""
+    sys.path.insert(0, REPO_DIR)
+    os.makedirs(case_dir, exist_ok=True)
+    os.chdir(case_dir)  # the stage scripts create cache/ and results/ relative to the working directory
+    log = open("stage.log", 'w', encoding='utf-8', buffering=1)
+    sys.stdout = sys.stderr = log
+
+    if stage_name == "quizzes":
+        import generate_quizzes as stage
+        configure_quiz_stage(stage, input_file, base_urls, concurrency, overrides)
+        start = time.monotonic()
+        stage.generate_quizzes_from_jsonl()
+        elapsed = time.monotonic() - start
+        records = failed = 0
+        with open(stage.OUTPUT_FILE, 'r', encoding='utf-8') as f:
+            for line in f:
+                records += 1
+                failed += json.loads(line).get("quiz") is None
+        result = {"records": records, "failed_records": failed}
+    else:
+        import generate_traces_and_grade as stage
+        from record_io import count_records
+        configure_grade_stage(stage, input_file, base_urls, concurrency, overrides)
+        start = time.monotonic()
+        stage.run_full_evaluation()
+        elapsed = time.monotonic() - start
+        with open(stage.OUTPUT_OVERVIEW_FILE, 'r', encoding='utf-8') as f:
+            overall = json.load(f)["overall_performance"]
+        result = {"records": count_records(input_file), "traces": overall["traces_generated_and_saved"]}
+        replica_pools = {key: client.pool_stats() for key, client in stage.API_CLIENTS.items() if client.num_replicas > 1}
+        if replica_pools:
+            result["replica_pools"] = replica_pools
+
+    latency = {}
+    for client_key, models in stage.METRICS.summary().items():
+        for digest in models.values():
+            latency[client_key] = {"requests": digest["attempts"], "errors": sum(digest["errors"].values()),
+                                   **(digest["latency_seconds"] or {})}
+    result.update({
+        "seconds": round(elapsed, 3),
+        "records_per_second": round(result["records"] / elapsed, 3) if elapsed else None,
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),  # KiB on Linux
+        "request_latency": latency,
+        "log": os.path.abspath("stage.log"),
+    })
+    log.close()
+    return result
+
+
+# --- Driver ---
+
+def fetch_server_stats(base_url, reset_peak=False):
+    try:
+        with urlopen(base_url.rsplit('/v1', 1)[0] + "/stats" + ("?reset_peak" if reset_peak else ""), timeout=5) as response:
+            return json.load(response)
+    except (OSError, ValueError):
+        return None  # not a mock server, or unreachable
+
+
+def server_stats_delta(before, after):
+    if not before or not after:
+        return None
+    return {
+        "requests": after["requests"] - before["requests"],
+        "aborted_streams": after["aborted_streams"] - before["aborted_streams"],
+        "completion_tokens": after["completion_tokens"] - before["completion_tokens"],
+        "max_active": after["max_active"],
+        "injected": {k: v - before["injected"].get(k, 0) for k, v in after["injected"].items() if v - before["injected"].get(k, 0)},
+    }
+
+
+def format_latency(latency):
+    """Compact "client p50/p99" summary for the table."""
+    return "  ".join(f"{key} {digest.get('p50', 0):.2f}/{digest.get('p99', 0):.2f}s" for key, digest in sorted(latency.items()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline stages against a mock OpenAI-compatible server.")
+    parser.add_argument("--stages", nargs='+', choices=STAGES, default=list(STAGES), help="Stages to benchmark (default: both).")
+    parser.add_argument("--sizes", nargs='+', type=int, default=[50, 200], help="Dataset sizes in records (default: 50 200).")
+    parser.add_argument("--concurrency", nargs='+', type=int, default=[8, 32], help="Concurrency levels (default: 8 32).")
+    parser.add_argument("-o", "--output-dir", default="benchmarks", help="Directory for results and per-case work files (default: benchmarks).")
+    parser.add_argument("--url", nargs='+', default=None, help="Use already running server(s) (e.g. http://localhost:8000/v1) instead of in-process mocks; several URLs are used as replicas.")
+    parser.add_argument("--replicas", type=int, default=1, help="Number of in-process mock servers serving peer/student as a replica pool (default: 1).")
+    parser.add_argument("--set-quizzes", action="append", metavar="NAME=VALUE", help="Override a generate_quizzes.py setting (JSON value).")
+    parser.add_argument("--set-grade", action="append", metavar="NAME=VALUE", help="Override a generate_traces_and_grade.py setting (JSON value).")
+    add_profile_arguments(parser)
+    args = parser.parse_args()
+
+    output_dir = os.path.abspath(args.output_dir)
+    os.makedirs(os.path.join(output_dir, "work"), exist_ok=True)
+    overrides = {"quizzes": parse_overrides(args.set_quizzes), "grade": parse_overrides(args.set_grade)}
+
+    servers = []
+    base_urls = args.url
+    if base_urls is None:
+        servers = [MockLLMServer(profile_from_args(args)) for _ in range(max(1, args.replicas))]
+        base_urls = [server.start() for server in servers]
+        print(f"Mock server(s) running at {', '.join(base_urls)}")
+
+    ctx = multiprocessing.get_context("spawn")
+    results = []
+    try:
+        for size in args.sizes:
+            input_file = os.path.join(output_dir, "work", f"problems_{size}.jsonl")
+            make_synthetic_problems(input_file, size, seed=args.seed)
+            for concurrency in args.concurrency:
+                for stage_name in args.stages:
+                    case_dir = os.path.join(output_dir, "work", f"{stage_name}_n{size}_c{concurrency}")
+                    print(f"-> {stage_name}: {size} records, concurrency {concurrency} ...", flush=True)
+                    before = [fetch_server_stats(url, reset_peak=True) for url in base_urls]
+                    with ProcessPoolExecutor(max_workers=1, mp_context=ctx) as executor:
+                        result = executor.submit(run_case, stage_name, input_file, case_dir, base_urls, concurrency, overrides[stage_name]).result()
+                    result.update({"stage": stage_name, "size": size, "concurrency": concurrency,
+                                   "servers": [server_stats_delta(b, fetch_server_stats(url)) for b, url in zip(before, base_urls)]})
+                    results.append(result)
+                    print(f"   {result['records_per_second']} records/s, {result['seconds']}s, peak RSS {result['peak_rss_mb']} MB, "
+                          f"latency p50/p99: {format_latency(result['request_latency'])}")
+    except KeyboardInterrupt:
+        print("\nKEYBOARD INTERRUPT DETECTED! Reporting the finished cases...")
+    finally:
+        for server in servers:
+            server.stop()
+
+    results_file = os.path.join(output_dir, f"benchmark_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+    with open(results_file, 'w', encoding='utf-8') as f:
+        json.dump({"settings": vars(args), "base_urls": base_urls, "results": results}, f, indent=4)
+
+    print(f"\n{'stage':<8} {'size':>6} {'conc':>5} {'rec/s':>9} {'seconds':>9} {'RSS MB':>8}  request latency p50/p99")
+    for r in results:
+        print(f"{r['stage']:<8} {r['size']:>6} {r['concurrency']:>5} {r['records_per_second']:>9} {r['seconds']:>9} {r['peak_rss_mb']:>8}  {format_latency(r['request_latency'])}")
+    print(f"\n✅ Results saved to '{results_file}'")
+
+
+if __name__ == "__main__":
+    main()
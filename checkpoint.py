@@ -0,0 +1,44 @@
+import json
+import os
+
+from record_io import detect_format, iter_records
+
+# --- Helpers for resuming interrupted runs ---
+
+def scan_completed_keys(path, key_fn, on_record=None, columns=None):
+    """
+    Reads an existing output (see record_io) and returns the set of `key_fn(record)` for every
+    record already written, so a resumed run can skip that work and append the rest.
+
+    If the process died mid-write, the last line of a .jsonl file has no trailing newline; that
+    partial line is truncated away so appended records start on a clean line. Malformed lines
+    elsewhere are ignored (their work is simply redone). Columnar outputs only ever contain
+    complete part files, and only `columns` (if given) are read from them.
+    """
+    completed = set()
+    if not os.path.exists(path):
+        return completed
+
+    if detect_format(path) != "jsonl":
+        for record in iter_records(path, columns=columns):
+            completed.add(key_fn(record))
+            if on_record:
+                on_record(record)
+        return completed
+
+    valid_end = 0
+    with open(path, 'rb+') as f:
+        for line in f:
+            if not line.endswith(b'\n'):
+                break
+            valid_end += len(line)
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            completed.add(key_fn(record))
+            if on_record:
+                on_record(record)
+        f.truncate(valid_end)
+
+    return completed
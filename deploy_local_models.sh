@@ -15,36 +15,65 @@
 # and they will continue running. To stop them, you will need to find and
 
 # kill the corresponding processes.
+#
+# Replicas: with spare GPUs, start several servers per model, e.g.
+#   PEER_REPLICAS=1 STUDENT_REPLICAS=3 PIN_GPUS=1 ./deploy_local_models.sh
+# Replica i of a model listens on its base port + 2*i (peer: 8000, 8002, ...; student: 8001, 8003, ...).
+# List the printed URLs in LOCAL_API_URL_PEER / LOCAL_API_URL_STUDENT of generate_traces_and_grade.py;
+# requests are then routed to the least-loaded healthy replica. PIN_GPUS=1 gives every server its own
+# GPUs (CUDA_VISIBLE_DEVICES), allocated in launch order starting at FIRST_GPU.
+
+# --enable-prefix-caching lets requests that share a prompt prefix (all traces of one problem, or
+# grading calls for one quiz when a grader is served locally) reuse its KV cache instead of
+# prefilling it again. Newer vLLM versions also report the reused tokens in `usage` when started
+# with --enable-prompt-tokens-details.
+
+PEER_REPLICAS=${PEER_REPLICAS:-1}
+STUDENT_REPLICAS=${STUDENT_REPLICAS:-1}
+PIN_GPUS=${PIN_GPUS:-0}
+NEXT_GPU=${FIRST_GPU:-0}
+ALL_PIDS=""
+
+# launch_replicas <role> <model> <base port> <tensor parallel size> <replicas>
+launch_replicas() {
+    local role=$1 model=$2 base_port=$3 tp=$4 replicas=$5
+    local urls=""
+    for ((i = 0; i < replicas; i++)); do
+        local port=$((base_port + 2 * i))
+        local log_file="${role}_model_server.log"
+        if [ "$replicas" -gt 1 ]; then
+            log_file="${role}_model_server_${i}.log"
+        fi
+        local gpu_env=""
+        if [ "$PIN_GPUS" = "1" ]; then
+            gpu_env="CUDA_VISIBLE_DEVICES=$(seq -s, "$NEXT_GPU" $((NEXT_GPU + tp - 1)))"
+            NEXT_GPU=$((NEXT_GPU + tp))
+        fi
+        echo "Launching ${role} model (${model}) replica ${i} on http://localhost:${port} ${gpu_env}..."
+        env $gpu_env nohup python -m vllm.entrypoints.openai.api_server \
+            --model "$model" \
+            --port "$port" \
+            --tensor-parallel-size "$tp" \
+            --gpu-memory-utilization 0.9 \
+            --enable-prefix-caching \
+            > "$log_file" 2>&1 &
+        local pid=$!
+        ALL_PIDS="$ALL_PIDS $pid"
+        echo "${role} model server started with PID: $pid. Logs are in $log_file"
+        urls="$urls \"http://localhost:${port}/v1\","
+        sleep 10 # Give each server a moment to start up
+    done
+    echo "  -> ${role} replica URLs: [${urls%,} ]"
+}
+
+# --- Launch Peer Model (Qwen2.5-72B-Instruct) on Port 8000 (+2 per extra replica) ---
+launch_replicas peer Qwen/Qwen2.5-72B-Instruct 8000 4 "$PEER_REPLICAS"
 
-echo "--- Starting QMath Local Model Deployment ---"
-
-# --- Launch Peer Model (Qwen2.5-72B-Instruct) on Port 8000 ---
-echo "Launching Peer model (Qwen/Qwen2.5-72B-Instruct) on http://localhost:8000 ..."
-nohup python -m vllm.entrypoints.openai.api_server \
-    --model Qwen/Qwen2.5-72B-Instruct \
-    --port 8000 \
-    --tensor-parallel-size 4 \
-    --gpu-memory-utilization 0.9 \
-    > peer_model_server.log 2>&1 &
-
-PEER_PID=$!
-echo "Peer model server started with PID: $PEER_PID. Logs are in peer_model_server.log"
-sleep 10 # Give the first server a moment to start up
-
-# --- Launch Student Model (Qwen2.5-7B-Instruct) on Port 8001 ---
-echo "Launching Student model (Qwen/Qwen2.5-7B-Instruct) on http://localhost:8001 ..."
-nohup python -m vllm.entrypoints.openai.api_server \
-    --model Qwen/Qwen2.5-7B-Instruct \
-    --port 8001 \
-    --tensor-parallel-size 1 \
-    --gpu-memory-utilization 0.9 \
-    > student_model_server.log 2>&1 &
-
-STUDENT_PID=$!
-echo "Student model server started with PID: $STUDENT_PID. Logs are in student_model_server.log"
+# --- Launch Student Model (Qwen2.5-7B-Instruct) on Port 8001 (+2 per extra replica) ---
+launch_replicas student Qwen/Qwen2.5-7B-Instruct 8001 1 "$STUDENT_REPLICAS"
 
 echo ""
-echo "✅ Both model servers have been launched in the background."
+echo "✅ All model servers have been launched in the background."
 echo "You can now run the main 'generate_traces_and_grade.py' script."
-echo "To stop the servers, use the command: 'kill $PEER_PID $STUDENT_PID'"
+echo "To stop the servers, use the command: 'kill$ALL_PIDS'"
 
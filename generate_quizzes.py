@@ -1,11 +1,21 @@
+import collections
+import heapq
+import itertools
 import json
 import os
 import re
+import shutil
 import time
 from tqdm import tqdm
-from openai import OpenAI
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from prompts import QUIZ_GENERATION_PROMPT
+from checkpoint import scan_completed_keys
+from llm_client import HedgePolicy, LLMClient, estimate_prompt_tokens, open_response_cache
+from metrics import MetricsRecorder
+from rate_limit import AdaptiveLimiter
+from length_schedule import schedule_by_length
+from prompt_budget import SOURCE_SEPARATOR, TokenCounter, PromptBudgeter, reasoning_candidates
+from record_io import detect_format, iter_records, count_records, open_record_writer, JsonlRecordWriter, ColumnarRecordWriter
 
 # --- 需要老师改动Configuration ---
 # IMPORTANT: Replace with your actual API key
@@ -15,23 +25,79 @@ QUIZ_GENERATOR_MODEL = "deepseek-r1"
 
 # --- 需要老师改动Script Behavior ---
 # This script now reads a single .jsonl file and writes to another .jsonl file
+# 输入/输出可以是 .jsonl，也可以是 Parquet / Arrow IPC（文件或以 _parquet / _arrow 结尾的分片目录，见 record_io.py）
 INPUT_FILE = '/root/autodl-tmp/filtered_math_data_original_structure.jsonl' # 注意改写分块 00～04
 OUTPUT_FILE = '/root/autodl-tmp/math_data_with_quizzes_number.jsonl' # 注意改写分块 00～04
+INPUT_BYTE_RANGE = None # 只处理 INPUT_FILE 中的一个分块：填 slice_jsons.py 清单里的 (start_byte, end_byte)；None 表示整个文件（仅限 .jsonl）
+OUTPUT_ROWS_PER_PART = 1000 # 输出为 Parquet / Arrow 时，每个分片文件的记录数
 CONCURRENT_REQUESTS = 50 # 同时发出api的次数
+IN_FLIGHT_MULTIPLIER = 2 # 最多同时在内存中的记录数 = CONCURRENT_REQUESTS * IN_FLIGHT_MULTIPLIER
+REORDER_OUTPUT = False # 结果按完成顺序写出；设为 True 则结束后按输入顺序重排输出文件
+RESUME = False # 断点续跑：跳过 OUTPUT_FILE 中已有的 uuid，只追加缺失的记录
+LENGTH_SCHEDULING = "longest_first" # 按长度调度："longest_first" 在接下来 LENGTH_LOOKAHEAD 条记录中总是先发最长的，避免分块末尾的长题单独拖尾；"grouped" 攒满一个窗口后从长到短整体发出，同时在跑的请求长度相近；None 按文件顺序
+LENGTH_LOOKAHEAD = 256 # 长度调度的前瞻窗口（记录数），这些记录会额外留在内存中
+REDRIVE = False # 失败重跑：只重新提交 OUTPUT_FILE 中失败的记录（quiz 为空 / 带 error），成功的记录原样保留，完成后原子替换 OUTPUT_FILE
 
-# --- API Client and Helper Functions (Unchanged) ---
-client = OpenAI(api_key=COMMERCIAL_API_KEY, base_url=COMMERCIAL_API_URL, max_retries=2)
+# --- Re-drive Policies ---
+# 按失败类型决定重跑策略：max_attempts 为该记录累计最多重跑次数（记录在 redrive_attempts 字段，多次重跑会累加），
+# backoff_seconds 为同一记录两次重跑之间的等待（指数增长），temperature 为重跑时的采样温度（None 表示默认 0.3）。
+# 每次重跑使用新的采样序号，不会从缓存中取回上次失败的回复。
+REDRIVE_POLICIES = {
+    "api_transient": {"max_attempts": 3, "backoff_seconds": 10.0, "temperature": None}, # 429 / 5xx / 超时 / 连接错误
+    "api_client_error": {"max_attempts": 1, "backoff_seconds": 0.0, "temperature": None}, # 其他 4xx，例如超出上下文长度
+    "parse_error": {"max_attempts": 2, "backoff_seconds": 0.0, "temperature": 0.6}, # 回复中没有合法 JSON（failed_raw_output）
+    "validation_error": {"max_attempts": 2, "backoff_seconds": 0.0, "temperature": 0.6}, # JSON 合法但缺少 quiz 键（received_json）
+    "no_reasoning_source": {"max_attempts": 0, "backoff_seconds": 0.0, "temperature": None}, # 输入本身没有可用的解答，重跑无意义
+    "unknown": {"max_attempts": 1, "backoff_seconds": 0.0, "temperature": None},
+}
 
-def call_llm_api(prompt, model_id, temperature=0.3):
+# --- Prompt Token Budget ---
+QUIZ_PROMPT_TOKEN_BUDGET = 16000 # 出题 prompt 的 token 上限（含模板、题目和解答）；超出时优先保留 solution 和 correctness_math_verify 验证正确的 generations，并截取超出部分的中间段；None 表示不限制
+QUIZ_TOKENIZER = None # 计数用的 Hugging Face tokenizer（如 "deepseek-ai/DeepSeek-R1"，需安装 transformers）；None 表示按约 4 字符/token 估算
+INCLUDE_UNVERIFIED_GENERATIONS = True # 预算有剩余时是否也使用未通过 correctness_math_verify 的 generations
+MIN_TRIMMED_SOURCE_TOKENS = 1024 # 剩余预算低于该值时不再截取新的解答片段
+
+# --- Response Cache (shared with generate_traces_and_grade.py) ---
+LLM_CACHE_PATH = "cache/llm_responses.sqlite" # 设为 None 关闭缓存
+LLM_CACHE_MAX_MB = 4096 # 超过后按最近最少使用淘汰
+
+# --- Adaptive Rate Control ---
+ADAPTIVE_CONCURRENCY = True # 根据 429/5xx 自动升降并发（AIMD），上限为 CONCURRENT_REQUESTS
+INITIAL_CONCURRENCY = 16 # 自适应模式下的起始并发
+REQUESTS_PER_MINUTE = None # 接口的 RPM 限额，None 表示不限制
+TOKENS_PER_MINUTE = None # 接口的 TPM 限额，None 表示不限制
+LATENCY_TARGET_SECONDS = None # 平均延迟超过该值时也降低并发；None 表示只根据错误调整
+
+# --- Hedged Requests ---
+HEDGE_REQUESTS = False # 请求耗时超过近期延迟的 HEDGE_PERCENTILE 分位时再发一份，取先返回的结果并取消另一份；重发的请求同样计费（最多多花 HEDGE_BUDGET），默认关闭
+HEDGE_PERCENTILE = 0.95 # 触发重发的延迟分位
+HEDGE_BUDGET = 0.05 # 重发请求数最多占总请求数的比例（额外花费上限）
+
+# --- Request Metrics ---
+METRICS_EVENT_LOG = True # 每次 API 请求写一行到 <OUTPUT_FILE 去掉扩展名>.request_metrics.jsonl
+METRICS_PROMETHEUS = True # 写 Prometheus textfile：<OUTPUT_FILE 去掉扩展名>.metrics.prom（每 30 秒刷新）
+
+# --- API Client and Helper Functions ---
+LLM_CACHE = open_response_cache(LLM_CACHE_PATH, LLM_CACHE_MAX_MB)
+def rate_limiter_settings():
+    """AdaptiveLimiter arguments from the settings above, or None without ADAPTIVE_CONCURRENCY (run_shards.py re-reads them)."""
+    if not ADAPTIVE_CONCURRENCY:
+        return None
+    return dict(initial_concurrency=INITIAL_CONCURRENCY, max_concurrency=CONCURRENT_REQUESTS, latency_target=LATENCY_TARGET_SECONDS,
+                requests_per_minute=REQUESTS_PER_MINUTE, tokens_per_minute=TOKENS_PER_MINUTE)
+
+RATE_LIMITER = AdaptiveLimiter(**rate_limiter_settings()) if ADAPTIVE_CONCURRENCY else None
+HEDGE_POLICY = HedgePolicy(percentile=HEDGE_PERCENTILE, budget=HEDGE_BUDGET) if HEDGE_REQUESTS else None
+METRICS = MetricsRecorder()
+PROMPT_BUDGETER = PromptBudgeter(TokenCounter(QUIZ_TOKENIZER), QUIZ_PROMPT_TOKEN_BUDGET,
+                                 INCLUDE_UNVERIFIED_GENERATIONS, MIN_TRIMMED_SOURCE_TOKENS)
+client = LLMClient(api_key=COMMERCIAL_API_KEY, base_url=COMMERCIAL_API_URL, max_retries=2, cache=LLM_CACHE, limiter=RATE_LIMITER,
+                   name="quiz_generator", metrics=METRICS, hedging=HEDGE_POLICY)
+
+def call_llm_api(prompt, model_id, temperature=0.3, sample_index=0):
     try:
-        completion = client.chat.completions.create(
-            model=model_id,
-            messages=[{"role": "user", "content": prompt}],
-            temperature=temperature,
-            max_tokens=4096,
-            timeout=400.0,
-        )
-        return completion.choices[0].message.content, None
+        content = client.complete(prompt, model_id, temperature, max_tokens=4096, sample_index=sample_index, timeout=400.0)
+        return content, None
     except Exception as e:
         return None, f"API Error: {e}"
 
@@ -47,23 +113,13 @@ def parse_json_from_text(text_blob: str):
     return None, "No JSON object found in response."
 
 # --- MODIFIED: This function is now corrected to match your data structure ---
-def process_single_problem(problem_data):
+def process_single_problem(problem_data, temperature=0.3, sample_index=0):
     output_record = problem_data.copy()
     
-    # Gather reasoning text from both 'solution' and 'generations' fields
-    reasoning_sources = []
-    
-    # 1. Get the solution if it's high-quality (e.g., longer than 100 chars)
-    solution_text = problem_data.get('solution')
-    if solution_text and isinstance(solution_text, str) and len(solution_text) > 100:
-        reasoning_sources.append(solution_text)
-        
-    # 2. Get any high-quality generations
-    generations = problem_data.get('generations', [])
-    if generations and isinstance(generations, list):
-        for gen_text in generations:
-            if gen_text and isinstance(gen_text, str) and len(gen_text) > 100:
-                reasoning_sources.append(gen_text)
+    # Gather reasoning text from the 'solution' and 'generations' fields (verified ones first),
+    # within the prompt token budget
+    prompt_fields = {"problem": problem_data.get('problem', 'N/A'), "answer": problem_data.get('answer', 'N/A')}
+    reasoning_sources = PROMPT_BUDGETER.select(problem_data, QUIZ_GENERATION_PROMPT.format(multiple_reason_solution="", **prompt_fields))
 
     # If we found no good reasoning text anywhere, mark an error and return
     if not reasoning_sources:
@@ -72,15 +128,11 @@ def process_single_problem(problem_data):
         return output_record
     
     # Join the found traces into a single block of text for the prompt
-    reasoning_text = "\n\n---\n\n".join(reasoning_sources)
+    reasoning_text = SOURCE_SEPARATOR.join(reasoning_sources)
 
-    quiz_gen_prompt = QUIZ_GENERATION_PROMPT.format(
-        problem=problem_data.get('problem', 'N/A'),
-        answer=problem_data.get('answer', 'N/A'),
-        multiple_reason_solution=reasoning_text
-    )
+    quiz_gen_prompt = QUIZ_GENERATION_PROMPT.format(multiple_reason_solution=reasoning_text, **prompt_fields)
 
-    raw_quiz_output, api_error = call_llm_api(quiz_gen_prompt, QUIZ_GENERATOR_MODEL)
+    raw_quiz_output, api_error = call_llm_api(quiz_gen_prompt, QUIZ_GENERATOR_MODEL, temperature, sample_index)
     if api_error:
         output_record["quiz"] = None
         output_record["error"] = api_error
@@ -103,44 +155,311 @@ def process_single_problem(problem_data):
     
     return output_record
 
-# --- MODIFIED: Main function now processes the large file in memory-safe chunks ---
+# --- Bounded-window scheduler ---
+def bounded_unordered_map(executor, fn, iterable, max_in_flight):
+    """
+    Like executor.map, but only pulls a new item from `iterable` when fewer than
+    `max_in_flight` are pending, and yields results as soon as they complete
+    rather than in input order. Memory stays flat regardless of input size.
+    """
+    pending = set()
+    for item in iterable:
+        if len(pending) >= max_in_flight:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+        pending.add(executor.submit(fn, item))
+
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            yield future.result()
+
+def bounded_retrying_map(executor, fn, iterable, max_in_flight, retry_delay):
+    """
+    Like bounded_unordered_map, but each result is first passed to `retry_delay(result, tries)`; if
+    that returns a delay, `fn` runs again on the result once the delay has passed instead of the
+    result being yielded. Waiting items hold no worker thread, but do count towards `max_in_flight`,
+    so intake slows down while many items back off.
+    """
+    items = iter(iterable)
+    pending = {}  # future -> tries so far
+    waiting = []  # heap of (due time, tiebreak, item, tries)
+    order = itertools.count()
+    exhausted = False
+    while True:
+        now = time.monotonic()
+        while waiting and waiting[0][0] <= now:
+            _, _, item, tries = heapq.heappop(waiting)
+            pending[executor.submit(fn, item)] = tries
+        while not exhausted and len(pending) + len(waiting) < max_in_flight:
+            item = next(items, None)
+            if item is None:
+                exhausted = True
+            else:
+                pending[executor.submit(fn, item)] = 0
+        if not pending and not waiting:
+            return
+        timeout = max(0.0, waiting[0][0] - now) if waiting else None
+        if not pending:
+            time.sleep(timeout)
+            continue
+        done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+        for future in done:
+            tries = pending.pop(future) + 1
+            result = future.result()
+            delay = retry_delay(result, tries)
+            if delay is None:
+                yield result
+            else:
+                heapq.heappush(waiting, (time.monotonic() + delay, next(order), result, tries))
+
+def reorder_output_by_input(input_file, output_file, input_byte_range=None):
+    """
+    Rewrites `output_file` so its records follow the order of `input_file` (or of its
+    `input_byte_range` shard), matching on 'uuid'.
+    Only a uuid -> byte offset index is held in memory; records are copied one at a time.
+    """
+    offsets = {}
+    unmatched_offsets = []
+    with open(output_file, 'rb') as f_out:
+        offset = 0
+        for line in f_out:
+            uuid = json.loads(line).get('uuid')
+            if uuid is None or uuid in offsets:
+                unmatched_offsets.append(offset)
+            else:
+                offsets[uuid] = offset
+            offset += len(line)
+
+    tmp_file = output_file + '.reorder.tmp'
+    with open(output_file, 'rb') as f_src, \
+         open(tmp_file, 'wb') as f_dst:
+        def copy_line_at(offset):
+            f_src.seek(offset)
+            f_dst.write(f_src.readline())
+
+        for record in iter_records(input_file, columns=['uuid'], byte_range=input_byte_range):
+            offset = offsets.pop(record.get('uuid'), None)
+            if offset is not None:
+                copy_line_at(offset)
+        # Anything that could not be matched to an input uuid goes at the end.
+        for offset in sorted(list(offsets.values()) + unmatched_offsets):
+            copy_line_at(offset)
+
+    os.replace(tmp_file, output_file)
+
+def estimate_record_tokens(problem_data):
+    """
+    Rough cost of a record for LENGTH_SCHEDULING: prompt tokens (the reasoning sources, capped by the
+    prompt budget) plus the expected output, for which the average source length stands in -- problems
+    with long solutions also get long deepseek-r1 reasoning.
+    """
+    source_tokens = [estimate_prompt_tokens(text) for _, text in reasoning_candidates(problem_data)]
+    prompt_tokens = estimate_prompt_tokens(str(problem_data.get('problem', ''))) + sum(source_tokens)
+    if QUIZ_PROMPT_TOKEN_BUDGET is not None:
+        prompt_tokens = min(prompt_tokens, QUIZ_PROMPT_TOKEN_BUDGET)
+    output_tokens = min(sum(source_tokens) // len(source_tokens), 4096) if source_tokens else 0
+    return prompt_tokens + output_tokens
+
+# --- Re-drive of failed records (REDRIVE) ---
+FAILURE_FIELDS = ("error", "failed_raw_output", "received_json")
+
+def classify_quiz_failure(record):
+    """Failure class of an output record (a key of REDRIVE_POLICIES), or None if it has a quiz."""
+    error = str(record.get("error") or "")
+    if record.get("quiz") and not error:
+        return None
+    if error.startswith("API Error"):
+        status = re.search(r'Error code: (\d{3})', error)
+        if status and 400 <= int(status.group(1)) < 500 and status.group(1) != "429":
+            return "api_client_error"
+        return "api_transient"
+    if "received_json" in record or error.startswith("Validation Error"):
+        return "validation_error"
+    if "failed_raw_output" in record or error.startswith(("JSON Decode Error", "No JSON object", "No content")):
+        return "parse_error"
+    if error.startswith("Record has no high-quality"):
+        return "no_reasoning_source"
+    return "unknown"
+
+def get_redrive_policy(failure_class):
+    return REDRIVE_POLICIES.get(failure_class) or REDRIVE_POLICIES["unknown"]
+
+def needs_redrive(record):
+    failure_class = classify_quiz_failure(record)
+    return failure_class is not None and record.get("redrive_attempts", 0) < get_redrive_policy(failure_class)["max_attempts"]
+
+def redrive_attempt(record):
+    """
+    One re-drive attempt of a failed record under its failure class's policy; returns the new record,
+    with redrive_attempts counting every attempt so far.
+    """
+    policy = get_redrive_policy(classify_quiz_failure(record))
+    problem_data = {key: value for key, value in record.items() if key not in FAILURE_FIELDS}
+    attempts = record.get("redrive_attempts", 0) + 1
+    temperature = 0.3 if policy["temperature"] is None else policy["temperature"]
+    # A fresh sample index gives a new cache key, so a cached bad reply is not served again.
+    result = process_single_problem(problem_data, temperature=temperature, sample_index=attempts)
+    result["redrive_attempts"] = attempts
+    return result
+
+def redrive_retry_delay(result, tries):
+    """
+    Backoff before the next attempt of a record that failed again, or None once it succeeded or its
+    budget is used up. If the failure class changed (e.g. a timeout, then unparsable output), the new
+    class's policy applies.
+    """
+    if not needs_redrive(result):
+        return None
+    return get_redrive_policy(classify_quiz_failure(result))["backoff_seconds"] * 2 ** (tries - 1)
+
+def redrive_failed_quizzes():
+    """
+    Streams OUTPUT_FILE, copies successful records as they are and re-submits only the failed ones
+    (under REDRIVE_POLICIES) through the same bounded window as a normal run. The merged output goes to
+    a temporary path that replaces OUTPUT_FILE only once complete, so an interrupted re-drive leaves
+    the original untouched.
+    """
+    if not os.path.exists(OUTPUT_FILE):
+        print(f"FATAL: Nothing to re-drive: '{OUTPUT_FILE}' does not exist.")
+        return
+
+    print(f"Scanning '{OUTPUT_FILE}' for failed records...")
+    failures = collections.Counter()
+    total_records = to_redrive = 0
+    for record in iter_records(OUTPUT_FILE):
+        total_records += 1
+        failure_class = classify_quiz_failure(record)
+        if failure_class is not None:
+            failures[failure_class] += 1
+            to_redrive += needs_redrive(record)
+    print(f"Found {sum(failures.values())} failed records out of {total_records} ({dict(failures)}); {to_redrive} will be re-driven.")
+    if not to_redrive:
+        return
+
+    fmt = detect_format(OUTPUT_FILE)
+    tmp_path = OUTPUT_FILE.rstrip('/\\') + ".redrive.tmp"
+    metrics_base = os.path.splitext(OUTPUT_FILE.rstrip('/\\'))[0]
+    METRICS.open(metrics_base + ".request_metrics.jsonl" if METRICS_EVENT_LOG else None,
+                 metrics_base + ".metrics.prom" if METRICS_PROMETHEUS else None, append=True)
+    outcomes = collections.Counter()
+    try:
+        writer = JsonlRecordWriter(tmp_path) if fmt == "jsonl" else ColumnarRecordWriter(tmp_path, fmt, 'w', OUTPUT_ROWS_PER_PART)
+        with ThreadPoolExecutor(max_workers=CONCURRENT_REQUESTS) as executor, writer as f_out:
+            def failed_records():
+                # Runs in this thread as the window pulls work; records that stay are copied straight through.
+                for record in iter_records(OUTPUT_FILE):
+                    if needs_redrive(record):
+                        yield record
+                    else:
+                        f_out.write(record)
+
+            work = schedule_by_length(failed_records(), estimate_record_tokens, LENGTH_SCHEDULING, LENGTH_LOOKAHEAD)
+            for result in tqdm(bounded_retrying_map(executor, redrive_attempt, work, CONCURRENT_REQUESTS * IN_FLIGHT_MULTIPLIER, redrive_retry_delay),
+                               total=to_redrive, desc="Re-driving failed quizzes"):
+                outcomes[classify_quiz_failure(result) or "recovered"] += 1
+                f_out.write(result)
+    except BaseException:
+        print(f"Re-drive interrupted; '{OUTPUT_FILE}' was left unchanged.")
+        if os.path.isdir(tmp_path):
+            shutil.rmtree(tmp_path)
+        elif os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    finally:
+        METRICS.close()
+
+    if os.path.isdir(OUTPUT_FILE):
+        # Part directories cannot be renamed over each other; swap them instead.
+        old_path = OUTPUT_FILE.rstrip('/\\') + ".redrive.old"
+        os.replace(OUTPUT_FILE, old_path)
+        os.replace(tmp_path, OUTPUT_FILE)
+        shutil.rmtree(old_path)
+    else:
+        os.replace(tmp_path, OUTPUT_FILE)
+
+    if REORDER_OUTPUT and fmt == "jsonl":
+        print("Restoring input order in output file...")
+        reorder_output_by_input(INPUT_FILE, OUTPUT_FILE, INPUT_BYTE_RANGE)
+    recovered = outcomes.pop("recovered", 0)
+    print(f"\n✅ Re-drive finished: {recovered} of {to_redrive} records recovered; still failing: {dict(outcomes) or 'none'}. Output saved to '{OUTPUT_FILE}'")
+    print(f"  - Token usage: {client.usage_stats()}")
+    if PROMPT_BUDGETER.budget is not None:
+        print(f"  - Prompt budget: {PROMPT_BUDGETER.stats()}")
+    print(f"  - Request metrics: {json.dumps(METRICS.summary(), ensure_ascii=False)}")
+
+# --- MODIFIED: Main function now streams the input through a bounded window ---
 def generate_quizzes_from_jsonl():
     """
-    Reads a large .jsonl file in chunks to avoid memory errors, generates quizzes,
-    and saves the output to a new .jsonl file.
+    Streams a large .jsonl file through a bounded window of worker threads, generates
+    quizzes, and writes each result to a new .jsonl file as soon as it completes.
+    With REDRIVE, only the failed records of an existing OUTPUT_FILE are processed again.
     """
+    if REDRIVE:
+        return redrive_failed_quizzes()
     if not os.path.exists(INPUT_FILE):
         print(f"FATAL: Input file not found at '{INPUT_FILE}'. Please run the data preparation script first.")
         return
 
     # To get a total for the progress bar, we can count the lines first
     print("Counting total problems in input file...")
-    with open(INPUT_FILE, 'r', encoding='utf-8') as f:
-        total_problems = sum(1 for line in f)
+    total_problems = count_records(INPUT_FILE, INPUT_BYTE_RANGE)
     
     print(f"Found {total_problems} problems to process.")
 
-    with ThreadPoolExecutor(max_workers=CONCURRENT_REQUESTS) as executor, \
-         open(INPUT_FILE, 'r', encoding='utf-8') as f_in, \
-         open(OUTPUT_FILE, 'w', encoding='utf-8') as f_out:
+    completed_uuids = set()
+    if RESUME:
+        completed_uuids = scan_completed_keys(OUTPUT_FILE, lambda record: record.get('uuid'), columns=['uuid'])
+        print(f"Resuming: {len(completed_uuids)} problems already in '{OUTPUT_FILE}' will be skipped.")
+
+    max_in_flight = CONCURRENT_REQUESTS * IN_FLIGHT_MULTIPLIER
+
+    metrics_base = os.path.splitext(OUTPUT_FILE.rstrip('/\\'))[0]
+    METRICS.open(metrics_base + ".request_metrics.jsonl" if METRICS_EVENT_LOG else None,
+                 metrics_base + ".metrics.prom" if METRICS_PROMETHEUS else None, append=RESUME)
+    try:
+        with ThreadPoolExecutor(max_workers=CONCURRENT_REQUESTS) as executor, \
+             open_record_writer(OUTPUT_FILE, 'a' if RESUME else 'w', OUTPUT_ROWS_PER_PART) as f_out:
         
-        # We use executor.map on the file object directly. This creates a generator.
-        # It reads one line, submits it to a worker thread, and moves to the next.
-        # This is highly memory-efficient.
-        problem_generator = (json.loads(line) for line in f_in)
+            # Records are read lazily: a new record is only read from disk once a slot in
+            # the window frees up, so at most `max_in_flight` records (plus the LENGTH_LOOKAHEAD
+            # records held back for length scheduling) are in memory.
+            problem_generator = schedule_by_length((
+                problem for problem in iter_records(INPUT_FILE, byte_range=INPUT_BYTE_RANGE)
+                if problem.get('uuid') not in completed_uuids
+            ), estimate_record_tokens, LENGTH_SCHEDULING, LENGTH_LOOKAHEAD)
         
-        results_iterator = tqdm(
-            executor.map(process_single_problem, problem_generator),
-            total=total_problems,
-            desc="Generating Quizzes"
-        )
+            results_iterator = tqdm(
+                bounded_unordered_map(executor, process_single_problem, problem_generator, max_in_flight),
+                total=max(total_problems - len(completed_uuids), 0),
+                desc="Generating Quizzes"
+            )
         
-        # Write results to the output file as they are completed
-        print(f"Writing results to {OUTPUT_FILE}...")
-        for result in results_iterator:
-            f_out.write(json.dumps(result) + '\n')
+            # Write results to the output file as they are completed (not in input order)
+            print(f"Writing results to {OUTPUT_FILE}...")
+            for result in results_iterator:
+                f_out.write(result)
+    finally:
+        METRICS.close()
+
+    if REORDER_OUTPUT and detect_format(OUTPUT_FILE) != "jsonl":
+        print("REORDER_OUTPUT only applies to .jsonl outputs; columnar output is left in completion order.")
+    elif REORDER_OUTPUT:
+        print("Restoring input order in output file...")
+        reorder_output_by_input(INPUT_FILE, OUTPUT_FILE, INPUT_BYTE_RANGE)
 
     print(f"\n✅ Finished processing. Output saved to '{OUTPUT_FILE}'")
+    if LLM_CACHE:
+        print(f"  - Response cache: {LLM_CACHE.stats()}")
+    if RATE_LIMITER:
+        print(f"  - Rate control: {RATE_LIMITER.stats()}")
+    print(f"  - Token usage: {client.usage_stats()}")
+    if PROMPT_BUDGETER.budget is not None:
+        print(f"  - Prompt budget: {PROMPT_BUDGETER.stats()}")
+    if HEDGE_POLICY:
+        print(f"  - Hedged requests: {HEDGE_POLICY.stats()}")
+    print(f"  - Request metrics: {json.dumps(METRICS.summary(), ensure_ascii=False)}")
 
 if __name__ == "__main__":
     generate_quizzes_from_jsonl()
@@ -1,12 +1,22 @@
+import asyncio
+import collections
 import json
 import os
 import re
 import time
 from tqdm import tqdm
 from datetime import datetime
-from openai import OpenAI
 # Make sure you have a prompts.py file with these variables defined
-from prompts import REASONING_PROMPT, QUIZ_GRADING_PROMPT
+from prompts import REASONING_PROMPT, QUIZ_GRADING_PROMPT, QUIZ_BATCH_GRADING_PROMPT
+from checkpoint import scan_completed_keys
+from llm_client import HedgePolicy, estimate_prompt_tokens, make_cache_key, open_llm_client, open_response_cache
+from batch_files import batch_request, iter_batch_results, iter_jsonl, make_custom_id, parse_custom_id
+from metrics import MetricsRecorder
+from run_stats import RunStatsAccumulator
+from pre_grader import pre_grade, should_audit, PreGraderStats
+from answer_check import extract_boxed_answer, normalize_and_compare_answers
+from record_io import iter_records, count_records
+from length_schedule import schedule_by_length
 
 # --- Configuration ---
 
@@ -15,24 +25,143 @@ GRADER_API_URL = "YOUR_DEEPSEEK_V3_API_URL_HERE"
 GRADER_API_KEY = "YOUR_DEEPSEEK_API_KEY_HERE" 
 GRADER_MODEL = "deepseek-chat" # Ensure this is the correct model name
 
+# A local URL may also be a list of replica URLs serving the same model (see deploy_local_models.sh),
+# e.g. ["http://localhost:8001/v1", "http://localhost:8003/v1"]; requests then go to the least-loaded healthy replica.
 LOCAL_API_URL_PEER = "http://localhost:8000/v1"
 LOCAL_API_KEY_PEER = "EMPTY"
 
 LOCAL_API_URL_STUDENT = "http://localhost:8001/v1"
 LOCAL_API_KEY_STUDENT = "EMPTY"
 
+# Replica pools: a replica is taken out of rotation for REPLICA_EJECT_SECONDS after REPLICA_EJECT_AFTER
+# consecutive connection errors/timeouts/5xx, or while its /health endpoint (polled every
+# REPLICA_HEALTH_CHECK_INTERVAL seconds) does not answer. A failed request is retried on another replica.
+REPLICA_EJECT_AFTER = 3
+REPLICA_EJECT_SECONDS = 30.0
+REPLICA_HEALTH_CHECK_INTERVAL = 10.0
+
 # --- 需要老师改写: File I/O & Script Behavior ---
 # The script now reads from the single JSONL file produced by the quiz generation step.
 INPUT_FILE = "/root/autodl-tmp/math_data_with_quizzes.jsonl"  # 需要改写，按照分块
+# Process only one shard of INPUT_FILE: (start_byte, end_byte) from a slice_jsons.py manifest. None = whole file.
+INPUT_BYTE_RANGE = None
+# INPUT_FILE may also be Parquet / Arrow IPC (see record_io.py); then only these columns are read from disk.
+INPUT_COLUMNS = ["uuid", "problem", "answer", "quiz", "valid_reasoning_traces"]
 
 # Output will be organized by a timestamp for each run
 RUN_TIMESTAMP = datetime.now().strftime("%Y%m%d_%H%M%S")
-OUTPUT_BASE_DIR = f"results/run_{RUN_TIMESTAMP}"
+# To continue an interrupted run, set this to its directory (e.g. "results/run_20250101_120000").
+# Already-written (problem_id, generator_type, trace_num) records are kept; only missing traces are redone.
+RESUME_RUN_DIR = None
+OUTPUT_BASE_DIR = RESUME_RUN_DIR or f"results/run_{RUN_TIMESTAMP}"
 OUTPUT_DETAILS_FILE = os.path.join(OUTPUT_BASE_DIR, "run_details.jsonl")
 OUTPUT_OVERVIEW_FILE = os.path.join(OUTPUT_BASE_DIR, "run_overview.json")
 
+# --- Execution Mode ---
+# "sequential": one problem at a time, every call blocks (the original behaviour).
+# "async": trace generation and grading run concurrently across problems, so the
+#          peer/student vLLM servers and the grader API are all kept busy.
+EXECUTION_MODE = "async"
+# Max in-flight requests per client key (only used in "async" mode), per replica for replica pools.
+CONCURRENCY_LIMITS = {
+    "peer": 16,
+    "student": 32,
+    "grader": 16,
+}
+# Max problems being worked on at once in "async" mode; bounds memory use.
+MAX_PROBLEMS_IN_FLIGHT = 64
+# Length-aware dispatch (see length_schedule.py), from estimated prompt and trace lengths per problem.
+# "longest_first": start the longest problem among the next LENGTH_LOOKAHEAD first, so long problems
+#                  do not straggle alone at the end of a slice.
+# "grouped": release whole windows of LENGTH_LOOKAHEAD problems longest first, so the vLLM servers
+#            batch requests of similar lengths together.
+# None: file order.
+LENGTH_SCHEDULING = "longest_first"
+LENGTH_LOOKAHEAD = 256
+
+# --- Adaptive Rate Control ---
+# Per-client AIMD limiters (see rate_limit.py): concurrency grows while requests succeed and is cut
+# on 429s, 5xx and timeouts, with optional requests/tokens-per-minute caps. The matching
+# CONCURRENCY_LIMITS entry remains the hard ceiling. Clients not listed here are not adapted.
+# Replica pools get one limiter per replica, so these limits (including the per-minute caps) apply per replica.
+ADAPTIVE_RATE_LIMITS = {
+    "grader": {"initial_concurrency": 8, "requests_per_minute": None, "tokens_per_minute": None},
+}
+
+# --- Hedged Requests ---
+# A request still running past the `percentile` of its client's recent latencies is sent a second time;
+# the first answer is kept and the other request is cancelled (see llm_client.HedgePolicy). `budget` caps
+# the duplicates at that fraction of the client's requests. Clients not listed here are never hedged.
+# Duplicates sent to a paid API are billed (up to `budget` extra), so hedging is opt-in; the grader API
+# is the usual candidate, e.g. {"grader": {"percentile": 0.95, "budget": 0.05}}. A duplicate sent to an
+# already saturated local vLLM server only adds load.
+HEDGED_REQUESTS = {}
+
+# --- Batched Grading ---
+# Up to this many traces of one problem are graded in a single grader call (QUIZ_BATCH_GRADING_PROMPT),
+# so the quiz and the instructions are sent once per batch instead of once per trace. The reply must
+# be a JSON array with one result per trace; if it is not, that batch is re-graded one trace per call.
+# 1 = the original one-call-per-trace grading.
+GRADER_BATCH_SIZE = 6
+
+# --- Local Pre-Grader ---
+# Traces whose quiz answers can be read off unambiguously (numeric options, or option text written
+# out in the trace, see pre_grader.py) are scored locally and skip the grader LLM. PRE_GRADER_AUDIT_RATE
+# of them are still sent to the grader, whose result is recorded, to track agreement ("pre_grader" in
+# run_overview.json). PRE_GRADER_CREDIT_CONCEPTUAL = True also scores traces whose conceptual question
+# has no evidence, crediting it when every numeric step is right (listed in "Auto_Credited_Questions");
+# more traces skip the grader, but their scores lean high.
+PRE_GRADER_ENABLED = True
+PRE_GRADER_AUDIT_RATE = 0.05
+PRE_GRADER_CREDIT_CONCEPTUAL = False
+
+# --- Grader Prefix Caching ---
+# Grading prompts put the instructions and the quiz first (see GradingPrompts), so all gradings of one
+# problem share a long prefix. In "async" mode, True sends a problem's first grading call alone and
+# releases the rest once it returns, so they hit DeepSeek's context cache (or vLLM's prefix cache,
+# see deploy_local_models.sh) instead of all missing it at once. Cached prompt tokens reported by the
+# API are summed in run_overview.json under "token_usage".
+GRADER_PREFIX_WARMUP = True
+
+# --- Streaming Early Stop (optional) ---
+# Set to a number of tokens (stream chunks, e.g. 32) to stream peer/student traces and cancel the
+# request that many tokens after a balanced \boxed{...} closes; the stored trace ends there. This frees
+# the vLLM slot instead of letting the model ramble on to max_tokens, but changes the saved traces
+# (and their cache keys) compared with full generations. None = plain, non-streamed requests.
+EARLY_STOP_GRACE_TOKENS = None
+
+# --- Offline Batch Mode ---
+# Splits trace generation from grading, so the peer/student models can run as offline batch jobs (vLLM's
+# run_batch batches far better than the online server and has no HTTP overhead):
+#   "emit":   write every pending REASONING_PROMPT request of INPUT_FILE (or its INPUT_BYTE_RANGE shard) to
+#             BATCH_DIR/<type>_requests.jsonl in OpenAI batch format, one file per api_call reasoner, and stop.
+#             Run each file with `python -m vllm.entrypoints.openai.run_batch -i <type>_requests.jsonl
+#             -o <type>_results.jsonl --model <model_id>`, any OpenAI-compatible batch API, or batch_files.py.
+#   "ingest": load BATCH_DIR/<type>_results.jsonl into the response cache, then extract answers and grade as
+#             usual. Batch traces are full generations (EARLY_STOP_GRACE_TOKENS does not apply); requests that
+#             failed or are missing from the results are sent to the online endpoint instead.
+#   None:     generate traces online (the default).
+BATCH_PHASE = None
+BATCH_DIR = None  # None = <OUTPUT_BASE_DIR>/batch; when ingesting in a new run, point this at the emitting run's batch dir
+
+# --- Response Cache (shared with generate_quizzes.py) ---
+# Traces are cached per (prompt, sample index), so re-running with a changed QUIZ_GRADING_PROMPT
+# reuses the same traces and only pays for the new grading calls. Set the path to None to disable.
+LLM_CACHE_PATH = "cache/llm_responses.sqlite"
+LLM_CACHE_MAX_MB = 4096
+
+# --- Request Metrics ---
+# Per-client/model latency and time-to-first-token histograms, token counts, retries and error classes
+# (see metrics.py), summarised under "request_metrics" in run_overview.json. Optionally also written to
+# the run directory as request_metrics.jsonl (one line per API attempt) and metrics.prom (Prometheus
+# textfile, refreshed every 30s; point node_exporter's textfile collector at it to watch a live run).
+METRICS_EVENT_LOG = True
+METRICS_PROMETHEUS = True
+
 # --- Portfolio of Reasoner Models ---
 # The script will use these configurations to generate new reasoning traces.
+# "batched_sampling": True requests all `num_traces` samples in one call with `n=num_traces`,
+# so the server prefills the prompt once. Endpoints that reject n>1 fall back to one call per trace.
 REASONER_MODELS = [
     {
         "type": "expert",
@@ -46,7 +175,8 @@ REASONER_MODELS = [
         "api_url": LOCAL_API_URL_PEER,
         "api_key": LOCAL_API_KEY_PEER,
         "num_traces": 2,
-        "temperature": 0.7
+        "temperature": 0.7,
+        "batched_sampling": True
     },
     {
         "type": "student",
@@ -55,7 +185,8 @@ REASONER_MODELS = [
         "api_url": LOCAL_API_URL_STUDENT,
         "api_key": LOCAL_API_KEY_STUDENT,
         "num_traces": 2,
-        "temperature": 0.9
+        "temperature": 0.9,
+        "batched_sampling": True
     }
 ]
 
@@ -63,37 +194,65 @@ REASONER_MODELS = [
 
 # --- IMPROVEMENT: Pre-initialize API clients for efficiency ---
 print("Initializing API clients...")
+LLM_CACHE = open_response_cache(LLM_CACHE_PATH, LLM_CACHE_MAX_MB)
+def rate_limiter_settings():
+    """Settings of each client's AdaptiveLimiter; replica pools get one limiter per replica (run_shards.py re-reads them)."""
+    return {
+        key: dict(max_concurrency=CONCURRENCY_LIMITS[key], **settings)
+        for key, settings in ADAPTIVE_RATE_LIMITS.items()
+    }
+
+RATE_LIMITER_SETTINGS = rate_limiter_settings()
+HEDGE_POLICIES = {key: HedgePolicy(**settings) for key, settings in HEDGED_REQUESTS.items()}
+METRICS = MetricsRecorder()
+REPLICA_SETTINGS = {"eject_after": REPLICA_EJECT_AFTER, "eject_seconds": REPLICA_EJECT_SECONDS, "health_check_interval": REPLICA_HEALTH_CHECK_INTERVAL}
 API_CLIENTS = {
-    "grader": OpenAI(api_key=GRADER_API_KEY, base_url=GRADER_API_URL, max_retries=3, timeout=300.0),
-    "peer": OpenAI(api_key=LOCAL_API_KEY_PEER, base_url=LOCAL_API_URL_PEER, max_retries=3, timeout=300.0),
-    "student": OpenAI(api_key=LOCAL_API_KEY_STUDENT, base_url=LOCAL_API_URL_STUDENT, max_retries=3, timeout=300.0)
+    "grader": open_llm_client(GRADER_API_URL, GRADER_API_KEY, "grader", max_retries=3, timeout=300.0, cache=LLM_CACHE, limiter_settings=RATE_LIMITER_SETTINGS.get("grader"), hedging=HEDGE_POLICIES.get("grader"), metrics=METRICS, **REPLICA_SETTINGS),
+    "peer": open_llm_client(LOCAL_API_URL_PEER, LOCAL_API_KEY_PEER, "peer", max_retries=3, timeout=300.0, cache=LLM_CACHE, limiter_settings=RATE_LIMITER_SETTINGS.get("peer"), hedging=HEDGE_POLICIES.get("peer"), metrics=METRICS, **REPLICA_SETTINGS),
+    "student": open_llm_client(LOCAL_API_URL_STUDENT, LOCAL_API_KEY_STUDENT, "student", max_retries=3, timeout=300.0, cache=LLM_CACHE, limiter_settings=RATE_LIMITER_SETTINGS.get("student"), hedging=HEDGE_POLICIES.get("student"), metrics=METRICS, **REPLICA_SETTINGS)
 }
+PRE_GRADER_STATS = PreGraderStats()
 print("API clients initialized.")
 
 
 # --- MODIFIED: Helper Functions now use pre-initialized clients ---
-def call_llm_api(client_key, prompt, model_id, temperature):
-    """Uses a pre-initialized client to call an OpenAI-compatible API."""
+COMPLETION_MAX_TOKENS = 2048  # also written into batch requests, so ingested traces land on the same cache keys
+
+def call_llm_api(client_key, prompt, model_id, temperature, sample_index=0, early_stop=None):
+    """Uses a pre-initialized client to call an OpenAI-compatible API. See EARLY_STOP_GRACE_TOKENS for `early_stop`."""
     try:
-        client = API_CLIENTS[client_key]
-        completion = client.chat.completions.create(
-            model=model_id,
-            messages=[{"role": "user", "content": prompt}],
-            temperature=temperature,
-            max_tokens=2048
-        )
-        return completion.choices[0].message.content
+        return API_CLIENTS[client_key].complete(prompt, model_id, temperature, max_tokens=COMPLETION_MAX_TOKENS, sample_index=sample_index, early_stop=early_stop)
     except Exception as e:
         print(f"    API Error using client '{client_key}' for model {model_id}: {e}")
         return None
 
-# --- Helper Functions (Unchanged logic) ---
-def extract_boxed_answer(trace_text):
-    if not trace_text: return None
-    match = re.search(r"\\boxed\{(.*?)\}", trace_text, re.DOTALL)
-    if match: return match.group(1).strip()
-    return None
+def call_llm_api_samples(client_key, prompt, model_id, temperature, sample_indices, early_stop=None):
+    """Fetches several samples of one prompt, in a single `n=` request where the endpoint allows it."""
+    try:
+        return API_CLIENTS[client_key].complete_samples(prompt, model_id, temperature, max_tokens=COMPLETION_MAX_TOKENS, sample_indices=sample_indices, early_stop=early_stop)
+    except Exception as e:
+        print(f"    API Error using client '{client_key}' for model {model_id}: {e}")
+        return [None] * len(sample_indices)
+
+async def async_call_llm_api(client_key, prompt, model_id, temperature, semaphores, sample_index=0, early_stop=None):
+    """Async version of call_llm_api; waits on the client's semaphore to cap in-flight requests."""
+    try:
+        async with semaphores[client_key]:
+            return await API_CLIENTS[client_key].acomplete(prompt, model_id, temperature, max_tokens=COMPLETION_MAX_TOKENS, sample_index=sample_index, early_stop=early_stop)
+    except Exception as e:
+        print(f"    API Error using client '{client_key}' for model {model_id}: {e}")
+        return None
+
+async def async_call_llm_api_samples(client_key, prompt, model_id, temperature, semaphores, sample_indices, early_stop=None):
+    """Async version of call_llm_api_samples; one batched request occupies one in-flight slot."""
+    try:
+        async with semaphores[client_key]:
+            return await API_CLIENTS[client_key].acomplete_samples(prompt, model_id, temperature, max_tokens=COMPLETION_MAX_TOKENS, sample_indices=sample_indices, early_stop=early_stop)
+    except Exception as e:
+        print(f"    API Error using client '{client_key}' for model {model_id}: {e}")
+        return [None] * len(sample_indices)
 
+# --- Helper Functions (Unchanged logic) ---
 def parse_json_from_text(text):
     if not text: return None
     match = re.search(r'\{.*\}', text, re.DOTALL)
@@ -102,29 +261,425 @@ def parse_json_from_text(text):
         except json.JSONDecodeError: return None
     return None
 
-def normalize_and_compare_answers(extracted_answer_raw, ground_truth_answers_list):
-    if extracted_answer_raw is None or not ground_truth_answers_list: return False
-    def normalize(text):
-        s = str(text).strip().lower()
-        s = re.sub(r'\\(d?frac)\s*\{([^}]+)\}\s*\{([^}]+)\}', r'\2/\3', s)
-        s = re.sub(r'\\[a-zA-Z]+', '', s)
-        s = re.sub(r'\s+', '', s)
-        s = re.sub(r'^[(\[{]*|[])}\$]*$', '', s)
-        return s
-    norm_extracted = normalize(extracted_answer_raw)
-    for gt_answer in ground_truth_answers_list:
-        norm_ground_truth = normalize(gt_answer)
-        if norm_extracted == norm_ground_truth: return True
-        try:
-            def evaluate_numeric(val):
-                if '/' in val:
-                    parts = val.split('/'); return float(parts[0]) / float(parts[1])
-                return float(val)
-            if abs(evaluate_numeric(norm_extracted) - evaluate_numeric(norm_ground_truth)) < 1e-6: return True
-        except (ValueError, TypeError, ZeroDivisionError): pass
-    return False
-
-# --- MODIFIED: Main Orchestration now reads and writes JSONL files ---
+# --- Per-problem evaluation, shared by the sequential and async modes ---
+def get_record_key(record):
+    """Identifies one graded trace in run_details.jsonl; used to skip finished work on resume."""
+    return (record.get('problem_id'), record.get('generator_type'), record.get('trace_num'))
+
+def get_pending_trace_nums(problem_id, reasoner_config, completed_keys):
+    """Trace numbers (1-based) of an api_call reasoner that still need to be generated."""
+    return [trace_num for trace_num in range(1, reasoner_config["num_traces"] + 1)
+            if (problem_id, reasoner_config["type"], trace_num) not in completed_keys]
+
+def get_problem_fields(problem_data):
+    """Returns (problem_id, question, ground_truth_raw_str) for a quiz record."""
+    problem_id = problem_data.get('uuid')
+    question = problem_data.get('problem')
+    ground_truth_raw_str = str(problem_data.get('answer'))
+    return problem_id, question, ground_truth_raw_str
+
+def estimate_record_tokens(problem_data):
+    """
+    Rough cost of a problem for LENGTH_SCHEDULING: the reasoner prompt and the quiz the grader reads,
+    plus the expected length of the traces to generate. The pre-generated expert traces stand in for
+    those (capped at COMPLETION_MAX_TOKENS), as harder problems get longer traces from every model.
+    """
+    expert_traces = [trace for trace in problem_data.get('valid_reasoning_traces') or [] if isinstance(trace, str)]
+    if expert_traces:
+        expected_trace_tokens = min(sum(map(estimate_prompt_tokens, expert_traces)) // len(expert_traces), COMPLETION_MAX_TOKENS)
+    else:
+        expected_trace_tokens = COMPLETION_MAX_TOKENS // 2
+    prompt_tokens = estimate_prompt_tokens(str(problem_data.get('problem', ''))) + estimate_prompt_tokens(json.dumps(problem_data.get('quiz')))
+    return prompt_tokens + expected_trace_tokens
+
+def collect_pre_generated_traces(problem_data, reasoner_config):
+    # MODIFIED: Read from 'valid_reasoning_traces'
+    model_type = reasoner_config["type"]
+    pre_gen_traces = (problem_data.get('valid_reasoning_traces') or [])[:reasoner_config["num_traces"]]
+    return [{"trace": trace, "model_id": f"pre_generated_{model_type}"} for trace in pre_gen_traces]
+
+def render_prompt_head(template, first_per_call_field, **shared_fields):
+    """Splits `template` before its first per-call field and renders the shared head once."""
+    head, marker, tail = template.partition("{" + first_per_call_field + "}")
+    return head.format(**shared_fields), marker + tail
+
+class GradingPrompts:
+    """
+    Grading prompts of one problem. The instructions and the quiz JSON come first in both templates,
+    so they are rendered once per problem and every grading call for the problem starts with the same
+    prefix, which provider-side context caching or vLLM prefix caching can reuse.
+    """
+
+    def __init__(self, quiz_json):
+        self.quiz_json = quiz_json
+        quiz_json_text = json.dumps(quiz_json, indent=2)
+        self.single_head, self.single_tail = render_prompt_head(QUIZ_GRADING_PROMPT, "reasoner_trace_text", quiz_json_text=quiz_json_text)
+        self.batch_head, self.batch_tail = render_prompt_head(QUIZ_BATCH_GRADING_PROMPT, "num_traces", quiz_json_text=quiz_json_text)
+
+    def single(self, reason_trace):
+        return self.single_head + self.single_tail.format(reasoner_trace_text=reason_trace)
+
+    def batch(self, reason_traces):
+        reasoner_traces_text = "\n\n".join(f"--- Trace {i} ---\n{trace}" for i, trace in enumerate(reason_traces, 1))
+        return self.batch_head + self.batch_tail.format(num_traces=len(reason_traces), reasoner_traces_text=reasoner_traces_text)
+
+def split_batch_grading_output(raw_grading_output, num_traces):
+    """
+    Splits a batched grader reply into one raw JSON string per trace, in trace order, so each can go
+    through build_result_record like a single grading reply. Returns None if the reply is unusable.
+    """
+    if not raw_grading_output: return None
+    match = re.search(r'\[.*\]', raw_grading_output, re.DOTALL)
+    if not match: return None
+    try: results = json.loads(match.group(0))
+    except json.JSONDecodeError: return None
+    if not isinstance(results, list) or len(results) != num_traces: return None
+    if not all(isinstance(result, dict) and "Score" in result for result in results): return None
+    trace_labels = [result.get("Trace") for result in results]
+    if all(isinstance(label, int) for label in trace_labels):
+        if sorted(trace_labels) != list(range(1, num_traces + 1)): return None
+        results = sorted(results, key=lambda result: result["Trace"])
+    return [json.dumps(result) for result in results]
+
+def batch_traces(items):
+    """Groups (model_type, trace_num, trace_info) items with a trace into grader batches of GRADER_BATCH_SIZE."""
+    items = [item for item in items if item[2]["trace"]]  # Skip if trace generation failed
+    batch_size = max(1, GRADER_BATCH_SIZE)
+    return [items[i:i + batch_size] for i in range(0, len(items), batch_size)]
+
+def pre_grade_items(problem_id, question, quiz_json, items):
+    """
+    Runs the local pre-grader over (model_type, trace_num, trace_info) items. Returns (locally graded
+    [(item, raw_grading_output)], items left for the grader LLM, audits), where `audits` maps the
+    (model_type, trace_num) of items sent to the grader for an agreement check to their local result.
+    """
+    if not PRE_GRADER_ENABLED:
+        return [], items, {}
+    local, remaining, audits = [], [], {}
+    for item in items:
+        model_type, trace_num, trace_info = item
+        if not trace_info["trace"]:
+            remaining.append(item)  # dropped by batch_traces
+            continue
+        PRE_GRADER_STATS.checked += 1
+        result = pre_grade(quiz_json, trace_info["trace"], question, credit_conceptual=PRE_GRADER_CREDIT_CONCEPTUAL)
+        if result is None:
+            remaining.append(item)
+        elif should_audit((problem_id, model_type, trace_num), PRE_GRADER_AUDIT_RATE):
+            audits[(model_type, trace_num)] = result
+            remaining.append(item)
+        else:
+            PRE_GRADER_STATS.graded_locally += 1
+            local.append((item, json.dumps(result)))
+    return local, remaining, audits
+
+def build_graded_record(problem_id, item, ground_truth_raw_str, raw_grading_output, audits):
+    """build_result_record for a (model_type, trace_num, trace_info) item, checking audited traces against the pre-grader."""
+    model_type, trace_num, trace_info = item
+    record = build_result_record(problem_id, model_type, trace_num, trace_info, ground_truth_raw_str, raw_grading_output)
+    if (model_type, trace_num) in audits:
+        PRE_GRADER_STATS.add_audit(audits[(model_type, trace_num)], record["grading_result"])
+    return record
+
+def build_result_record(problem_id, model_type, trace_num, trace_info, ground_truth_raw_str, raw_grading_output):
+    """Scores one graded trace and assembles the record written to run_details.jsonl."""
+    reason_trace = trace_info["trace"]
+    # IMPROVEMENT: Safer answer parsing
+    ground_truth_answers_list = [ground_truth_raw_str]
+
+    extracted_answer = extract_boxed_answer(reason_trace)
+    is_correct = normalize_and_compare_answers(extracted_answer, ground_truth_answers_list)
+
+    grading_result = parse_json_from_text(raw_grading_output)
+    reward_score = 0.0
+    if grading_result and "Score" in grading_result:
+        score_match = re.search(r'(\d+\.?\d*)', str(grading_result.get("Score")))
+        if score_match: reward_score = float(score_match.group(1))
+
+    return {
+        "problem_id": problem_id, "generator_model": trace_info["model_id"],
+        "generator_type": model_type, "trace_num": trace_num, "is_correct": is_correct,
+        "ground_truth_answer": ground_truth_raw_str,
+        "extracted_answer": extracted_answer, "reward_score": reward_score,
+        "reason_trace": reason_trace, "grading_result": grading_result,
+    }
+
+def iter_problem_results(problem_data, completed_keys):
+    """Sequential mode: generates and grades every trace of one problem, yielding records as they finish."""
+    grading_prompts = GradingPrompts(problem_data.get('quiz'))
+    problem_id, question, ground_truth_raw_str = get_problem_fields(problem_data)
+    pending_items = []
+
+    # Loop through the model portfolio
+    for reasoner_config in REASONER_MODELS:
+        model_type = reasoner_config["type"]
+        num_traces = reasoner_config["num_traces"]
+        traces_to_evaluate = []
+
+        if reasoner_config["source"] == "pre_generated":
+            traces_to_evaluate = collect_pre_generated_traces(problem_data, reasoner_config)
+
+        elif reasoner_config["source"] == "api_call" and reasoner_config.get("batched_sampling"):
+            reasoner_prompt = REASONING_PROMPT.format(problem=question)
+            trace_nums = get_pending_trace_nums(problem_id, reasoner_config, completed_keys)
+            new_traces = call_llm_api_samples(model_type, reasoner_prompt, reasoner_config["model_id"], reasoner_config["temperature"], trace_nums, early_stop=trace_early_stop()) if trace_nums else []
+            traces_by_num = dict(zip(trace_nums, new_traces))
+            # Slots already graded in a resumed run stay None, so trace numbers line up.
+            traces_to_evaluate = [{"trace": traces_by_num.get(i + 1), "model_id": reasoner_config["model_id"]} for i in range(num_traces)]
+
+        elif reasoner_config["source"] == "api_call":
+            for i in range(num_traces):
+                if (problem_id, model_type, i + 1) in completed_keys:
+                    # Already graded in the run being resumed; keep the slot so trace numbers line up.
+                    traces_to_evaluate.append({"trace": None, "model_id": reasoner_config["model_id"]})
+                    continue
+                reasoner_prompt = REASONING_PROMPT.format(problem=question)
+                new_trace = call_llm_api(model_type, reasoner_prompt, reasoner_config["model_id"], reasoner_config["temperature"], sample_index=i + 1, early_stop=trace_early_stop())
+                traces_to_evaluate.append({"trace": new_trace, "model_id": reasoner_config["model_id"]})
+                time.sleep(1)
+
+        items = [(model_type, i + 1, trace_info) for i, trace_info in enumerate(traces_to_evaluate)
+                 if (problem_id, model_type, i + 1) not in completed_keys]
+        if GRADER_BATCH_SIZE > 1:
+            # Graded below, together with the traces of the other reasoners.
+            pending_items.extend(items)
+        else:
+            yield from grade_items(problem_id, question, grading_prompts, ground_truth_raw_str, items)
+
+    yield from grade_items(problem_id, question, grading_prompts, ground_truth_raw_str, pending_items)
+
+def grade_items(problem_id, question, grading_prompts, ground_truth_raw_str, items):
+    """
+    Sequential mode: grades (model_type, trace_num, trace_info) items, locally where the pre-grader
+    is confident and otherwise GRADER_BATCH_SIZE traces per grader call.
+    """
+    local, items, audits = pre_grade_items(problem_id, question, grading_prompts.quiz_json, items)
+    for item, raw_grading_output in local:
+        yield build_graded_record(problem_id, item, ground_truth_raw_str, raw_grading_output, audits)
+    for batch in batch_traces(items):
+        raw_outputs = None
+        if len(batch) > 1:
+            raw_batch_output = call_llm_api("grader", grading_prompts.batch([info["trace"] for _, _, info in batch]), GRADER_MODEL, 0.3)
+            raw_outputs = split_batch_grading_output(raw_batch_output, len(batch))
+            if raw_outputs is None:
+                print(f"    Batched grading of {len(batch)} traces for problem {problem_id} failed; grading them one by one.")
+        for i, item in enumerate(batch):
+            raw_grading_output = raw_outputs[i] if raw_outputs else call_llm_api("grader", grading_prompts.single(item[2]["trace"]), GRADER_MODEL, 0.3)
+            yield build_graded_record(problem_id, item, ground_truth_raw_str, raw_grading_output, audits)
+
+async def evaluate_problem_async(problem_data, semaphores, completed_keys):
+    """
+    Async mode: every trace of one problem is generated concurrently. With GRADER_BATCH_SIZE = 1 each
+    trace is graded as soon as it arrives; otherwise grading waits for all of the problem's traces so
+    they can share grader calls. Returns the records in the same order as the sequential mode.
+    """
+    grading_prompts = GradingPrompts(problem_data.get('quiz'))
+    problem_id, question, ground_truth_raw_str = get_problem_fields(problem_data)
+    prefix_cached = asyncio.Event()
+    warmup_started = False
+
+    async def call_grader(grading_prompt):
+        # With GRADER_PREFIX_WARMUP, the problem's first grading call goes out alone and the others
+        # wait for it, so they find the shared instructions + quiz prefix already cached.
+        nonlocal warmup_started
+        if GRADER_PREFIX_WARMUP and not prefix_cached.is_set():
+            if warmup_started:
+                await prefix_cached.wait()
+            else:
+                warmup_started = True
+                try:
+                    return await async_call_llm_api("grader", grading_prompt, GRADER_MODEL, 0.3, semaphores)
+                finally:
+                    prefix_cached.set()
+        return await async_call_llm_api("grader", grading_prompt, GRADER_MODEL, 0.3, semaphores)
+
+    async def grade_trace(item, audits):
+        raw_grading_output = await call_grader(grading_prompts.single(item[2]["trace"]))
+        return build_graded_record(problem_id, item, ground_truth_raw_str, raw_grading_output, audits)
+
+    async def grade_batch(batch, audits):
+        if len(batch) > 1:
+            raw_batch_output = await call_grader(grading_prompts.batch([info["trace"] for _, _, info in batch]))
+            raw_outputs = split_batch_grading_output(raw_batch_output, len(batch))
+            if raw_outputs is not None:
+                return [build_graded_record(problem_id, item, ground_truth_raw_str, raw_grading_output, audits)
+                        for item, raw_grading_output in zip(batch, raw_outputs)]
+            print(f"    Batched grading of {len(batch)} traces for problem {problem_id} failed; grading them one by one.")
+        return await asyncio.gather(*(grade_trace(item, audits) for item in batch))
+
+    async def grade_items(items):
+        local, items, audits = pre_grade_items(problem_id, question, grading_prompts.quiz_json, items)
+        graded = await asyncio.gather(*(grade_batch(batch, audits) for batch in batch_traces(items)))
+        return [build_graded_record(problem_id, item, ground_truth_raw_str, raw_grading_output, audits) for item, raw_grading_output in local] + \
+               [record for records in graded for record in records]
+
+    # Each job returns the traces it produced as (model_type, trace_num, trace_info) items,
+    # so single and batched generations can be mixed.
+    async def pre_generated(items):
+        return items
+
+    async def generate(reasoner_config, trace_num):
+        model_type = reasoner_config["type"]
+        reasoner_prompt = REASONING_PROMPT.format(problem=question)
+        new_trace = await async_call_llm_api(model_type, reasoner_prompt, reasoner_config["model_id"], reasoner_config["temperature"], semaphores, sample_index=trace_num, early_stop=trace_early_stop())
+        return [(model_type, trace_num, {"trace": new_trace, "model_id": reasoner_config["model_id"]})]
+
+    async def generate_batch(reasoner_config, trace_nums):
+        model_type = reasoner_config["type"]
+        reasoner_prompt = REASONING_PROMPT.format(problem=question)
+        new_traces = await async_call_llm_api_samples(model_type, reasoner_prompt, reasoner_config["model_id"], reasoner_config["temperature"], semaphores, trace_nums, early_stop=trace_early_stop())
+        return [(model_type, trace_num, {"trace": new_trace, "model_id": reasoner_config["model_id"]})
+                for trace_num, new_trace in zip(trace_nums, new_traces)]
+
+    async def generate_and_grade(job):
+        return await grade_items(await job)
+
+    jobs = []
+    for reasoner_config in REASONER_MODELS:
+        model_type = reasoner_config["type"]
+        if reasoner_config["source"] == "pre_generated":
+            items = [(model_type, i + 1, trace_info) for i, trace_info in enumerate(collect_pre_generated_traces(problem_data, reasoner_config))
+                     if (problem_id, model_type, i + 1) not in completed_keys]
+            jobs.append(pre_generated(items))
+        elif reasoner_config["source"] == "api_call":
+            trace_nums = get_pending_trace_nums(problem_id, reasoner_config, completed_keys)
+            if reasoner_config.get("batched_sampling") and trace_nums:
+                jobs.append(generate_batch(reasoner_config, trace_nums))
+            else:
+                jobs.extend(generate(reasoner_config, trace_num) for trace_num in trace_nums)
+
+    if GRADER_BATCH_SIZE > 1:
+        produced = await asyncio.gather(*jobs)
+        return await grade_items([item for items in produced for item in items])
+    results = await asyncio.gather(*(generate_and_grade(job) for job in jobs))
+    return [record for records in results for record in records]
+
+async def run_evaluation_async(problems, total_problems, f_details, stats, completed_keys):
+    """
+    Keeps up to MAX_PROBLEMS_IN_FLIGHT problems running at once. Records are written
+    per problem as each one completes, so problem order in the output may differ from the input.
+    """
+    semaphores = {key: asyncio.Semaphore(limit * API_CLIENTS[key].num_replicas) for key, limit in CONCURRENCY_LIMITS.items()}
+    pending = set()
+
+    with tqdm(total=total_problems, desc="Evaluating Problems") as pbar:
+        def write_finished(done):
+            for task in done:
+                for result_record in task.result():
+                    f_details.write(json.dumps(result_record) + '\n')
+                    stats.add(result_record)
+                pbar.update(1)
+
+        for problem_data in problems:
+            if not problem_data.get('quiz'):
+                pbar.update(1)
+                continue
+
+            pending.add(asyncio.create_task(evaluate_problem_async(problem_data, semaphores, completed_keys)))
+            if len(pending) >= MAX_PROBLEMS_IN_FLIGHT:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                write_finished(done)
+
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            write_finished(done)
+
+# --- Offline batch phases (see BATCH_PHASE) ---
+def trace_early_stop():
+    """Early stop for reasoner calls. Ingested batch traces are full generations, cached without it."""
+    return None if BATCH_PHASE == "ingest" else EARLY_STOP_GRACE_TOKENS
+
+def get_batch_dir():
+    return BATCH_DIR or os.path.join(OUTPUT_BASE_DIR, "batch")
+
+def get_batch_files(model_type):
+    batch_dir = get_batch_dir()
+    return os.path.join(batch_dir, f"{model_type}_requests.jsonl"), os.path.join(batch_dir, f"{model_type}_results.jsonl")
+
+def emit_batch_requests(problems, total_problems, completed_keys):
+    """
+    Writes the reasoner requests the online run would send, grouped the same way (one `n=` request per
+    problem with batched_sampling, otherwise one per trace), to one batch input file per reasoner type.
+    """
+    os.makedirs(get_batch_dir(), exist_ok=True)
+    files, counts = {}, collections.Counter()
+    try:
+        for problem_data in tqdm(problems, total=total_problems, desc="Writing batch requests"):
+            if not problem_data.get('quiz'): continue
+            problem_id, question, _ = get_problem_fields(problem_data)
+            reasoner_prompt = REASONING_PROMPT.format(problem=question)
+            for reasoner_config in REASONER_MODELS:
+                if reasoner_config["source"] != "api_call": continue
+                model_type = reasoner_config["type"]
+                trace_nums = get_pending_trace_nums(problem_id, reasoner_config, completed_keys)
+                groups = [trace_nums] if reasoner_config.get("batched_sampling") and trace_nums else [[num] for num in trace_nums]
+                if model_type not in files:
+                    files[model_type] = open(get_batch_files(model_type)[0], 'w', encoding='utf-8')
+                for group in groups:
+                    request = batch_request(make_custom_id(problem_id, model_type, group), reasoner_config["model_id"], reasoner_prompt,
+                                            reasoner_config["temperature"], COMPLETION_MAX_TOKENS, n=len(group))
+                    files[model_type].write(json.dumps(request, ensure_ascii=False) + '\n')
+                    counts[model_type] += len(group)
+    finally:
+        for f in files.values():
+            f.close()
+
+    print(f"\n✅ Batch requests written to '{get_batch_dir()}':")
+    for reasoner_config in REASONER_MODELS:
+        model_type = reasoner_config["type"]
+        if model_type in files:
+            requests_file, results_file = get_batch_files(model_type)
+            print(f"  - {model_type}: {counts[model_type]} traces in {requests_file}")
+            print(f"    python -m vllm.entrypoints.openai.run_batch -i {requests_file} -o {results_file} --model {reasoner_config['model_id']}")
+    print("Then run again with BATCH_PHASE = \"ingest\" (and BATCH_DIR set to this directory if the run directory changes).")
+
+def ingest_batch_results():
+    """
+    Loads every reasoner's batch results into LLM_CACHE under the keys its online calls look up, so the
+    grading pass finds the batch traces as cache hits. The entries are pinned under OUTPUT_BASE_DIR, so
+    LLM_CACHE_MAX_MB cannot evict them before they are read; the run unpins them when it ends. Only the
+    cache keys of each request are held in memory, not its prompt. Returns per-type counts for the overview.
+    """
+    summary = {}
+    for reasoner_config in REASONER_MODELS:
+        if reasoner_config["source"] != "api_call": continue
+        model_type = reasoner_config["type"]
+        requests_file, results_file = get_batch_files(model_type)
+        if not (os.path.exists(requests_file) and os.path.exists(results_file)):
+            print(f"  - {model_type}: no batch files in '{get_batch_dir()}'; its traces will be generated online.")
+            continue
+
+        cache_keys = {}
+        for request in iter_jsonl(requests_file):
+            body = request["body"]
+            _, _, trace_nums = parse_custom_id(request["custom_id"])
+            cache_keys[request["custom_id"]] = [make_cache_key(body["model"], body["messages"][0]["content"], body["temperature"], body["max_tokens"], num)
+                                                for num in trace_nums]
+        counts = collections.Counter()
+        for custom_id, texts, error, usage in iter_batch_results(results_file):
+            keys = cache_keys.pop(custom_id, None)
+            if keys is None:
+                counts["unknown_requests"] += 1
+                continue
+            if texts is None:
+                counts["failed_requests"] += 1
+                if counts["failed_requests"] <= 3:
+                    print(f"    Batch request {custom_id} failed: {error}")
+                continue
+            for index, key in enumerate(keys):
+                if texts.get(index):
+                    LLM_CACHE.put(key, texts[index], pin=OUTPUT_BASE_DIR)
+                    counts["traces"] += 1
+                else:
+                    counts["empty_traces"] += 1
+            counts["completion_tokens"] += (usage or {}).get("completion_tokens") or 0
+        counts["missing_requests"] = len(cache_keys)
+        summary[model_type] = dict(counts)
+        print(f"  - {model_type}: {counts['traces']} traces loaded from {results_file} "
+              f"({counts['failed_requests']} failed and {counts['missing_requests']} missing requests go online).")
+    return summary
+
+# --- MODIFIED: Main Orchestration now streams JSONL files end to end ---
 def run_full_evaluation():
     os.makedirs(OUTPUT_BASE_DIR, exist_ok=True)
     
@@ -132,114 +687,96 @@ def run_full_evaluation():
         print(f"FATAL: No input file found at '{INPUT_FILE}'. Please run 'generate_quizzes.py' first.")
         return
 
-    all_detailed_results = []
-    
+    # Overview statistics are accumulated record by record instead of keeping every result in memory.
+    stats = RunStatsAccumulator()
+    run_status = "Run Complete"
+
+    completed_keys = set()
+    if RESUME_RUN_DIR:
+        # Records from the interrupted run count towards the final overview as well.
+        completed_keys = scan_completed_keys(OUTPUT_DETAILS_FILE, get_record_key, on_record=stats.add)
+        print(f"Resuming run in '{OUTPUT_BASE_DIR}': {len(completed_keys)} graded traces will be skipped.")
+
+    # Count lines up front to get an accurate total for tqdm without loading the file
+    total_problems = count_records(INPUT_FILE, INPUT_BYTE_RANGE)
+    print(f"Found {total_problems} problems with quizzes to evaluate.")
+
+    if BATCH_PHASE == "emit":
+        emit_batch_requests(iter_records(INPUT_FILE, columns=INPUT_COLUMNS, byte_range=INPUT_BYTE_RANGE), total_problems, completed_keys)
+        return
+    batch_ingest = None
+    if BATCH_PHASE == "ingest":
+        if LLM_CACHE is None:
+            print("FATAL: BATCH_PHASE = \"ingest\" loads the batch results into the response cache; set LLM_CACHE_PATH.")
+            return
+        print(f"Loading batch results from '{get_batch_dir()}'...")
+        batch_ingest = ingest_batch_results()
+
+    METRICS.open(os.path.join(OUTPUT_BASE_DIR, "request_metrics.jsonl") if METRICS_EVENT_LOG else None,
+                 os.path.join(OUTPUT_BASE_DIR, "metrics.prom") if METRICS_PROMETHEUS else None,
+                 append=bool(RESUME_RUN_DIR))
     try:
-        # Open both input and output files to stream data
-        with open(INPUT_FILE, 'r', encoding='utf-8') as f_in, \
-             open(OUTPUT_DETAILS_FILE, 'w', encoding='utf-8') as f_details:
-            
-            # Create a list of problems to get an accurate total for tqdm
-            problems_to_process = list(f_in)
-            print(f"Found {len(problems_to_process)} problems with quizzes to evaluate.")
-
-            for line in tqdm(problems_to_process, desc="Evaluating Problems"):
-                problem_data = json.loads(line)
-                
-                # Robustly get common fields
-                quiz_json = problem_data.get('quiz')
-                if not quiz_json: continue
-
-                problem_id = problem_data.get('uuid')
-                question = problem_data.get('problem')
-                ground_truth_raw_str = str(problem_data.get('answer'))
-                # IMPROVEMENT: Safer answer parsing
-                ground_truth_answers_list = [ground_truth_raw_str]
-
-                # Loop through the model portfolio
-                for reasoner_config in REASONER_MODELS:
-                    model_type = reasoner_config["type"]
-                    num_traces = reasoner_config["num_traces"]
-                    traces_to_evaluate = []
-                    
-                    if reasoner_config["source"] == "pre_generated":
-                        # MODIFIED: Read from 'valid_reasoning_traces'
-                        pre_gen_traces = problem_data.get('valid_reasoning_traces', [])[:num_traces]
-                        for trace in pre_gen_traces:
-                            traces_to_evaluate.append({"trace": trace, "model_id": f"pre_generated_{model_type}"})
-                    
-                    elif reasoner_config["source"] == "api_call":
-                        for i in range(num_traces):
-                            reasoner_prompt = REASONING_PROMPT.format(problem=question)
-                            new_trace = call_llm_api(model_type, reasoner_prompt, reasoner_config["model_id"], reasoner_config["temperature"])
-                            traces_to_evaluate.append({"trace": new_trace, "model_id": reasoner_config["model_id"]})
-                            time.sleep(1)
-
-                    # Evaluate each collected trace
-                    for i, trace_info in enumerate(traces_to_evaluate):
-                        reason_trace = trace_info["trace"]
-                        if not reason_trace: continue # Skip if trace generation failed
-
-                        extracted_answer = extract_boxed_answer(reason_trace)
-                        is_correct = normalize_and_compare_answers(extracted_answer, ground_truth_answers_list)
-
-                        grading_prompt = QUIZ_GRADING_PROMPT.format(
-                            quiz_json_text=json.dumps(quiz_json, indent=2),
-                            reasoner_trace_text=reason_trace
-                        )
-                        raw_grading_output = call_llm_api("grader", grading_prompt, GRADER_MODEL, 0.3)
-                        grading_result = parse_json_from_text(raw_grading_output)
-                        
-                        reward_score = 0.0
-                        if grading_result and "Score" in grading_result:
-                            score_match = re.search(r'(\d+\.?\d*)', str(grading_result.get("Score")))
-                            if score_match: reward_score = float(score_match.group(1))
-
-                        result_record = {
-                            "problem_id": problem_id, "generator_model": trace_info["model_id"],
-                            "generator_type": model_type, "trace_num": i + 1, "is_correct": is_correct,
-                            "ground_truth_answer": ground_truth_raw_str,
-                            "extracted_answer": extracted_answer, "reward_score": reward_score,
-                            "reason_trace": reason_trace, "grading_result": grading_result,
-                        }
+        # Stream the input (or just its shard) and write details as we go
+        problems = schedule_by_length(iter_records(INPUT_FILE, columns=INPUT_COLUMNS, byte_range=INPUT_BYTE_RANGE),
+                                      estimate_record_tokens, LENGTH_SCHEDULING, LENGTH_LOOKAHEAD)
+        with open(OUTPUT_DETAILS_FILE, 'a' if RESUME_RUN_DIR else 'w', encoding='utf-8') as f_details:
+
+            if EXECUTION_MODE == "async":
+                asyncio.run(run_evaluation_async(problems, total_problems, f_details, stats, completed_keys))
+            else:
+                for problem_data in tqdm(problems, total=total_problems, desc="Evaluating Problems"):
+                    if not problem_data.get('quiz'): continue
+
+                    for result_record in iter_problem_results(problem_data, completed_keys):
                         f_details.write(json.dumps(result_record) + '\n')
-                        all_detailed_results.append(result_record)
+                        stats.add(result_record)
 
     except KeyboardInterrupt:
+        run_status = "Run Interrupted"
         print("\n\nKEYBOARD INTERRUPT DETECTED! Stopping and proceeding to save overview...")
+    finally:
+        METRICS.close()
+        if batch_ingest is not None:
+            LLM_CACHE.unpin(OUTPUT_BASE_DIR)  # a resumed ingest run loads and pins them again
     
-    # --- Final Analysis section, now reads from the in-memory list ---
+    # --- Final Analysis section, built from the running statistics ---
     print("\n\n--- Generating Final Overview ---")
     
-    if not all_detailed_results:
+    if not stats.overall.traces:
         print("No results were processed. Exiting.")
         return
 
-    # (The rest of the analysis logic is perfect and requires no changes)
-    total_traces = len(all_detailed_results)
-    total_correct = sum(1 for r in all_detailed_results if r['is_correct'])
-    accuracy = (total_correct / total_traces * 100) if total_traces > 0 else 0
-    scores_when_correct = [r['reward_score'] for r in all_detailed_results if r['is_correct']]
-    scores_when_incorrect = [r['reward_score'] for r in all_detailed_results if not r['is_correct']]
-    avg_score_correct = sum(scores_when_correct) / len(scores_when_correct) if scores_when_correct else 0
-    avg_score_incorrect = sum(scores_when_incorrect) / len(scores_when_incorrect) if scores_when_incorrect else 0
-    
-    overview_data = {
-        "run_info": { "timestamp": RUN_TIMESTAMP, "input_file": INPUT_FILE, "reasoner_portfolio": REASONER_MODELS, "grader_model": GRADER_MODEL, "status": "Run Interrupted" if 'KeyboardInterrupt' in locals() else "Run Complete"},
-        "overall_performance": { "problems_attempted": len(set(r['problem_id'] for r in all_detailed_results)), "traces_generated_and_saved": total_traces, "traces_correctly_answered": total_correct, "trace_accuracy_percent": round(accuracy, 2) },
-        "correlation_analysis": { "average_reward_score_when_correct": round(avg_score_correct, 3), "average_reward_score_when_incorrect": round(avg_score_incorrect, 3), "comment": "This is the most important metric. A large positive gap proves the quiz score is a good proxy for correctness." }
-    }
+    run_info = { "timestamp": RUN_TIMESTAMP, "input_file": INPUT_FILE, "input_byte_range": INPUT_BYTE_RANGE, "reasoner_portfolio": REASONER_MODELS, "grader_model": GRADER_MODEL, "status": run_status, "batch_phase": BATCH_PHASE, "length_scheduling": LENGTH_SCHEDULING}
+    overview_data = stats.build_overview(run_info)
+    if LLM_CACHE:
+        overview_data["llm_cache"] = LLM_CACHE.stats()
+    if batch_ingest is not None:
+        overview_data["batch_ingest"] = batch_ingest
+    if PRE_GRADER_ENABLED:
+        overview_data["pre_grader"] = PRE_GRADER_STATS.summary()
+    overview_data["request_metrics"] = METRICS.summary()
+    overview_data["token_usage"] = {key: client.usage_stats() for key, client in API_CLIENTS.items() if client.requests}
+    if EARLY_STOP_GRACE_TOKENS is not None:
+        overview_data["early_stop"] = {key: client.stream_stats() for key, client in API_CLIENTS.items() if client.streamed_choices}
+    replica_pools = {key: client.pool_stats() for key, client in API_CLIENTS.items() if client.num_replicas > 1}
+    if replica_pools:
+        overview_data["replica_pools"] = replica_pools
+    if RATE_LIMITER_SETTINGS:
+        overview_data["rate_control"] = {key: API_CLIENTS[key].limiter_stats() for key in RATE_LIMITER_SETTINGS}
+    if HEDGE_POLICIES:
+        overview_data["hedging"] = {key: policy.stats() for key, policy in HEDGE_POLICIES.items()}
 
     with open(OUTPUT_OVERVIEW_FILE, 'w', encoding='utf-8') as f_overview:
         json.dump(overview_data, f_overview, indent=4)
         
+    overall = stats.overall
     print(f"\n✅ Evaluation Complete (or Gracefully Stopped)!")
     print(f"  - Full details saved to: {OUTPUT_DETAILS_FILE}")
     print(f"  - Overview saved to: {OUTPUT_OVERVIEW_FILE}")
     print("\n--- Correlation Summary ---")
-    print(f"Trace Accuracy: {accuracy:.2f}% ({total_correct}/{total_traces})")
-    print(f"Avg. Reward Score (When Correct):   {avg_score_correct:.3f}")
-    print(f"Avg. Reward Score (When Incorrect): {avg_score_incorrect:.3f}")
+    print(f"Trace Accuracy: {overall.accuracy:.2f}% ({overall.correct}/{overall.traces})")
+    print(f"Avg. Reward Score (When Correct):   {overall.avg_score_correct:.3f}")
+    print(f"Avg. Reward Score (When Incorrect): {overall.avg_score_incorrect:.3f}")
 
 if __name__ == "__main__":
     run_full_evaluation()
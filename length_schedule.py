@@ -0,0 +1,36 @@
+import heapq
+import itertools
+
+# --- Length-aware dispatch order ---
+# Both pipeline stages read records in file order, so a long problem near the end of a slice runs
+# alone after everything else has finished, and the local vLLM servers batch requests of very
+# different lengths together. schedule_by_length reorders a record stream within a bounded window:
+#   "longest_first": always dispatch the longest record among the next `lookahead` ones. The window
+#                    slides, so short records still flow while long ones are picked early.
+#   "grouped":       fill the window, then release all of it longest first, so records dispatched
+#                    together (and batched together by the server) have similar lengths.
+# At most `lookahead` records are held back, so memory stays bounded. Estimates only need to rank
+# records (see estimate_record_tokens in each stage); outputs stay keyed by uuid.
+
+SCHEDULING_MODES = ("longest_first", "grouped")
+
+
+def schedule_by_length(records, estimate, mode="longest_first", lookahead=256):
+    """Yields `records` reordered by descending `estimate(record)` within a `lookahead` window; mode None keeps file order."""
+    if mode is None or lookahead <= 1:
+        return iter(records)
+    if mode not in SCHEDULING_MODES:
+        raise ValueError(f"Unknown length scheduling mode {mode!r}; expected one of {SCHEDULING_MODES} or None.")
+    return _schedule(records, estimate, mode == "grouped", lookahead)
+
+
+def _schedule(records, estimate, grouped, lookahead):
+    order = itertools.count()  # ties keep file order; records themselves are never compared
+    window = []
+    for record in records:
+        heapq.heappush(window, (-estimate(record), next(order), record))
+        if len(window) >= lookahead:
+            for _ in range(len(window) if grouped else 1):
+                yield heapq.heappop(window)[2]
+    while window:
+        yield heapq.heappop(window)[2]
@@ -0,0 +1,1015 @@
+import asyncio
+import collections
+import hashlib
+import json
+import os
+import queue
+import random
+import re
+import sqlite3
+import threading
+import time
+from types import SimpleNamespace
+from urllib.request import urlopen
+from openai import OpenAI, AsyncOpenAI, BadRequestError, RateLimitError, APITimeoutError, APIConnectionError
+from rate_limit import AdaptiveLimiter
+
+# --- Shared LLM client used by generate_quizzes.py and generate_traces_and_grade.py ---
+
+
+def classify_error(error):
+    """Buckets an API exception into a coarse error class used for retries, rate control and metrics."""
+    if isinstance(error, RateLimitError):
+        return "rate_limited"
+    if isinstance(error, APITimeoutError):
+        return "timeout"
+    if isinstance(error, APIConnectionError):
+        return "connection_error"
+    status_code = getattr(error, "status_code", None)
+    if status_code == 429:
+        return "rate_limited"
+    if status_code is not None and status_code >= 500:
+        return "server_error"
+    if status_code is not None:
+        return "client_error"
+    return "other_error"
+
+
+RETRYABLE_ERRORS = ("rate_limited", "timeout", "connection_error", "server_error")
+
+
+def rejects_n(error):
+    """
+    True if a 400 is the endpoint refusing the `n` parameter (e.g. "n > 1 is not supported"), rather
+    than a problem with this particular request such as an over-long prompt.
+    """
+    if getattr(error, "param", None) == "n":
+        return True
+    message = str(getattr(error, "message", None) or error).lower()
+    return re.search(r"(?<![\w-])['\"`]?n['\"`]?(?![\w-])", message) is not None
+
+
+def estimate_prompt_tokens(text):
+    """Cheap token estimate (about 4 characters per token) for rate budgeting."""
+    return len(text) // 4 + 1
+
+
+def usage_counts(usage):
+    """
+    (prompt, cached prompt, completion) tokens of an API `usage` object. Cached prompt tokens are
+    read from prompt_tokens_details.cached_tokens (OpenAI, vLLM) or prompt_cache_hit_tokens (DeepSeek).
+    """
+    if usage is None:
+        return 0, 0, 0
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached = getattr(details, "cached_tokens", None) if details is not None else None
+    if cached is None:
+        cached = getattr(usage, "prompt_cache_hit_tokens", None)
+    return getattr(usage, "prompt_tokens", 0) or 0, cached or 0, getattr(usage, "completion_tokens", 0) or 0
+
+
+def make_cache_key(model_id, prompt, temperature, max_tokens, sample_index=0, early_stop=None):
+    """Content address of one completion request. Early-stopped (truncated) texts get their own keys."""
+    fields = [model_id, prompt, temperature, max_tokens, sample_index]
+    if early_stop is not None:
+        fields.append(["early_stop", early_stop])
+    payload = json.dumps(fields, ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+# --- Streaming early termination ---
+
+# Asks for a final usage chunk on streamed requests (OpenAI, vLLM, DashScope), so token accounting
+# does not depend on estimates.
+STREAM_OPTIONS = {"include_usage": True}
+
+class BoxedAnswerWatcher:
+    """
+    Follows one streamed completion and reports when it can be cut off: once a balanced
+    \\boxed{...} has closed and `grace_chunks` more content chunks (roughly tokens) have
+    arrived. A new \\boxed{ opened inside the grace window restarts the wait, so a corrected
+    final answer is still captured.
+    """
+
+    MARKER = "\\boxed{"
+
+    def __init__(self, grace_chunks):
+        self.grace_chunks = grace_chunks
+        self._pieces = []
+        # Only the not yet scanned end of the text (plus a possible partial marker) is kept for
+        # scanning, so each chunk costs time proportional to its own length.
+        self._tail = ""
+        self._pos = 0
+        self._depth = 0
+        self._chunks_since_close = None
+
+    def feed(self, piece):
+        """Adds a content chunk; returns True when the stream may be closed."""
+        self._pieces.append(piece)
+        self._tail += piece
+        if self._chunks_since_close is not None:
+            self._chunks_since_close += 1
+        self._scan()
+        self._tail = self._tail[self._pos:]
+        self._pos = 0
+        return (self.grace_chunks is not None and self._depth == 0 and self._chunks_since_close is not None
+                and self._chunks_since_close >= self.grace_chunks)
+
+    @property
+    def text(self):
+        return "".join(self._pieces)
+
+    def _scan(self):
+        text = self._tail
+        while self._pos < len(text):
+            if self._depth == 0:
+                start = text.find(self.MARKER, self._pos)
+                if start == -1:
+                    # Keep a possible partial marker at the end for the next chunk.
+                    self._pos = max(self._pos, len(text) - len(self.MARKER) + 1)
+                    return
+                self._pos = start + len(self.MARKER)
+                self._depth = 1
+                self._chunks_since_close = None
+                continue
+            char = text[self._pos]
+            if char == "\\":
+                if self._pos + 1 >= len(text):
+                    return  # wait for the escaped character
+                self._pos += 2  # \{ and \} do not change the nesting
+                continue
+            if char == "{":
+                self._depth += 1
+            elif char == "}":
+                self._depth -= 1
+                if self._depth == 0:
+                    self._chunks_since_close = 0
+            self._pos += 1
+
+
+class StreamCollector:
+    """
+    Assembles the `n` choices of a streamed completion, deciding when every choice is done.
+    `grace_chunks=None` never stops a choice early (plain streaming, see HedgePolicy).
+    """
+
+    def __init__(self, n, grace_chunks):
+        self.grace_chunks = grace_chunks
+        self.watchers = [BoxedAnswerWatcher(grace_chunks) for _ in range(n)]
+        self.done = set()
+        self.stopped_early = 0
+        self.usage = None
+        self.first_token_at = None
+        self.content_chunks = 0
+
+    def add(self, chunk):
+        """
+        Consumes one stream chunk; returns True once the stream can be closed, i.e. every choice is done
+        and at least one was cut early. Streams whose choices all finish are read to the end, so the
+        final usage chunk is not missed.
+        """
+        if getattr(chunk, "usage", None) is not None:
+            self.usage = chunk.usage
+        for choice in chunk.choices or []:
+            if choice.index in self.done or choice.index >= len(self.watchers):
+                continue
+            piece = getattr(choice.delta, "content", None) if choice.delta else None
+            # Reasoning models (deepseek-r1) stream their thinking as reasoning_content before any content.
+            reasoning_piece = getattr(choice.delta, "reasoning_content", None) if choice.delta else None
+            if piece or reasoning_piece:
+                self.content_chunks += 1
+                if self.first_token_at is None:
+                    self.first_token_at = time.monotonic()
+            if piece and self.watchers[choice.index].feed(piece):
+                self.done.add(choice.index)
+                self.stopped_early += 1
+            elif choice.finish_reason:
+                self.done.add(choice.index)
+        return self.stopped_early > 0 and len(self.done) == len(self.watchers)
+
+    def texts(self):
+        return [watcher.text for watcher in self.watchers]
+
+
+class ResponseCache:
+    """
+    Persistent on-disk cache of completion texts, stored in a single SQLite file so it can be
+    shared by every stage (and by several processes at once). When the stored text exceeds
+    `max_bytes`, the least recently used entries are evicted. Entries put with a `pin` tag (e.g. batch
+    results that a run has yet to read) are never evicted until `unpin(pin)`.
+
+    Hits only note their access time in memory; the times are written in one batch with the next put,
+    before an eviction, on close, or once TOUCH_FLUSH_EVERY are pending, so a lookup never writes.
+    """
+
+    EVICTION_CHECK_EVERY = 256  # puts between size checks
+    TOUCH_FLUSH_EVERY = 4096  # pending access times before a hit writes them anyway
+
+    def __init__(self, path, max_bytes=None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._puts_since_check = 0
+        self._touched = {}  # key -> last access time not yet written
+        self._lock = threading.Lock()
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=30.0, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " key TEXT PRIMARY KEY, response TEXT NOT NULL,"
+            " size INTEGER NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_last_access ON responses(last_access)")
+        if "pin" not in [row[1] for row in self._conn.execute("PRAGMA table_info(responses)")]:
+            try:
+                self._conn.execute("ALTER TABLE responses ADD COLUMN pin TEXT")  # caches from before pinning
+            except sqlite3.OperationalError:
+                pass  # another process added it first
+        self._conn.commit()
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._touched[key] = time.time()
+            if len(self._touched) >= self.TOUCH_FLUSH_EVERY:
+                self._flush_touched_locked()
+                self._conn.commit()
+            return row[0]
+
+    def _flush_touched_locked(self):
+        if self._touched:
+            self._conn.executemany("UPDATE responses SET last_access = ? WHERE key = ?",
+                                   [(accessed, key) for key, accessed in self._touched.items()])
+            self._touched.clear()
+
+    def put(self, key, response, pin=None):
+        with self._lock:
+            self._touched.pop(key, None)
+            self._flush_touched_locked()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, response, size, last_access, pin) VALUES (?, ?, ?, ?, ?)",
+                (key, response, len(response.encode('utf-8')), time.time(), pin),
+            )
+            self._conn.commit()
+            self._puts_since_check += 1
+            if self.max_bytes and self._puts_since_check >= self.EVICTION_CHECK_EVERY:
+                self._puts_since_check = 0
+                self._evict_locked()
+
+    def _evict_locked(self):
+        self._flush_touched_locked()  # evict by up-to-date access times
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # Evict down to 90% of the budget so we don't re-trigger on the very next put.
+        target = int(self.max_bytes * 0.9)
+        doomed = []
+        for key, size in self._conn.execute("SELECT key, size FROM responses WHERE pin IS NULL ORDER BY last_access"):
+            if total <= target:
+                break
+            doomed.append((key,))
+            total -= size
+        self._conn.executemany("DELETE FROM responses WHERE key = ?", doomed)
+        self._conn.commit()
+        self.evictions += len(doomed)
+
+    def unpin(self, pin):
+        """Makes the entries put with `pin` evictable again."""
+        with self._lock:
+            self._conn.execute("UPDATE responses SET pin = NULL WHERE pin = ?", (pin,))
+            self._conn.commit()
+
+    def stats(self):
+        with self._lock:
+            entries, total = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+            pinned = self._conn.execute("SELECT COUNT(*) FROM responses WHERE pin IS NOT NULL").fetchone()[0]
+        lookups = self.hits + self.misses
+        return {
+            "path": self.path,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate_percent": round(self.hits / lookups * 100, 2) if lookups else 0.0,
+            "evictions": self.evictions,
+            "entries": entries,
+            "pinned_entries": pinned,
+            "stored_mb": round(total / 1024 / 1024, 2),
+        }
+
+    def close(self):
+        with self._lock:
+            self._flush_touched_locked()
+            self._conn.commit()
+            self._conn.close()
+
+
+def open_response_cache(path, max_mb):
+    """Returns a ResponseCache, or None if caching is disabled (`path` is None)."""
+    if not path:
+        return None
+    return ResponseCache(path, max_bytes=int(max_mb * 1024 * 1024) if max_mb else None)
+
+
+# --- Hedged requests ---
+
+class RequestCancelled(Exception):
+    """Raised inside the losing attempt of a hedged request when the other attempt answered first."""
+
+
+def hedge_key(kwargs, early_stop):
+    """Requests whose latencies are comparable: same model, same `n`, early-stopped or not."""
+    return kwargs["model"], kwargs.get("n", 1), early_stop is not None
+
+
+class HedgePolicy:
+    """
+    Decides when a slow request gets a duplicate ("hedged request"): once it has been running longer
+    than the `percentile` of the last `window` successful latencies for the same kind of request. The
+    first answer is kept and the other request is cancelled. At most `budget` duplicates are sent per
+    request (0.05 = at most 5% extra requests), and nothing is hedged before `min_samples` latencies
+    have been seen or earlier than `min_delay` seconds. One policy can be shared by several clients.
+    """
+
+    def __init__(self, percentile=0.95, budget=0.05, min_samples=20, window=512, min_delay=1.0):
+        self.percentile = percentile
+        self.budget = budget
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self.latencies = collections.defaultdict(lambda: collections.deque(maxlen=window))
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.over_budget = 0
+        self._lock = threading.Lock()
+
+    def observe(self, key, latency):
+        with self._lock:
+            self.latencies[key].append(latency)
+
+    def start(self, key):
+        """Counts a new request; returns how long to wait before hedging it, or None if it cannot be hedged yet."""
+        with self._lock:
+            self.requests += 1
+            samples = self.latencies[key]
+            if len(samples) < self.min_samples:
+                return None
+            return self._delay_locked(samples)
+
+    def try_hedge(self):
+        """Takes one duplicate from the budget; False if it is used up."""
+        with self._lock:
+            if self.hedges + 1 > self.budget * self.requests:
+                self.over_budget += 1
+                return False
+            self.hedges += 1
+            return True
+
+    def finish(self, hedge_won):
+        if hedge_won:
+            with self._lock:
+                self.hedge_wins += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "hedged_requests": self.hedges,
+                "hedge_wins": self.hedge_wins,
+                "hedges_skipped_over_budget": self.over_budget,
+                "extra_request_percent": round(self.hedges / self.requests * 100, 2) if self.requests else 0.0,
+                "hedge_delay_seconds": {f"{model} n={n}{' early_stop' if early else ''}": round(self._delay_locked(samples), 3)
+                                        for (model, n, early), samples in self.latencies.items() if len(samples) >= self.min_samples},
+            }
+
+    def _delay_locked(self, samples):
+        ordered = sorted(samples)
+        return max(self.min_delay, ordered[min(len(ordered) - 1, int(self.percentile * len(ordered)))])
+
+
+class LLMClient:
+    """
+    One OpenAI-compatible endpoint, with sync (`complete`) and async (`acomplete`) calls that
+    share an optional ResponseCache. Errors from the API are raised to the caller unchanged.
+
+    With a `limiter` (rate_limit.AdaptiveLimiter) attached, every request waits for a slot and
+    reports its outcome back, and retries are done here instead of inside the OpenAI SDK so
+    that each throttled attempt is seen by the limiter. Throttled requests get up to
+    `rate_limit_retries` attempts, since the limiter backs concurrency off between them.
+
+    With a `metrics` recorder (metrics.MetricsRecorder) attached, every attempt is reported under
+    `name` with its latency, time to first token, token usage and outcome; requests are then always
+    streamed, since the first token is only visible on a stream.
+
+    Passing `early_stop=<grace chunks>` streams the completion and closes the connection once a
+    \\boxed{...} answer has closed (see BoxedAnswerWatcher); vLLM aborts the request when the
+    client disconnects, so the rest of the generation never occupies a GPU slot.
+
+    With a `hedging` policy (HedgePolicy) attached, a request still running past the policy's latency
+    percentile is duplicated and the slower of the two is cancelled. Synchronous hedged requests run on
+    helper threads and are streamed, so the loser can be closed at its next chunk.
+    """
+
+    num_replicas = 1  # see ReplicaPool
+
+    def __init__(self, api_key, base_url, max_retries=2, timeout=None, cache=None, limiter=None, rate_limit_retries=8,
+                 name=None, metrics=None, hedging=None, failover_errors=()):
+        self.name = name or base_url
+        self.metrics = metrics
+        self.hedging = hedging
+        self.api_key = api_key
+        self.base_url = base_url
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.cache = cache
+        self.limiter = limiter
+        self.rate_limit_retries = rate_limit_retries
+        # Error classes raised at once so a ReplicaPool can retry them on another replica.
+        self.failover_errors = failover_errors
+        # When we retry ourselves, the SDK must not retry as well.
+        self._sdk_retries = 0 if limiter or failover_errors else max_retries
+        self.client = OpenAI(api_key=api_key, base_url=base_url, max_retries=self._sdk_retries, timeout=timeout)
+        self._async_client = None
+        # Flipped to False the first time the endpoint rejects the `n` parameter; other 400s are raised.
+        self.supports_n = True
+        self.streamed_choices = 0
+        self.early_stopped_choices = 0
+        self.estimated_usage_streams = 0  # cut streams whose token usage had to be estimated
+        # Token usage reported by the API (cache hits from `cache` are not requests and not counted).
+        self.requests = 0
+        self.prompt_tokens = 0
+        self.cached_prompt_tokens = 0
+        self.completion_tokens = 0
+        self._stats_lock = threading.Lock()
+
+    @property
+    def async_client(self):
+        # Created on first use so purely synchronous scripts never build an async HTTP pool.
+        if self._async_client is None:
+            self._async_client = AsyncOpenAI(api_key=self.api_key, base_url=self.base_url,
+                                             max_retries=self._sdk_retries, timeout=self.timeout)
+        return self._async_client
+
+    def _request_kwargs(self, prompt, model_id, temperature, max_tokens, timeout, n=1):
+        kwargs = {
+            "model": model_id,
+            "messages": [{"role": "user", "content": prompt}],
+            "temperature": temperature,
+            "max_tokens": max_tokens,
+        }
+        if n > 1:
+            kwargs["n"] = n
+        if timeout is not None:
+            kwargs["timeout"] = timeout
+        return kwargs
+
+    # --- Request path: limiter, retries ---
+
+    def _retry_delay(self, error_class, attempt):
+        """Returns the backoff before the next attempt, or None if the error should be raised."""
+        if self.limiter is None and not self.failover_errors:
+            return None  # the SDK already retried
+        if error_class not in RETRYABLE_ERRORS or error_class in self.failover_errors:
+            return None
+        allowed = self.rate_limit_retries if error_class == "rate_limited" else self.max_retries
+        if attempt > allowed:
+            return None
+        return min(60.0, 2.0 ** attempt) * random.uniform(0.5, 1.0)
+
+    def _observe(self, kwargs, outcome, start, attempt, estimated_tokens=0, usage=None, first_token_at=None, streamed=False):
+        """Reports one finished attempt to the limiter, the usage totals and the metrics recorder."""
+        latency = time.monotonic() - start
+        counts = usage_counts(usage)
+        if outcome == "ok":
+            with self._stats_lock:
+                self.requests += 1
+                self.prompt_tokens += counts[0]
+                self.cached_prompt_tokens += counts[1]
+                self.completion_tokens += counts[2]
+        if self.limiter:
+            self.limiter.release(outcome, latency, getattr(usage, "total_tokens", 0) or 0, estimated_tokens)
+        if self.metrics:
+            ttft = first_token_at - start if first_token_at is not None else None
+            self.metrics.record(self.name, kwargs["model"], outcome, latency, attempt=attempt, ttft=ttft,
+                                usage_counts=counts, n=kwargs.get("n", 1), streamed=streamed)
+
+    @staticmethod
+    def _completion_result(completion):
+        """(choice texts in index order, usage, first token time) of a non-streamed completion."""
+        texts = [choice.message.content for choice in sorted(completion.choices, key=lambda c: c.index)]
+        return texts, getattr(completion, "usage", None), None
+
+    def _record_stream(self, collector, kwargs):
+        if collector.grace_chunks is not None:
+            with self._stats_lock:
+                self.streamed_choices += len(collector.watchers)
+                self.early_stopped_choices += collector.stopped_early
+        usage = collector.usage
+        if usage is None and collector.stopped_early:
+            # Only a stream cut by early stop misses the final usage chunk (see STREAM_OPTIONS); estimate
+            # its usage (vLLM sends ~one token per chunk). Complete streams report the server's counts.
+            prompt_tokens = estimate_prompt_tokens(kwargs["messages"][0]["content"])
+            usage = SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=collector.content_chunks,
+                                    total_tokens=prompt_tokens + collector.content_chunks, prompt_tokens_details=None)
+            with self._stats_lock:
+                self.estimated_usage_streams += 1
+        return collector.texts(), usage, collector.first_token_at
+
+    def _streams(self, early_stop, cancel=None):
+        """
+        Whether a request is streamed: for early stop, for hedging (so the loser can be abandoned) and
+        whenever metrics are recorded, since time to first token is only visible on a stream.
+        """
+        return early_stop is not None or cancel is not None or self.metrics is not None
+
+    def _send(self, early_stop, kwargs, cancel=None):
+        """Sends one request. With a `cancel` event (hedged requests) the reply is streamed so it can be abandoned."""
+        if not self._streams(early_stop, cancel):
+            return self._completion_result(self.client.chat.completions.create(**kwargs))
+        collector = StreamCollector(kwargs.get("n", 1), early_stop)
+        stream = self.client.chat.completions.create(stream=True, stream_options=STREAM_OPTIONS, **kwargs)
+        try:
+            for chunk in stream:
+                if cancel is not None and cancel.is_set():
+                    raise RequestCancelled()
+                if collector.add(chunk):
+                    break
+        finally:
+            stream.close()
+        return self._record_stream(collector, kwargs)
+
+    async def _asend(self, early_stop, kwargs):
+        if not self._streams(early_stop):
+            return self._completion_result(await self.async_client.chat.completions.create(**kwargs))
+        collector = StreamCollector(kwargs.get("n", 1), early_stop)
+        stream = await self.async_client.chat.completions.create(stream=True, stream_options=STREAM_OPTIONS, **kwargs)
+        try:
+            async for chunk in stream:
+                if collector.add(chunk):
+                    break
+        finally:
+            await stream.close()
+        return self._record_stream(collector, kwargs)
+
+    def _attempt(self, early_stop, kwargs, estimated_tokens, attempt, cancel=None):
+        """One request: waits for the limiter, sends, and reports the outcome. Errors are re-raised."""
+        streamed = self._streams(early_stop, cancel)
+        if self.limiter:
+            self.limiter.acquire(estimated_tokens)
+        start = time.monotonic()
+        try:
+            if cancel is not None and cancel.is_set():
+                raise RequestCancelled()  # the other attempt answered while this one waited for the limiter
+            texts, usage, first_token_at = self._send(early_stop, kwargs, cancel)
+        except RequestCancelled:
+            self._observe(kwargs, "cancelled", start, attempt, streamed=streamed)
+            raise
+        except Exception as e:
+            self._observe(kwargs, classify_error(e), start, attempt, streamed=streamed)
+            raise
+        self._observe(kwargs, "ok", start, attempt, estimated_tokens, usage, first_token_at, streamed=streamed)
+        if self.hedging:
+            self.hedging.observe(hedge_key(kwargs, early_stop), time.monotonic() - start)
+        return texts
+
+    async def _aattempt(self, early_stop, kwargs, estimated_tokens, attempt):
+        streamed = self._streams(early_stop)
+        if self.limiter:
+            await self.limiter.acquire_async(estimated_tokens)
+        start = time.monotonic()
+        try:
+            texts, usage, first_token_at = await self._asend(early_stop, kwargs)
+        except asyncio.CancelledError:
+            self._observe(kwargs, "cancelled", start, attempt, streamed=streamed)
+            raise
+        except Exception as e:
+            self._observe(kwargs, classify_error(e), start, attempt, streamed=streamed)
+            raise
+        self._observe(kwargs, "ok", start, attempt, estimated_tokens, usage, first_token_at, streamed=streamed)
+        if self.hedging:
+            self.hedging.observe(hedge_key(kwargs, early_stop), time.monotonic() - start)
+        return texts
+
+    def _hedged_attempt(self, early_stop, kwargs, estimated_tokens, attempt):
+        """`_attempt`, duplicated once it outlives the hedging delay; returns the first answer."""
+        delay = self.hedging.start(hedge_key(kwargs, early_stop))
+        if delay is None:
+            return self._attempt(early_stop, kwargs, estimated_tokens, attempt)
+        results = queue.Queue()
+        cancel = threading.Event()
+
+        def run(is_hedge):
+            try:
+                results.put((is_hedge, self._attempt(early_stop, kwargs, estimated_tokens, attempt, cancel), None))
+            except Exception as e:
+                results.put((is_hedge, None, e))
+
+        threading.Thread(target=run, args=(False,), daemon=True).start()
+        running = 1
+        try:
+            outcome = results.get(timeout=delay)
+        except queue.Empty:
+            outcome = None
+            if self.hedging.try_hedge():
+                threading.Thread(target=run, args=(True,), daemon=True).start()
+                running += 1
+        while True:
+            is_hedge, texts, error = outcome or results.get()
+            outcome = None
+            running -= 1
+            if error is None:
+                cancel.set()
+                self.hedging.finish(is_hedge)
+                return texts
+            if not running:
+                raise error
+
+    async def _ahedged_attempt(self, early_stop, kwargs, estimated_tokens, attempt):
+        delay = self.hedging.start(hedge_key(kwargs, early_stop))
+        if delay is None:
+            return await self._aattempt(early_stop, kwargs, estimated_tokens, attempt)
+        primary = asyncio.ensure_future(self._aattempt(early_stop, kwargs, estimated_tokens, attempt))
+        is_hedge = {primary: False}
+        pending = {primary}
+        try:
+            done, _ = await asyncio.wait(pending, timeout=delay)
+            if not done and self.hedging.try_hedge():
+                hedge = asyncio.ensure_future(self._aattempt(early_stop, kwargs, estimated_tokens, attempt))
+                is_hedge[hedge] = True
+                pending.add(hedge)
+            while True:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                errors = [task.exception() for task in done if task.exception() is not None]
+                winners = [task for task in done if task.exception() is None]
+                if winners:
+                    self.hedging.finish(is_hedge[winners[0]])
+                    return winners[0].result()
+                if not pending:
+                    raise errors[0]
+        finally:
+            for task in pending:
+                task.cancel()  # the loser's connection is closed and it is recorded as "cancelled"
+
+    def _create(self, early_stop=None, first_attempt=1, **kwargs):
+        """
+        Sends one request (streamed as decided by `_streams`); returns the choice texts in index order.
+        Attempts are numbered from `first_attempt` (a ReplicaPool's failover retries continue the count).
+        """
+        estimated_tokens = estimate_prompt_tokens(kwargs["messages"][0]["content"])
+        tries = 0
+        while True:
+            tries += 1
+            attempt = first_attempt + tries - 1
+            try:
+                if self.hedging:
+                    return self._hedged_attempt(early_stop, kwargs, estimated_tokens, attempt)
+                return self._attempt(early_stop, kwargs, estimated_tokens, attempt)
+            except Exception as e:
+                delay = self._retry_delay(classify_error(e), tries)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+
+    async def _acreate(self, early_stop=None, first_attempt=1, **kwargs):
+        estimated_tokens = estimate_prompt_tokens(kwargs["messages"][0]["content"])
+        tries = 0
+        while True:
+            tries += 1
+            attempt = first_attempt + tries - 1
+            try:
+                if self.hedging:
+                    return await self._ahedged_attempt(early_stop, kwargs, estimated_tokens, attempt)
+                return await self._aattempt(early_stop, kwargs, estimated_tokens, attempt)
+            except Exception as e:
+                delay = self._retry_delay(classify_error(e), tries)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+
+    # --- Cache helpers ---
+
+    def _cached_samples(self, prompt, model_id, temperature, max_tokens, sample_indices, early_stop=None):
+        """Splits `sample_indices` into cache hits ({index: text}) and the indices still to fetch."""
+        found, missing = {}, []
+        for sample_index in sample_indices:
+            cached = None
+            if self.cache is not None:
+                cached = self.cache.get(make_cache_key(model_id, prompt, temperature, max_tokens, sample_index, early_stop))
+            if cached is not None:
+                found[sample_index] = cached
+            else:
+                missing.append(sample_index)
+        return found, missing
+
+    def _store_samples(self, prompt, model_id, temperature, max_tokens, sample_indices, texts, found, early_stop=None):
+        """Records `texts` against `sample_indices`; returns the indices left unfilled."""
+        for sample_index, content in zip(sample_indices, texts):
+            found[sample_index] = content
+            if self.cache is not None and content:
+                self.cache.put(make_cache_key(model_id, prompt, temperature, max_tokens, sample_index, early_stop), content)
+        return sample_indices[len(texts):]
+
+    def _reject_n(self, n, error):
+        print(f"    Endpoint {self.base_url} rejected n={n}; falling back to one request per sample. ({error})")
+        self.supports_n = False
+
+    def stream_stats(self):
+        return {"streamed_choices": self.streamed_choices, "early_stopped_choices": self.early_stopped_choices,
+                "estimated_usage_streams": self.estimated_usage_streams}
+
+    def usage_stats(self):
+        with self._stats_lock:
+            return {
+                "requests": self.requests,
+                "prompt_tokens": self.prompt_tokens,
+                "cached_prompt_tokens": self.cached_prompt_tokens,
+                "prompt_cache_hit_percent": round(self.cached_prompt_tokens / self.prompt_tokens * 100, 2) if self.prompt_tokens else 0.0,
+                "completion_tokens": self.completion_tokens,
+            }
+
+    def limiter_stats(self):
+        return self.limiter.stats() if self.limiter else None
+
+    def reset_limiter(self, limiter_settings):
+        """Swaps in a fresh AdaptiveLimiter(**limiter_settings) (None: no limiter) before a run, e.g. to split limits between shards."""
+        self.limiter = AdaptiveLimiter(**limiter_settings) if limiter_settings else None
+        sdk_retries = 0 if self.limiter or self.failover_errors else self.max_retries
+        if sdk_retries != self._sdk_retries:
+            self._sdk_retries = sdk_retries
+            self.client = self.client.with_options(max_retries=sdk_retries)
+            self._async_client = None
+
+    # --- Public API ---
+
+    def complete(self, prompt, model_id, temperature, max_tokens, sample_index=0, timeout=None, early_stop=None, first_attempt=1):
+        """
+        Returns the completion text. `sample_index` keeps repeated samples of one prompt apart in the
+        cache; `early_stop` (grace chunks) cuts the generation off shortly after a closed \\boxed{}.
+        `first_attempt` numbers the first request for the metrics (ReplicaPool passes its failover count).
+        """
+        return self.complete_samples(prompt, model_id, temperature, max_tokens, [sample_index], timeout, early_stop, first_attempt)[0]
+
+    async def acomplete(self, prompt, model_id, temperature, max_tokens, sample_index=0, timeout=None, early_stop=None, first_attempt=1):
+        """Async version of `complete`."""
+        return (await self.acomplete_samples(prompt, model_id, temperature, max_tokens, [sample_index], timeout, early_stop, first_attempt))[0]
+
+    def complete_samples(self, prompt, model_id, temperature, max_tokens, sample_indices, timeout=None, early_stop=None, first_attempt=1):
+        """
+        Returns one completion per entry of `sample_indices`. Uncached samples are fetched with a
+        single `n=` request so the prompt is prefilled once; if the endpoint rejects `n>1` (or
+        returns fewer choices than asked), the rest are fetched with one request per sample.
+        """
+        found, missing = self._cached_samples(prompt, model_id, temperature, max_tokens, sample_indices, early_stop)
+        if len(missing) > 1 and self.supports_n:
+            try:
+                texts = self._create(early_stop, first_attempt, **self._request_kwargs(prompt, model_id, temperature, max_tokens, timeout, n=len(missing)))
+                missing = self._store_samples(prompt, model_id, temperature, max_tokens, missing, texts, found, early_stop)
+            except BadRequestError as e:
+                if not rejects_n(e):
+                    raise
+                self._reject_n(len(missing), e)
+        for sample_index in missing:
+            texts = self._create(early_stop, first_attempt, **self._request_kwargs(prompt, model_id, temperature, max_tokens, timeout))
+            self._store_samples(prompt, model_id, temperature, max_tokens, [sample_index], texts, found, early_stop)
+        return [found[sample_index] for sample_index in sample_indices]
+
+    async def acomplete_samples(self, prompt, model_id, temperature, max_tokens, sample_indices, timeout=None, early_stop=None, first_attempt=1):
+        """Async version of `complete_samples`."""
+        found, missing = self._cached_samples(prompt, model_id, temperature, max_tokens, sample_indices, early_stop)
+        if len(missing) > 1 and self.supports_n:
+            try:
+                texts = await self._acreate(early_stop, first_attempt, **self._request_kwargs(prompt, model_id, temperature, max_tokens, timeout, n=len(missing)))
+                missing = self._store_samples(prompt, model_id, temperature, max_tokens, missing, texts, found, early_stop)
+            except BadRequestError as e:
+                if not rejects_n(e):
+                    raise
+                self._reject_n(len(missing), e)
+        for sample_index in missing:
+            texts = await self._acreate(early_stop, first_attempt, **self._request_kwargs(prompt, model_id, temperature, max_tokens, timeout))
+            self._store_samples(prompt, model_id, temperature, max_tokens, [sample_index], texts, found, early_stop)
+        return [found[sample_index] for sample_index in sample_indices]
+
+
+# --- Replica pools ---
+
+REPLICA_FAILOVER_ERRORS = ("connection_error", "timeout", "server_error")
+
+
+class Replica:
+    """One endpoint of a ReplicaPool with its routing state."""
+
+    def __init__(self, client):
+        self.client = client
+        self.health_url = client.base_url.rstrip('/').rsplit('/v1', 1)[0] + "/health"
+        self.outstanding = 0
+        self.routed = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.ejections = 0
+        self.ejected_until = 0.0
+        self.healthy = True  # last active health check
+
+
+class ReplicaPool:
+    """
+    Several LLMClients serving the same model (e.g. one vLLM server per GPU group) behind the LLMClient
+    interface. Each call goes to the healthy replica with the fewest outstanding requests (ties are
+    broken round-robin); each replica keeps its own long-lived OpenAI client and rate limiter, so HTTP
+    connections are reused and one failing replica does not back off the others. A replica is ejected
+    for `eject_seconds` after `eject_after` consecutive connection errors, timeouts or 5xx responses.
+    The replicas do not retry those errors themselves, only rate limiting (see open_llm_client): the pool retries a failed
+    call on each other replica in turn, then starts another round after a backoff, for up to
+    `max_retries` retries (at least one per other replica). With
+    `health_check_interval`, a background thread polls every replica's /health (vLLM's health endpoint)
+    and takes replicas that do not answer out of rotation until they do.
+    """
+
+    def __init__(self, clients, name=None, eject_after=3, eject_seconds=30.0, health_check_interval=10.0, max_retries=2):
+        self.replicas = [Replica(client) for client in clients]
+        self.name = name or clients[0].name
+        self.max_retries = max(max_retries, len(clients) - 1)
+        self.eject_after = eject_after
+        self.eject_seconds = eject_seconds
+        self._lock = threading.Lock()
+        self._next = 0
+        if health_check_interval:
+            threading.Thread(target=self._health_check_loop, args=(health_check_interval,), name=f"health-{self.name}", daemon=True).start()
+
+    @property
+    def num_replicas(self):
+        return len(self.replicas)
+
+    # --- Routing ---
+
+    def _acquire(self, tried):
+        with self._lock:
+            now = time.monotonic()
+            untried = [r for r in self.replicas if r not in tried]
+            candidates = [r for r in untried if r.healthy and r.ejected_until <= now] or untried  # all down: try anyway
+            if not candidates:
+                return None
+            fewest = min(r.outstanding for r in candidates)
+            least_loaded = [r for r in candidates if r.outstanding == fewest]
+            replica = least_loaded[self._next % len(least_loaded)]
+            self._next += 1
+            replica.outstanding += 1
+            replica.routed += 1
+            return replica
+
+    def _release(self, replica, outcome):
+        with self._lock:
+            replica.outstanding -= 1
+            if outcome == "ok":
+                replica.consecutive_failures = 0
+            elif outcome in REPLICA_FAILOVER_ERRORS:
+                replica.failures += 1
+                replica.consecutive_failures += 1
+                if replica.consecutive_failures >= self.eject_after and replica.ejected_until <= time.monotonic():
+                    replica.ejected_until = time.monotonic() + self.eject_seconds
+                    replica.ejections += 1
+                    print(f"    Replica {replica.client.base_url} of '{self.name}' ejected for {self.eject_seconds:.0f}s after {replica.consecutive_failures} consecutive failures.")
+
+    def _retry_delay(self, error_class, failures):
+        """Backoff before retrying a failed call (0 while an untried replica is left), or None to raise."""
+        if error_class not in REPLICA_FAILOVER_ERRORS or failures > self.max_retries:
+            return None
+        if failures % len(self.replicas):
+            return 0.0
+        return min(60.0, 2.0 ** (failures // len(self.replicas))) * random.uniform(0.5, 1.0)
+
+    def _call(self, method, *args, **kwargs):
+        tried, failures = [], 0
+        while True:
+            if len(tried) == len(self.replicas):
+                tried = []  # every replica failed once: another round
+            replica = self._acquire(tried)
+            tried.append(replica)
+            try:
+                result = getattr(replica.client, method)(*args, first_attempt=failures + 1, **kwargs)
+            except Exception as e:
+                error_class = classify_error(e)
+                self._release(replica, error_class)
+                failures += 1
+                delay = self._retry_delay(error_class, failures)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                continue
+            self._release(replica, "ok")
+            return result
+
+    async def _acall(self, method, *args, **kwargs):
+        tried, failures = [], 0
+        while True:
+            if len(tried) == len(self.replicas):
+                tried = []
+            replica = self._acquire(tried)
+            tried.append(replica)
+            try:
+                result = await getattr(replica.client, method)(*args, first_attempt=failures + 1, **kwargs)
+            except asyncio.CancelledError:
+                self._release(replica, "cancelled")
+                raise
+            except Exception as e:
+                error_class = classify_error(e)
+                self._release(replica, error_class)
+                failures += 1
+                delay = self._retry_delay(error_class, failures)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                continue
+            self._release(replica, "ok")
+            return result
+
+    def _health_check_loop(self, interval):
+        while True:
+            time.sleep(interval)
+            for replica in self.replicas:
+                try:
+                    with urlopen(replica.health_url, timeout=min(5.0, interval)) as response:
+                        healthy = response.status == 200
+                except (OSError, ValueError):
+                    healthy = False
+                if healthy != replica.healthy:
+                    print(f"    Replica {replica.client.base_url} of '{self.name}' is {'back up' if healthy else 'failing health checks'}.")
+                with self._lock:
+                    replica.healthy = healthy
+
+    # --- Same interface as LLMClient ---
+
+    def complete(self, *args, **kwargs):
+        return self._call("complete", *args, **kwargs)
+
+    async def acomplete(self, *args, **kwargs):
+        return await self._acall("acomplete", *args, **kwargs)
+
+    def complete_samples(self, *args, **kwargs):
+        return self._call("complete_samples", *args, **kwargs)
+
+    async def acomplete_samples(self, *args, **kwargs):
+        return await self._acall("acomplete_samples", *args, **kwargs)
+
+    @property
+    def requests(self):
+        return sum(r.client.requests for r in self.replicas)
+
+    @property
+    def streamed_choices(self):
+        return sum(r.client.streamed_choices for r in self.replicas)
+
+    def stream_stats(self):
+        return {key: sum(r.client.stream_stats()[key] for r in self.replicas)
+                for key in ("streamed_choices", "early_stopped_choices", "estimated_usage_streams")}
+
+    def usage_stats(self):
+        totals = {key: sum(r.client.usage_stats()[key] for r in self.replicas)
+                  for key in ("requests", "prompt_tokens", "cached_prompt_tokens", "completion_tokens")}
+        totals["prompt_cache_hit_percent"] = round(totals["cached_prompt_tokens"] / totals["prompt_tokens"] * 100, 2) if totals["prompt_tokens"] else 0.0
+        return totals
+
+    def reset_limiter(self, limiter_settings):
+        for replica in self.replicas:
+            replica.client.reset_limiter(limiter_settings)
+
+    def limiter_stats(self):
+        stats = [r.client.limiter_stats() for r in self.replicas]
+        return None if stats[0] is None else [{"url": r.client.base_url, **s} for r, s in zip(self.replicas, stats)]
+
+    def pool_stats(self):
+        with self._lock:
+            now = time.monotonic()
+            return [{
+                "url": r.client.base_url, "routed_calls": r.routed, "failures": r.failures, "ejections": r.ejections,
+                "healthy": r.healthy and r.ejected_until <= now,
+            } for r in self.replicas]
+
+
+def open_llm_client(api_url, api_key, name, limiter_settings=None, eject_after=3, eject_seconds=30.0, health_check_interval=10.0,
+                    max_retries=2, **client_kwargs):
+    """
+    Returns an LLMClient for a single URL, or a ReplicaPool of LLMClients (sharing `client_kwargs`, e.g.
+    the response cache and metrics recorder) when `api_url` is a list of replica URLs. With
+    `limiter_settings` (AdaptiveLimiter arguments), every client gets its own limiter, so concurrency
+    limits and backoff apply per replica. Pool members retry rate limiting themselves (up to
+    `max_retries`), but not connection errors, timeouts or 5xx; the pool retries those on another replica. Replicas are reported to the metrics
+    recorder as "<name>#<index>".
+    """
+    def make_client(url, client_name, failover_errors=()):
+        limiter = AdaptiveLimiter(**limiter_settings) if limiter_settings else None
+        return LLMClient(api_key=api_key, base_url=url, name=client_name, max_retries=max_retries, limiter=limiter,
+                         failover_errors=failover_errors, **client_kwargs)
+
+    urls = [api_url] if isinstance(api_url, str) else list(api_url)
+    if len(urls) == 1:
+        return make_client(urls[0], name)
+    clients = [make_client(url, f"{name}#{i}", REPLICA_FAILOVER_ERRORS) for i, url in enumerate(urls)]
+    return ReplicaPool(clients, name, eject_after, eject_seconds, health_check_interval, max_retries)
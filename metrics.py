@@ -0,0 +1,232 @@
+import collections
+import json
+import os
+import threading
+import time
+
+# --- Per-endpoint request metrics ---
+# LLMClient reports every API attempt here, labelled by client key ("peer", "student", "grader",
+# "quiz_generator") and model. Three outputs:
+#   * an optional JSONL event log, one line per attempt (for ad-hoc analysis),
+#   * an optional Prometheus textfile (node_exporter textfile collector format), rewritten
+#     atomically every `flush_seconds` and at close,
+#   * `summary()`, a compact per-client/model digest stored in run_overview.json.
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0, 300.0)
+TTFT_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Histogram:
+    """
+    Cumulative-bucket histogram as in Prometheus. Quantiles are interpolated within a bucket and
+    capped at the largest value seen.
+    """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last slot is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        index = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                index = i
+                break
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, bucket_count in enumerate(self.counts):
+            if seen + bucket_count >= rank and bucket_count:
+                if i == len(self.buckets):
+                    return self.max  # beyond the largest bucket
+                lower = self.buckets[i - 1] if i else 0.0
+                return min(self.max, lower + (self.buckets[i] - lower) * (rank - seen) / bucket_count)
+            seen += bucket_count
+        return self.max
+
+    def cumulative(self):
+        """(upper bound label, cumulative count) pairs including +Inf."""
+        total = 0
+        for bound, bucket_count in zip(list(self.buckets) + ["+Inf"], self.counts):
+            total += bucket_count
+            yield bound, total
+
+
+class EndpointStats:
+    """Everything recorded for one (client key, model) pair."""
+
+    def __init__(self):
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.ttft = Histogram(TTFT_BUCKETS)
+        self.outcomes = collections.Counter()
+        self.retries = 0
+        self.prompt_tokens = 0
+        self.cached_prompt_tokens = 0
+        self.completion_tokens = 0
+        self.first_seen = None
+        self.last_seen = None
+
+    def summary(self):
+        elapsed = (self.last_seen - self.first_seen) if self.first_seen is not None else 0
+        ok = self.outcomes.get("ok", 0)
+        return {
+            "attempts": sum(self.outcomes.values()),
+            "successful": ok,
+            "retries": self.retries,
+            "errors": {k: v for k, v in self.outcomes.items() if k != "ok"},
+            "latency_seconds": _digest(self.latency),
+            "time_to_first_token_seconds": _digest(self.ttft) if self.ttft.count else None,
+            "prompt_tokens": self.prompt_tokens,
+            "cached_prompt_tokens": self.cached_prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "completion_tokens_per_second": round(self.completion_tokens / elapsed, 1) if elapsed > 0 else None,
+            "requests_per_second": round(ok / elapsed, 2) if elapsed > 0 else None,
+        }
+
+
+def _digest(histogram):
+    if not histogram.count:
+        return None
+    return {
+        "mean": round(histogram.sum / histogram.count, 3),
+        "p50": round(histogram.quantile(0.5), 3),
+        "p90": round(histogram.quantile(0.9), 3),
+        "p99": round(histogram.quantile(0.99), 3),
+    }
+
+
+class MetricsRecorder:
+    """Thread-safe sink for request metrics; one instance can be shared by several LLMClients."""
+
+    def __init__(self, events_file=None, prometheus_file=None, flush_seconds=30.0):
+        self.endpoints = collections.defaultdict(EndpointStats)
+        self.flush_seconds = flush_seconds
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()  # serialises textfile writes
+        self._events = None
+        self._prometheus_file = None
+        self._last_flush = time.monotonic()
+        self.open(events_file, prometheus_file)
+
+    def open(self, events_file=None, prometheus_file=None, append=False):
+        """(Re)directs the event log and the Prometheus textfile, e.g. once the run directory is known."""
+        with self._lock:
+            if self._events:
+                self._events.close()
+                self._events = None
+            if events_file:
+                if os.path.dirname(events_file):
+                    os.makedirs(os.path.dirname(events_file), exist_ok=True)
+                self._events = open(events_file, 'a' if append else 'w', encoding='utf-8')
+            self._prometheus_file = prometheus_file
+
+    def record(self, client_key, model, outcome, latency, attempt=1, ttft=None, usage_counts=(0, 0, 0), n=1, streamed=False):
+        """Records one API attempt. `usage_counts` is (prompt, cached prompt, completion) tokens."""
+        now = time.time()
+        prompt_tokens, cached_tokens, completion_tokens = usage_counts
+        with self._lock:
+            stats = self.endpoints[(client_key, model)]
+            stats.outcomes[outcome] += 1
+            stats.latency.observe(latency)
+            if ttft is not None:
+                stats.ttft.observe(ttft)
+            if attempt > 1:
+                stats.retries += 1
+            stats.prompt_tokens += prompt_tokens
+            stats.cached_prompt_tokens += cached_tokens
+            stats.completion_tokens += completion_tokens
+            stats.first_seen = stats.first_seen if stats.first_seen is not None else now - latency
+            stats.last_seen = now
+            if self._events:
+                self._events.write(json.dumps({
+                    "ts": round(now, 3), "client": client_key, "model": model, "attempt": attempt,
+                    "outcome": outcome, "latency": round(latency, 4),
+                    "ttft": round(ttft, 4) if ttft is not None else None, "n": n, "streamed": streamed,
+                    "prompt_tokens": prompt_tokens, "cached_prompt_tokens": cached_tokens, "completion_tokens": completion_tokens,
+                }) + '\n')
+            flush_due = self._prometheus_file and time.monotonic() - self._last_flush >= self.flush_seconds
+            if flush_due:
+                self._last_flush = time.monotonic()
+        if flush_due:
+            self.write_prometheus()
+
+    def summary(self):
+        """{client key: {model: digest}} for run_overview.json."""
+        with self._lock:
+            result = {}
+            for (client_key, model), stats in sorted(self.endpoints.items(), key=lambda item: (str(item[0][0]), str(item[0][1]))):
+                result.setdefault(client_key, {})[model] = stats.summary()
+            return result
+
+    def write_prometheus(self):
+        with self._flush_lock:
+            with self._lock:
+                path = self._prometheus_file
+                if not path:
+                    return
+                text = self._prometheus_text()
+            tmp_path = path + ".tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(text)
+            os.replace(tmp_path, path)
+
+    def _prometheus_text(self):
+        lines = []
+
+        def header(name, kind, help_text):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        def histogram(name, help_text, attr):
+            header(name, "histogram", help_text)
+            for (client_key, model), stats in self.endpoints.items():
+                hist = getattr(stats, attr)
+                labels = _labels(client=client_key, model=model)
+                for bound, total in hist.cumulative():
+                    lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {total}')
+                lines.append(f"{name}_sum{{{labels}}} {hist.sum}")
+                lines.append(f"{name}_count{{{labels}}} {hist.count}")
+
+        histogram("qmath_llm_request_duration_seconds", "Latency of LLM API attempts.", "latency")
+        histogram("qmath_llm_time_to_first_token_seconds", "Time to first streamed token.", "ttft")
+
+        header("qmath_llm_requests_total", "counter", "LLM API attempts by outcome (ok or error class).")
+        for (client_key, model), stats in self.endpoints.items():
+            for outcome, count in stats.outcomes.items():
+                lines.append(f"qmath_llm_requests_total{{{_labels(client=client_key, model=model, outcome=outcome)}}} {count}")
+
+        for name, attr, help_text in (
+            ("qmath_llm_retries_total", "retries", "Attempts that were retries of an earlier failed attempt."),
+            ("qmath_llm_prompt_tokens_total", "prompt_tokens", "Prompt tokens reported by the API."),
+            ("qmath_llm_cached_prompt_tokens_total", "cached_prompt_tokens", "Prompt tokens served from the provider's prefix cache."),
+            ("qmath_llm_completion_tokens_total", "completion_tokens", "Completion tokens reported by the API."),
+        ):
+            header(name, "counter", help_text)
+            for (client_key, model), stats in self.endpoints.items():
+                lines.append(f"{name}{{{_labels(client=client_key, model=model)}}} {getattr(stats, attr)}")
+        return "\n".join(lines) + "\n"
+
+    def close(self):
+        self.write_prometheus()
+        with self._lock:
+            if self._events:
+                self._events.close()
+                self._events = None
+
+
+def _labels(**labels):
+    return ",".join(f'{key}="{_escape(value)}"' for key, value in labels.items())
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
@@ -0,0 +1,428 @@
+import argparse
+import hashlib
+import json
+import math
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# --- Local stand-in for the OpenAI-compatible endpoints ---
+# Speaks enough of the chat-completions API (plain and streamed, n > 1, usage, 429/5xx errors) for
+# generate_quizzes.py and generate_traces_and_grade.py to run end to end without GPUs or paid APIs.
+# Replies are canned but well-formed: a 5-question quiz JSON for QUIZ_GENERATION_PROMPT, grading JSON
+# (an array for QUIZ_BATCH_GRADING_PROMPT) for the grading prompts, and a reasoning trace ending in
+# \boxed{...} plus some trailing text for everything else. Timing follows a simple model:
+#   time to first token = prefill (prompt tokens / --prefill-tokens-per-second) + a --ttft sample,
+#   then completion tokens at --tokens-per-second,
+# with --straggler-rate of the requests slowed down by --straggler-factor.
+#
+#   python mock_llm_server.py --port 8000 --ttft lognormal:0.3,0.5 --tokens-per-second 60 --rate-limit-rate 0.02
+#
+# Point LOCAL_API_URL_PEER / LOCAL_API_URL_STUDENT / GRADER_API_URL / COMMERCIAL_API_URL at
+# http://localhost:<port>/v1. GET /stats returns request, token and injected-error counters
+# (GET /stats?reset_peak restarts the max_active high-water mark);
+# GET /health answers 200 like vLLM's health endpoint. benchmark.py starts one in-process.
+
+
+def parse_distribution(spec):
+    """
+    Parses "fixed:S", "uniform:LO,HI", "exp:MEAN" or "lognormal:MEDIAN,SIGMA" (a bare number means
+    fixed) into a function rng -> non-negative float.
+    """
+    kind, _, raw_params = str(spec).partition(':')
+    if not raw_params:
+        kind, raw_params = "fixed", kind
+    params = [float(p) for p in raw_params.split(',')]
+    if kind == "fixed":
+        return lambda rng: params[0]
+    if kind == "uniform":
+        return lambda rng: rng.uniform(params[0], params[1])
+    if kind == "exp":
+        return lambda rng: rng.expovariate(1.0 / params[0]) if params[0] > 0 else 0.0
+    if kind == "lognormal":
+        return lambda rng: params[0] * math.exp(rng.gauss(0.0, params[1]))
+    raise ValueError(f"Unknown distribution '{spec}' (use fixed, uniform, exp or lognormal)")
+
+
+class MockProfile:
+    """Latency, output length and fault-injection settings of a mock server."""
+
+    def __init__(self, ttft="lognormal:0.2,0.5", tokens_per_second=80.0, prefill_tokens_per_second=8000.0,
+                 trace_tokens="lognormal:500,0.6", trailing_tokens=200, error_rate=0.0, rate_limit_rate=0.0,
+                 malformed_rate=0.0, straggler_rate=0.0, straggler_factor=10.0, max_concurrency=None,
+                 reject_n=False, seed=0):
+        self.ttft = parse_distribution(ttft)
+        self.tokens_per_second = tokens_per_second
+        self.prefill_tokens_per_second = prefill_tokens_per_second
+        self.trace_tokens = parse_distribution(trace_tokens)
+        self.trailing_tokens = trailing_tokens
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.malformed_rate = malformed_rate
+        self.straggler_rate = straggler_rate
+        self.straggler_factor = straggler_factor
+        self.max_concurrency = max_concurrency
+        self.reject_n = reject_n
+        self.seed = seed
+
+
+def add_profile_arguments(parser):
+    """Adds the MockProfile settings as command-line options (shared with benchmark.py)."""
+    group = parser.add_argument_group("mock server profile")
+    group.add_argument("--ttft", default="lognormal:0.2,0.5", help="Time-to-first-token distribution in seconds, excluding prefill (default: lognormal:0.2,0.5).")
+    group.add_argument("--tokens-per-second", type=float, default=80.0, help="Decode speed per request (default: 80).")
+    group.add_argument("--prefill-tokens-per-second", type=float, default=8000.0, help="Prompt processing speed per request (default: 8000).")
+    group.add_argument("--trace-tokens", default="lognormal:500,0.6", help="Length distribution of reasoning traces up to the boxed answer (default: lognormal:500,0.6).")
+    group.add_argument("--trailing-tokens", type=int, default=200, help="Tokens a trace keeps going after its boxed answer (default: 200).")
+    group.add_argument("--error-rate", type=float, default=0.0, help="Share of requests answered with HTTP 500.")
+    group.add_argument("--rate-limit-rate", type=float, default=0.0, help="Share of requests answered with HTTP 429.")
+    group.add_argument("--malformed-rate", type=float, default=0.0, help="Share of quiz/grading replies that are not valid JSON.")
+    group.add_argument("--straggler-rate", type=float, default=0.0, help="Share of requests that are --straggler-factor times slower.")
+    group.add_argument("--straggler-factor", type=float, default=10.0, help="Slow-down of straggler requests (default: 10).")
+    group.add_argument("--max-concurrency", type=int, default=None, help="Answer 429 while this many requests are already running.")
+    group.add_argument("--reject-n", action="store_true", help="Reject n > 1 with HTTP 400, like APIs without multi-sampling.")
+    group.add_argument("--seed", type=int, default=0, help="Seed for reply contents and injected faults.")
+    return group
+
+
+def profile_from_args(args):
+    return MockProfile(
+        ttft=args.ttft, tokens_per_second=args.tokens_per_second, prefill_tokens_per_second=args.prefill_tokens_per_second,
+        trace_tokens=args.trace_tokens, trailing_tokens=args.trailing_tokens, error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate, malformed_rate=args.malformed_rate, straggler_rate=args.straggler_rate,
+        straggler_factor=args.straggler_factor, max_concurrency=args.max_concurrency, reject_n=args.reject_n, seed=args.seed,
+    )
+
+
+# --- Canned replies ---
+
+FILLER_WORDS = ("First", "we", "compute", "the", "value", "of", "x", "so", "that", "gives", "=", "+", "-", "3", "12",
+                "then", "substitute", "into", "equation", "and", "simplify", "step", "which", "means", "27", "/", "4")
+
+
+def count_tokens(text):
+    """Same rough 4-characters-per-token rule as llm_client.estimate_prompt_tokens."""
+    return len(text) // 4 + 1
+
+
+def classify_prompt(prompt):
+    if "**Reasoner Traces (" in prompt:
+        return "batch_grading"
+    if "**Reasoner Trace:**" in prompt:
+        return "grading"
+    if "diagnostic quiz" in prompt:
+        return "quiz"
+    return "reasoning"
+
+
+def quiz_reply(rng):
+    questions = [{
+        "question_id": 1,
+        "question_text": "What is the primary strategy required to solve the problem?",
+        "options": ["Set up and solve an equation", "Guess and check", "Draw a diagram only", "Use a trigonometric identity"],
+        "correct_answer_index": 0,
+        "reward_score": 0.2,
+    }]
+    for question_id in range(2, 6):
+        correct = rng.randint(2, 99)
+        options = [str(correct), str(-correct), str(correct + rng.randint(1, 9)), str(correct * 2)]
+        rng.shuffle(options)
+        questions.append({
+            "question_id": question_id,
+            "question_text": f"What is the value of intermediate quantity {question_id}?",
+            "options": options,
+            "correct_answer_index": options.index(str(correct)),
+            "reward_score": 0.2,
+        })
+    return json.dumps({"quiz": questions}, indent=2)
+
+
+def grading_result(rng, trace_label=None):
+    correct = sorted(rng.sample(range(1, 6), rng.randint(0, 5)))
+    result = {"Trace": trace_label} if trace_label is not None else {}
+    result.update({"Score": round(0.2 * len(correct), 2), "Correct_Questions": correct,
+                   "Wrong_Questions": [q for q in range(1, 6) if q not in correct]})
+    if len(correct) < 5:
+        result["Reason_for_Failure"] = "Some intermediate values in the trace do not match the correct options."
+    return result
+
+
+def reasoning_tokens(rng, profile):
+    """Token list of one trace: filler, the boxed answer, then trailing text that early stop can cut."""
+    body = [rng.choice(FILLER_WORDS) + " " for _ in range(max(1, int(profile.trace_tokens(rng))))]
+    answer = ["The final answer is ", "\\boxed{", str(rng.randint(0, 99)), "}", ".\n"]
+    trailing = [rng.choice(FILLER_WORDS) + " " for _ in range(profile.trailing_tokens)]
+    return body + answer + trailing
+
+
+def reply_tokens(kind, prompt, choice_index, profile, malformed):
+    """Completion of one choice as a list of tokens (stream chunks). Deterministic per prompt and choice."""
+    digest = hashlib.sha256(prompt.encode('utf-8')).hexdigest()
+    rng = random.Random(f"{profile.seed}:{digest}:{choice_index}")
+    if kind == "reasoning":
+        return reasoning_tokens(rng, profile)
+    if malformed:
+        text = "I am sorry, but I cannot produce the requested JSON for this input."
+    elif kind == "quiz":
+        text = quiz_reply(rng)
+    elif kind == "batch_grading":
+        num_traces = prompt.count("--- Trace ")
+        text = json.dumps([grading_result(rng, i) for i in range(1, num_traces + 1)], indent=2)
+    else:
+        text = json.dumps(grading_result(rng), indent=2)
+    return [text[i:i + 4] for i in range(0, len(text), 4)]
+
+
+# --- Server ---
+
+class MockServerStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.by_kind = {}
+        self.injected = {"rate_limited": 0, "server_error": 0, "malformed": 0, "straggler": 0, "rejected_n": 0, "over_concurrency": 0}
+        self.aborted_streams = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.active = 0
+        self.max_active = 0
+
+    def snapshot(self, reset_peak=False):
+        """Counters so far; `reset_peak` restarts max_active from the current load (e.g. between benchmark cases)."""
+        with self.lock:
+            snapshot = {
+                "requests": self.requests, "by_kind": dict(self.by_kind), "injected": dict(self.injected),
+                "aborted_streams": self.aborted_streams, "prompt_tokens": self.prompt_tokens,
+                "completion_tokens": self.completion_tokens, "active": self.active, "max_active": self.max_active,
+            }
+            if reset_peak:
+                self.max_active = self.active
+            return snapshot
+
+
+class MockRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, like a real server; streams use chunked encoding
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def do_GET(self):
+        path, _, query = self.path.partition('?')
+        if path.rstrip('/') == "/health":
+            self._send_json(200, {"status": "ok"})
+        elif path.rstrip('/') == "/stats":
+            self._send_json(200, self.server.stats.snapshot(reset_peak="reset_peak" in query))
+        elif path.rstrip('/') == "/v1/models":
+            self._send_json(200, {"object": "list", "data": [{"id": "mock", "object": "model"}]})
+        else:
+            self._send_json(404, {"error": {"message": f"Unknown path {self.path}", "type": "not_found"}})
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        if self.path.rstrip('/') != "/v1/chat/completions":
+            self._send_json(404, {"error": {"message": f"Unknown path {self.path}", "type": "not_found"}})
+            return
+        try:
+            request = json.loads(body)
+            prompt = "".join(str(message.get("content") or "") for message in request["messages"])
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            self._send_json(400, {"error": {"message": f"Malformed request: {e}", "type": "invalid_request_error"}})
+            return
+
+        server, stats, profile = self.server, self.server.stats, self.server.profile
+        n = int(request.get("n") or 1)
+        with stats.lock:
+            stats.requests += 1
+            request_number = stats.requests
+            rng = random.Random(f"{profile.seed}:request:{request_number}")
+            over_concurrency = profile.max_concurrency is not None and stats.active >= profile.max_concurrency
+            if over_concurrency:
+                stats.injected["over_concurrency"] += 1
+        if over_concurrency or rng.random() < profile.rate_limit_rate:
+            if not over_concurrency:
+                server.count("rate_limited")
+            self._send_json(429, {"error": {"message": "Rate limit reached (mock)", "type": "rate_limit_error"}}, {"Retry-After": "1"})
+            return
+        if rng.random() < profile.error_rate:
+            server.count("server_error")
+            self._send_json(500, {"error": {"message": "Injected server error (mock)", "type": "server_error"}})
+            return
+        if n > 1 and profile.reject_n:
+            server.count("rejected_n")
+            self._send_json(400, {"error": {"message": "n > 1 is not supported (mock)", "type": "invalid_request_error"}})
+            return
+
+        kind = classify_prompt(prompt)
+        malformed = kind != "reasoning" and rng.random() < profile.malformed_rate
+        if malformed:
+            server.count("malformed")
+        max_tokens = request.get("max_tokens")
+        choices = []
+        for index in range(n):
+            tokens = reply_tokens(kind, prompt, index, profile, malformed)
+            finish_reason = "stop"
+            if max_tokens and len(tokens) > max_tokens:
+                tokens, finish_reason = tokens[:max_tokens], "length"
+            choices.append((tokens, finish_reason))
+
+        prompt_tokens = count_tokens(prompt)
+        slowdown = 1.0
+        if rng.random() < profile.straggler_rate:
+            server.count("straggler")
+            slowdown = profile.straggler_factor
+        ttft = (prompt_tokens / profile.prefill_tokens_per_second + profile.ttft(rng)) * slowdown
+        seconds_per_token = slowdown / profile.tokens_per_second if profile.tokens_per_second > 0 else 0.0
+
+        with stats.lock:
+            stats.by_kind[kind] = stats.by_kind.get(kind, 0) + 1
+            stats.prompt_tokens += prompt_tokens
+            stats.active += 1
+            stats.max_active = max(stats.max_active, stats.active)
+        try:
+            if request.get("stream"):
+                include_usage = bool((request.get("stream_options") or {}).get("include_usage"))
+                self._stream(request, request_number, choices, prompt_tokens, ttft, seconds_per_token, include_usage)
+            else:
+                completion_tokens = sum(len(tokens) for tokens, _ in choices)
+                time.sleep(ttft + seconds_per_token * max(len(tokens) for tokens, _ in choices))
+                with stats.lock:
+                    stats.completion_tokens += completion_tokens
+                self._send_json(200, {
+                    "id": f"chatcmpl-mock-{request_number}", "object": "chat.completion", "created": int(time.time()),
+                    "model": request.get("model"),
+                    "choices": [{"index": i, "message": {"role": "assistant", "content": "".join(tokens)}, "finish_reason": finish_reason}
+                                for i, (tokens, finish_reason) in enumerate(choices)],
+                    "usage": self._usage(prompt_tokens, completion_tokens),
+                })
+        finally:
+            with stats.lock:
+                stats.active -= 1
+
+    def _stream(self, request, request_number, choices, prompt_tokens, ttft, seconds_per_token, include_usage):
+        """Sends the choices as server-sent events, one token per choice per chunk, paced in real time."""
+        stats = self.server.stats
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        base = {"id": f"chatcmpl-mock-{request_number}", "object": "chat.completion.chunk",
+                "created": int(time.time()), "model": request.get("model")}
+
+        def event(choice_list, usage=None):
+            payload = dict(base, choices=choice_list)
+            if usage is not None:
+                payload["usage"] = usage
+            return "data: " + json.dumps(payload) + "\n\n"
+
+        start = time.monotonic()
+        sent_tokens = 0
+        pending = [event([{"index": i, "delta": {"role": "assistant", "content": ""}, "finish_reason": None} for i in range(len(choices))])]
+        try:
+            for position in range(max(len(tokens) for tokens, _ in choices)):
+                due = start + ttft + position * seconds_per_token
+                wait = due - time.monotonic()
+                if wait > 0.005:
+                    self._write_chunk("".join(pending))  # flush what is due before sleeping
+                    pending = []
+                    time.sleep(wait)
+                pieces = [{"index": i, "delta": {"content": tokens[position]}, "finish_reason": None}
+                          for i, (tokens, _) in enumerate(choices) if position < len(tokens)]
+                sent_tokens += len(pieces)
+                pending.append(event(pieces))
+            pending.append(event([{"index": i, "delta": {}, "finish_reason": finish_reason} for i, (_, finish_reason) in enumerate(choices)]))
+            if include_usage:
+                pending.append(event([], self._usage(prompt_tokens, sent_tokens)))
+            pending.append("data: [DONE]\n\n")
+            self._write_chunk("".join(pending))
+            self.wfile.write(b"0\r\n\r\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # The client hung up (e.g. early stop after \boxed{}); a real server aborts the generation here.
+            with stats.lock:
+                stats.aborted_streams += 1
+            self.close_connection = True
+        finally:
+            with stats.lock:
+                stats.completion_tokens += sent_tokens
+
+    def _write_chunk(self, text):
+        if text:
+            data = text.encode('utf-8')
+            self.wfile.write(f"{len(data):x}\r\n".encode('ascii') + data + b"\r\n")
+            self.wfile.flush()
+
+    @staticmethod
+    def _usage(prompt_tokens, completion_tokens):
+        return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens}
+
+    def _send_json(self, status, payload, headers=None):
+        data = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class MockLLMServer(ThreadingHTTPServer):
+    """Threaded mock server; `start()` runs it in a background thread (as benchmark.py does)."""
+
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, profile=None, host="127.0.0.1", port=0, verbose=False):
+        super().__init__((host, port), MockRequestHandler)
+        self.profile = profile or MockProfile()
+        self.stats = MockServerStats()
+        self.verbose = verbose
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def handle_error(self, request, client_address):
+        # Clients hanging up mid-request (early stop, cancelled hedged requests) is expected traffic.
+        if isinstance(sys.exc_info()[1], (BrokenPipeError, ConnectionResetError)):
+            return
+        super().handle_error(request, client_address)
+
+    def count(self, injected_kind):
+        with self.stats.lock:
+            self.stats.injected[injected_kind] += 1
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, name="mock-llm-server", daemon=True)
+        self._thread.start()
+        return self.base_url
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock OpenAI-compatible chat-completions server for local end-to-end runs and benchmarks.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--verbose", action="store_true", help="Log every HTTP request.")
+    add_profile_arguments(parser)
+    args = parser.parse_args()
+
+    server = MockLLMServer(profile_from_args(args), args.host, args.port, args.verbose)
+    print(f"Mock LLM server listening on {server.base_url} (stats: http://{args.host}:{server.server_address[1]}/stats)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(f"\nStopping. Final stats: {json.dumps(server.stats.snapshot())}")
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
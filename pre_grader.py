@@ -0,0 +1,210 @@
+import hashlib
+import math
+import re
+
+# --- Deterministic local pre-grader ---
+# Quiz questions 2-5 usually ask for a numeric intermediate value (Δx, a discriminant, a radicand...),
+# with the distractors built from typical mistakes. For those questions we can check the trace
+# directly: if the correct value shows up in the trace and none of the distractors do, the step was
+# done right; if a distractor shows up and the correct value does not, it was done wrong. Numbers that
+# already appear in the problem statement are ignored as evidence, since traces restate them.
+#
+# Conceptual questions (question 1 asks for the strategy) are decided the same way on their option
+# text: the correct option written out in the trace and no other option is evidence of a right
+# answer, and the other way round of a wrong one.
+#
+# A trace is graded locally only when the evidence settles the whole quiz, i.e. every question is
+# decided. Anything else returns None and goes to the grader LLM. With `credit_conceptual`, conceptual
+# questions without evidence are credited when every numeric step is correct (a trace that gets all
+# the intermediate values right has probably used the right strategy); such questions are listed
+# under "Auto_Credited_Questions" in the result.
+
+_NUMBER = r'\d+(?:\.\d+)?'
+# A minus sign only counts as a sign at the start or after a space, bracket, '=', ',', ':' or ';',
+# so "5-3" yields 3 (a subtraction) while "x = -3" yields -3.
+_SIGN = r'(?:(?<![^\s(\[{=,:;])[-−])?'
+TRACE_VALUE_RE = re.compile(
+    rf'(?P<frac>{_SIGN}\\d?frac\s*\{{\s*(?P<fn>-?{_NUMBER})\s*\}}\s*\{{\s*(?P<fd>-?{_NUMBER})\s*\}})'
+    rf'|(?P<root>{_SIGN}(?P<rc>{_NUMBER})?\s*(?:\\sqrt\s*\{{\s*(?P<rb>{_NUMBER})\s*\}}|√\s*(?P<ru>{_NUMBER})))'
+    rf'|(?P<ratio>{_SIGN}(?P<rn>{_NUMBER})\s*/\s*(?P<rd>{_NUMBER}))'
+    rf'|(?P<plain>{_SIGN}{_NUMBER})',
+    re.MULTILINE,
+)
+OPTION_NOISE_RE = re.compile(r'[\s$]|\\[()\[\],;!]|\\left|\\right|\.$')
+NON_WORD_RE = re.compile(r'[^a-z0-9]+')
+MIN_OPTION_WORDS = 3  # shorter conceptual options ("Factoring") match too much text to count as evidence
+
+
+def _value(match):
+    """Float value of one TRACE_VALUE_RE match, rounded so equal values compare equal."""
+    text = match.group(0)
+    negative = text.lstrip()[:1] in ('-', '−')
+    try:
+        if match.group('frac'):
+            value = float(match.group('fn')) / float(match.group('fd'))
+        elif match.group('root'):
+            radicand = match.group('rb') or match.group('ru')
+            value = float(match.group('rc') or 1) * math.sqrt(float(radicand))
+        elif match.group('ratio'):
+            value = float(match.group('rn')) / float(match.group('rd'))
+        else:
+            value = float(text.lstrip('-−'))
+    except (ValueError, ZeroDivisionError):
+        return None
+    return round(-value if negative else value, 6)
+
+
+def extract_values(text):
+    """Set of numeric values (integers, decimals, fractions, square roots) written in `text`."""
+    values = set()
+    for match in TRACE_VALUE_RE.finditer(text or ""):
+        value = _value(match)
+        if value is not None:
+            values.add(value)
+    return values
+
+
+def parse_numeric_option(option):
+    """Value of a quiz option that is a single number, or None for anything else (e.g. conceptual options)."""
+    if not isinstance(option, (str, int, float)):
+        return None
+    text = OPTION_NOISE_RE.sub('', str(option))
+    match = TRACE_VALUE_RE.fullmatch(text)
+    return _value(match) if match else None
+
+
+def normalize_words(text):
+    """Lower-case words of `text` separated by single spaces, padded with spaces for whole-word matching."""
+    return " " + NON_WORD_RE.sub(" ", str(text).lower()).strip() + " "
+
+
+def _conceptual_evidence(options, correct_index, trace_words):
+    """(shows_correct, shows_distractor) for a conceptual question; None if an option is too short to match."""
+    phrases = [normalize_words(option) for option in options]
+    if any(len(phrase.split()) < MIN_OPTION_WORDS for phrase in phrases):
+        return None
+    shows_correct = phrases[correct_index] in trace_words
+    shows_distractor = any(phrase in trace_words for i, phrase in enumerate(phrases) if i != correct_index and phrase != phrases[correct_index])
+    return shows_correct, shows_distractor
+
+
+def pre_grade(quiz_json, reason_trace, problem_text="", min_numeric_questions=2, credit_conceptual=False):
+    """
+    Returns a grading result shaped like the grader LLM's JSON, or None if the trace is not clear-cut.
+    `credit_conceptual` credits undecided conceptual questions of a trace with every numeric step right.
+    """
+    if not isinstance(quiz_json, list) or not quiz_json or not reason_trace:
+        return None
+    trace_values = extract_values(reason_trace) - extract_values(problem_text)
+    trace_words = normalize_words(reason_trace)
+
+    correct_questions, wrong_questions, conceptual_positions = [], [], []
+    total_score, numeric_questions = 0.0, 0
+    for position, question in enumerate(quiz_json, 1):
+        if not isinstance(question, dict):
+            return None
+        question_id = question.get('question_id', position)
+        options = question.get('options') or []
+        correct_index = question.get('correct_answer_index')
+        if not isinstance(correct_index, int) or not 0 <= correct_index < len(options):
+            return None
+        values = [parse_numeric_option(option) for option in options]
+        if values[correct_index] is None:
+            evidence = _conceptual_evidence(options, correct_index, trace_words)
+            if evidence == (True, False):
+                correct_questions.append(question_id)
+                total_score += _reward(question, len(quiz_json))
+            elif evidence == (False, True):
+                wrong_questions.append(question_id)
+            else:
+                conceptual_positions.append(position)
+            continue
+
+        numeric_questions += 1
+        distractors = {v for i, v in enumerate(values) if i != correct_index and v is not None and v != values[correct_index]}
+        shows_correct = values[correct_index] in trace_values
+        shows_distractor = bool(distractors & trace_values)
+        if shows_correct and not shows_distractor:
+            correct_questions.append(question_id)
+            total_score += _reward(question, len(quiz_json))
+        elif shows_distractor and not shows_correct:
+            wrong_questions.append(question_id)
+        else:
+            return None  # no evidence, or both the right value and a distractor appear
+
+    if numeric_questions < min_numeric_questions:
+        return None
+    auto_credited = []
+    if conceptual_positions:
+        if not credit_conceptual or wrong_questions:
+            return None
+        for position in conceptual_positions:
+            question = quiz_json[position - 1]
+            auto_credited.append(question.get('question_id', position))
+            total_score += _reward(question, len(quiz_json))
+        correct_questions += auto_credited
+
+    result = {
+        "Score": round(total_score, 6),
+        "Correct_Questions": sorted(correct_questions),
+        "Wrong_Questions": sorted(wrong_questions),
+        "Grader": "local_pre_grader",
+    }
+    if auto_credited:
+        result["Auto_Credited_Questions"] = sorted(auto_credited)
+    if wrong_questions:
+        result["Reason_for_Failure"] = "A distractor appears in the trace instead of the correct answer for questions " + ", ".join(map(str, sorted(wrong_questions))) + "."
+    return result
+
+
+def _reward(question, num_questions):
+    try:
+        return float(question.get('reward_score', 1.0 / num_questions))
+    except (TypeError, ValueError):
+        return 1.0 / num_questions
+
+
+def should_audit(key, rate):
+    """Deterministically picks about `rate` of all keys, so a resumed run audits the same traces."""
+    if rate <= 0:
+        return False
+    digest = hashlib.md5(repr(key).encode('utf-8')).hexdigest()
+    return int(digest[:8], 16) / 0xFFFFFFFF < rate
+
+
+def parse_score(grading_result):
+    match = re.search(r'(\d+\.?\d*)', str((grading_result or {}).get("Score")))
+    return float(match.group(1)) if match else None
+
+
+class PreGraderStats:
+    """Counts how many traces the pre-grader settles and how often it agrees with the grader LLM on audits."""
+
+    def __init__(self):
+        self.checked = 0
+        self.graded_locally = 0
+        self.audited = 0
+        self.agreed = 0
+        self.score_diff_sum = 0.0
+
+    def add_audit(self, local_result, llm_result):
+        """Compares a local result with the grader LLM's result (a parsed dict, or None) for the same trace."""
+        llm_score = parse_score(llm_result)
+        if llm_score is None:
+            return  # grader failed; nothing to compare against
+        self.audited += 1
+        llm_correct = sorted(int(q) for q in llm_result.get("Correct_Questions") or [] if str(q).lstrip('-').isdigit())
+        if llm_correct == local_result["Correct_Questions"]:
+            self.agreed += 1
+        self.score_diff_sum += abs(llm_score - local_result["Score"])
+
+    def summary(self):
+        return {
+            "traces_checked": self.checked,
+            "graded_locally": self.graded_locally,
+            "sent_to_grader": self.checked - self.graded_locally,
+            "local_share_percent": round(self.graded_locally / self.checked * 100, 2) if self.checked else 0.0,
+            "audited": self.audited,
+            "audit_agreement_percent": round(self.agreed / self.audited * 100, 2) if self.audited else None,
+            "audit_mean_abs_score_diff": round(self.score_diff_sum / self.audited, 4) if self.audited else None,
+        }
@@ -1,7 +1,10 @@
-import json
+import hashlib
 import os
-from tqdm import tqdm
+import re
+import unicodedata
+import numpy as np
 from datasets import load_dataset
+from answer_check import normalize_answer
 
 # --- Configuration ---
 HF_DATASET_ID = "open-r1/OpenR1-Math-220k"
@@ -17,6 +20,28 @@ OUTPUT_FILE_ALL = os.path.join(BASE_DIR, "open_r1_math_data_original.jsonl")
 # 2. This NEW file will contain only the subset with simple numeric answers.
 OUTPUT_FILE_NUMERIC = os.path.join(BASE_DIR, "open_r1_math_data_numeric_only.jsonl")
 
+# --- Parallelism & output format ---
+NUM_PROC = os.cpu_count() or 1 # Worker processes for the datasets filter calls
+FILTER_BATCH_SIZE = 1000 # Rows handed to each filter call
+# "jsonl" writes the two files above. "parquet" writes each output as a directory of
+# Parquet shards next to them instead (e.g. open_r1_math_data_numeric_only_parquet/part-00000.parquet).
+OUTPUT_FORMAT = "jsonl"
+PARQUET_SHARDS = 16
+
+# --- Near-duplicate removal (MinHash / LSH over the normalised `problem` text) ---
+# OpenR1 repeats many problems verbatim or slightly reworded, and every copy would later cost a quiz
+# call plus all the reasoning/grading calls. Records are clustered by exact normalised text (fast
+# path) and by MinHash similarity of word shingles; only the first record of each cluster goes into
+# the numeric-only output. OUTPUT_FILE_ALL keeps every record with `dedup_cluster_id` (the uuid of the
+# cluster's kept record) and `dedup_cluster_size`, so results can be re-expanded to the duplicates.
+DEDUP_ENABLED = True
+DEDUP_NUM_PERM = 128 # MinHash signature length
+DEDUP_BANDS = 16 # LSH bands; DEDUP_NUM_PERM / DEDUP_BANDS rows per band
+DEDUP_THRESHOLD = 0.8 # Estimated Jaccard similarity of the shingle sets above which two problems are duplicates
+DEDUP_SHINGLE_SIZE = 3 # Words per shingle
+DEDUP_REQUIRE_SAME_ANSWER = True # Near (not exact) duplicates must also have the same normalised answer, so "x = 3" vs "x = 5" variants survive
+DEDUP_SEED = 42
+
 
 # --- NEW: Helper function to check for simple integer answers ---
 def is_simple_numeric_answer(answer_str: str) -> bool:
@@ -36,12 +61,184 @@ def is_simple_numeric_answer(answer_str: str) -> bool:
         return False
 
 
+# --- Batched filter predicates (run inside datasets worker processes) ---
+def is_high_quality_record(solution_text, generations, correctness_flags):
+    """Stage 1 "Gatekeeper": a long solution, or at least one long generation verified as correct."""
+    if solution_text and isinstance(solution_text, str) and len(solution_text) > 100:
+        return True
+
+    if generations and correctness_flags and len(generations) == len(correctness_flags):
+        for i, is_correct in enumerate(correctness_flags):
+            if is_correct:
+                generation_text = generations[i]
+                if isinstance(generation_text, str) and len(generation_text) > 100:
+                    return True
+    return False
+
+def filter_high_quality_batch(solutions, generations_batch, correctness_batch):
+    return [
+        is_high_quality_record(solution_text, generations or [], correctness_flags or [])
+        for solution_text, generations, correctness_flags in zip(solutions, generations_batch, correctness_batch)
+    ]
+
+def filter_numeric_batch(answers):
+    return [is_simple_numeric_answer(answer) for answer in answers]
+
+
+# --- Near-duplicate detection ---
+MERSENNE_PRIME = (1 << 31) - 1
+TOKEN_RE = re.compile(r'\w+|[^\w\s]')
+LATEX_NOISE_RE = re.compile(r'\\(?:left|right|displaystyle|quad|qquad|[,;:!])|\$')
+_MINHASH_PARAMS = None
+
+def normalize_problem_text(text):
+    """Lower-cased, NFKC-normalised tokens without LaTeX spacing and $ delimiters, joined by single spaces."""
+    text = unicodedata.normalize('NFKC', text or '').lower()
+    return ' '.join(TOKEN_RE.findall(LATEX_NOISE_RE.sub(' ', text)))
+
+def text_hash64(text):
+    """Stable 64-bit hash (Python's hash() is salted per process, and this runs in several)."""
+    return int.from_bytes(hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest(), 'little', signed=True)
+
+def minhash_params():
+    global _MINHASH_PARAMS
+    if _MINHASH_PARAMS is None:
+        rng = np.random.RandomState(DEDUP_SEED)
+        a = rng.randint(1, MERSENNE_PRIME, size=(DEDUP_NUM_PERM, 1)).astype(np.uint64)
+        b = rng.randint(0, MERSENNE_PRIME, size=(DEDUP_NUM_PERM, 1)).astype(np.uint64)
+        _MINHASH_PARAMS = a, b
+    return _MINHASH_PARAMS
+
+def minhash_signature(normalized_text):
+    """DEDUP_NUM_PERM-long MinHash of the text's word shingles, using (a * x + b) mod (2^31 - 1) permutations."""
+    tokens = normalized_text.split(' ')
+    shingles = {' '.join(tokens[i:i + DEDUP_SHINGLE_SIZE]) for i in range(max(1, len(tokens) - DEDUP_SHINGLE_SIZE + 1))}
+    # blake2b rather than crc32: crc32 is linear, which biases the estimate for near-identical shingles.
+    x = np.fromiter((text_hash64(s) % MERSENNE_PRIME for s in shingles), dtype=np.uint64, count=len(shingles))
+    a, b = minhash_params()
+    return ((a * x + b) % MERSENNE_PRIME).min(axis=1).astype(np.uint32)
+
+def minhash_batch(problems, answers):
+    """datasets.map function: exact-text hash, answer hash and MinHash signature of each problem."""
+    exact_hashes, answer_hashes, signatures = [], [], []
+    for problem, answer in zip(problems, answers):
+        normalized = normalize_problem_text(problem)
+        exact_hashes.append(text_hash64(normalized))
+        answer_hashes.append(text_hash64(normalize_answer(answer)))
+        signatures.append(minhash_signature(normalized))
+    return {"exact_hash": exact_hashes, "answer_hash": answer_hashes, "minhash": signatures}
+
+def find_duplicate_clusters(exact_hashes, answer_hashes, signatures):
+    """
+    Returns (index of each record's cluster representative, counts). Identical normalised texts are
+    merged directly (with DEDUP_REQUIRE_SAME_ANSWER, only if their answers match too); one record per
+    distinct text then goes through LSH banding, and every pair sharing a bucket is kept if their
+    signatures agree on at least DEDUP_THRESHOLD of the positions (and, with DEDUP_REQUIRE_SAME_ANSWER,
+    their answers match). Representatives are the earliest record of each cluster.
+    """
+    if DEDUP_NUM_PERM % DEDUP_BANDS:
+        raise ValueError("DEDUP_NUM_PERM must be a multiple of DEDUP_BANDS")
+    num_records = len(exact_hashes)
+    exact_keys = np.stack([exact_hashes, answer_hashes], axis=1) if DEDUP_REQUIRE_SAME_ANSWER else np.asarray(exact_hashes)[:, None]
+    _, first_index, inverse = np.unique(exact_keys, axis=0, return_index=True, return_inverse=True)
+    exact_representative = first_index[inverse.reshape(-1)]
+    distinct = np.sort(first_index)  # one record per distinct text
+    distinct_signatures = signatures[distinct]
+
+    rows = DEDUP_NUM_PERM // DEDUP_BANDS
+    band_multipliers = np.random.RandomState(DEDUP_SEED + 1).randint(1, 1 << 31, size=rows).astype(np.uint64) | np.uint64(1)
+    candidate_pairs = [np.empty((0, 2), dtype=np.int64)]
+    for band in range(DEDUP_BANDS):
+        block = distinct_signatures[:, band * rows:(band + 1) * rows].astype(np.uint64)
+        bucket_keys = (block * band_multipliers).sum(axis=1)  # wraps around; collisions are re-checked below
+        # All pairs within each bucket: sorted by key, a bucket is a run, so pairing every record with
+        # the one `offset` places later covers every pair once the offsets reach the longest run.
+        order = np.argsort(bucket_keys, kind='stable')
+        sorted_keys = bucket_keys[order]
+        for offset in range(1, len(order)):
+            same_bucket = sorted_keys[offset:] == sorted_keys[:-offset]
+            if not same_bucket.any():
+                break
+            candidate_pairs.append(np.stack([order[offset:][same_bucket], order[:-offset][same_bucket]], axis=1))
+    pairs = np.unique(np.concatenate(candidate_pairs), axis=0)
+
+    similarity = (distinct_signatures[pairs[:, 0]] == distinct_signatures[pairs[:, 1]]).mean(axis=1) if len(pairs) else np.empty(0)
+    accepted = similarity >= DEDUP_THRESHOLD
+    if DEDUP_REQUIRE_SAME_ANSWER:
+        accepted &= answer_hashes[distinct[pairs[:, 0]]] == answer_hashes[distinct[pairs[:, 1]]]
+
+    # Union-find over distinct texts; the root is always the smallest position (earliest record).
+    parent = np.arange(len(distinct))
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+    for i, j in pairs[accepted]:
+        root_i, root_j = find(i), find(j)
+        if root_i != root_j:
+            parent[max(root_i, root_j)] = min(root_i, root_j)
+    roots = np.array([find(i) for i in range(len(distinct))], dtype=np.int64)
+
+    representative = distinct[roots][np.searchsorted(distinct, exact_representative)]
+    counts = {
+        "records": num_records,
+        "exact_duplicates": int(num_records - len(distinct)),
+        "near_duplicates": int(len(distinct) - len(np.unique(roots))),
+        "clusters": int(len(np.unique(roots))),
+        "candidate_pairs_checked": int(len(pairs)),
+    }
+    return representative, counts
+
+def add_dedup_clusters(dataset):
+    """
+    Adds `dedup_cluster_id` / `dedup_cluster_size` to `dataset`. Returns (dataset with the columns,
+    indices of the records to keep, counts). Signatures are computed across NUM_PROC processes.
+    """
+    signature_ds = dataset.map(
+        minhash_batch,
+        input_columns=['problem', 'answer'],
+        batched=True,
+        batch_size=FILTER_BATCH_SIZE,
+        num_proc=NUM_PROC,
+        remove_columns=dataset.column_names,
+        desc="MinHashing Problems",
+    )
+    table = signature_ds.data
+    signatures = np.asarray(table.column('minhash').combine_chunks().flatten()).reshape(len(signature_ds), DEDUP_NUM_PERM)
+    representative, counts = find_duplicate_clusters(table.column('exact_hash').to_numpy(), table.column('answer_hash').to_numpy(), signatures)
+
+    uuids = dataset['uuid'] if 'uuid' in dataset.column_names else [str(i) for i in range(len(dataset))]
+    cluster_sizes = np.bincount(representative, minlength=len(dataset))[representative]
+    dataset = dataset.add_column('dedup_cluster_id', [uuids[i] for i in representative])
+    dataset = dataset.add_column('dedup_cluster_size', cluster_sizes.tolist())
+    keep_indices = np.nonzero(representative == np.arange(len(representative)))[0]
+    return dataset, keep_indices, counts
+
+
+def write_dataset(dataset, jsonl_path):
+    """Writes `dataset` as JSON Lines, or as sharded Parquet when OUTPUT_FORMAT == "parquet". Returns the path written."""
+    if OUTPUT_FORMAT == "parquet":
+        output_dir = os.path.splitext(jsonl_path)[0] + "_parquet"
+        os.makedirs(output_dir, exist_ok=True)
+        num_shards = max(1, min(PARQUET_SHARDS, len(dataset)))
+        for index in range(num_shards):
+            shard = dataset.shard(num_shards=num_shards, index=index, contiguous=True)
+            shard.to_parquet(os.path.join(output_dir, f"part-{index:05d}.parquet"))
+        return output_dir
+
+    dataset.to_json(jsonl_path, lines=True, num_proc=NUM_PROC)
+    return jsonl_path
+
+
 # --- Main Pre-processing Logic ---
 def prepare_dataset():
     """
-    Downloads the dataset, filters for high-quality records, and saves two files:
+    Downloads the dataset, filters for high-quality records, and saves two outputs:
     1. All high-quality records, preserving their original structure.
     2. A subset of (1) containing only problems with simple integer answers.
+    Filtering runs as batched datasets.filter calls across NUM_PROC processes, so rows stay
+    in Arrow the whole way and are only serialized once, when written.
     """
     print(f"--- Starting Data Preparation (Dual Output) ---")
     os.makedirs(HF_CACHE_DIR, exist_ok=True)
@@ -58,65 +255,55 @@ def prepare_dataset():
         print(f"FATAL: Could not load dataset. Error: {e}")
         return
 
-    # --- MODIFIED: Two counters for two output files ---
-    records_written_all = 0
-    records_written_numeric = 0
-    
-    print(f"Filtering records and writing to two files:")
-    print(f"  - All high-quality records: {OUTPUT_FILE_ALL}")
-    print(f"  - Numeric-only subset:      {OUTPUT_FILE_NUMERIC}")
-
-    # --- MODIFIED: Open both files for writing ---
-    with open(OUTPUT_FILE_ALL, 'w', encoding='utf-8') as f_all, \
-         open(OUTPUT_FILE_NUMERIC, 'w', encoding='utf-8') as f_numeric:
-        
-        for problem_data in tqdm(ds, desc="Filtering Problems"):
-            
-            # Stage 1: "Gatekeeper" logic for overall quality (unchanged)
-            is_record_valid = False
-
-            solution_text = problem_data.get('solution')
-            if solution_text and isinstance(solution_text, str) and len(solution_text) > 100:
-                is_record_valid = True
-
-            if not is_record_valid:
-                generations = problem_data.get('generations', [])
-                correctness_flags = problem_data.get('correctness_math_verify', [])
-                
-                if generations and correctness_flags and len(generations) == len(correctness_flags):
-                    for i, is_correct in enumerate(correctness_flags):
-                        if is_correct:
-                            generation_text = generations[i]
-                            if isinstance(generation_text, str) and len(generation_text) > 100:
-                                is_record_valid = True
-                                break
-
-            # If the record is not high-quality, skip it entirely.
-            if not is_record_valid:
-                continue
-            
-            # --- Stage 2: Write to files based on the new filter ---
-            
-            # Prepare the record for writing (same as before)
-            output_record = problem_data.copy()
-            output_record.pop('messages', None)
-            record_as_json_string = json.dumps(output_record) + '\n'
-
-            # Action 1: Every valid, high-quality record gets written to the main file.
-            f_all.write(record_as_json_string)
-            records_written_all += 1
-            
-            # Action 2: Apply the new numeric filter.
-            answer = problem_data.get('answer')
-            if is_simple_numeric_answer(answer):
-                # If it passes, also write it to the numeric-only subset file.
-                f_numeric.write(record_as_json_string)
-                records_written_numeric += 1
+    # The chat-formatted 'messages' column is not needed downstream.
+    if 'messages' in ds.column_names:
+        ds = ds.remove_columns('messages')
+
+    print(f"Filtering records with {NUM_PROC} processes (batch size {FILTER_BATCH_SIZE})...")
+
+    # Stage 1: "Gatekeeper" logic for overall quality (unchanged)
+    high_quality_ds = ds.filter(
+        filter_high_quality_batch,
+        input_columns=['solution', 'generations', 'correctness_math_verify'],
+        batched=True,
+        batch_size=FILTER_BATCH_SIZE,
+        num_proc=NUM_PROC,
+        desc="Filtering Problems",
+    )
+
+    # Stage 1.5: near-duplicate clustering; only one record per cluster continues to the numeric subset
+    unique_ds = high_quality_ds
+    if DEDUP_ENABLED:
+        print(f"Clustering near-duplicate problems (MinHash {DEDUP_NUM_PERM} perms, {DEDUP_BANDS} bands, threshold {DEDUP_THRESHOLD})...")
+        high_quality_ds, keep_indices, dedup_counts = add_dedup_clusters(high_quality_ds)
+        unique_ds = high_quality_ds.select(keep_indices)
+        removed = len(high_quality_ds) - len(unique_ds)
+        print(f"  - {dedup_counts['exact_duplicates']} exact and {dedup_counts['near_duplicates']} near duplicates: "
+              f"{removed} of {len(high_quality_ds)} records removed ({removed / max(len(high_quality_ds), 1) * 100:.1f}%), "
+              f"{dedup_counts['candidate_pairs_checked']} LSH candidate pairs checked")
+
+    # Stage 2: the numeric-only subset of the (deduplicated) high-quality records
+    numeric_ds = unique_ds.filter(
+        filter_numeric_batch,
+        input_columns=['answer'],
+        batched=True,
+        batch_size=FILTER_BATCH_SIZE,
+        num_proc=NUM_PROC,
+        desc="Filtering Numeric Answers",
+    )
+
+    print(f"Writing {OUTPUT_FORMAT} outputs:")
+    output_all = write_dataset(high_quality_ds, OUTPUT_FILE_ALL)
+    print(f"  - All high-quality records: {output_all}")
+    output_numeric = write_dataset(numeric_ds, OUTPUT_FILE_NUMERIC)
+    print(f"  - Numeric-only subset:      {output_numeric}")
             
     print(f"\n✅ Filtering complete.")
     print(f"  - Total problems read: {total_problems_to_process}")
-    print(f"  - Total high-quality records saved to '{os.path.basename(OUTPUT_FILE_ALL)}': {records_written_all}")
-    print(f"  - Numeric-only records saved to '{os.path.basename(OUTPUT_FILE_NUMERIC)}': {records_written_numeric}")
+    print(f"  - Total high-quality records saved to '{os.path.basename(output_all)}': {len(high_quality_ds)}")
+    if DEDUP_ENABLED:
+        print(f"  - Unique problems after deduplication: {len(unique_ds)} (clusters: 'dedup_cluster_id' in '{os.path.basename(output_all)}')")
+    print(f"  - Numeric-only records saved to '{os.path.basename(output_numeric)}': {len(numeric_ds)}")
 
 if __name__ == "__main__":
     prepare_dataset()
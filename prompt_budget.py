@@ -0,0 +1,172 @@
+import collections
+import hashlib
+import threading
+
+from llm_client import estimate_prompt_tokens
+
+# --- Token budgeting of quiz-generation prompts ---
+# generate_quizzes.py puts the reference solution and the R1 generations of a record into one prompt.
+# Some OpenR1 records carry several very long generations, which makes prompts slow and expensive or
+# overflows the context. PromptBudgeter picks reasoning sources in order of trust -- the reference
+# solution, generations verified by correctness_math_verify, then unverified generations -- while they
+# fit the budget, and trims the source that crosses it (keeping its beginning and its conclusion).
+# The chosen sources keep their dataset order in the prompt, so a record that fits the budget gets
+# exactly the prompt (and response-cache key) it had before budgeting.
+#
+# Token counts come from the model's Hugging Face tokenizer when one is named (needs `transformers`),
+# otherwise from the ~4 characters per token estimate used for rate budgeting. Counts are cached by
+# content hash, so re-driven or resumed records are not tokenized twice.
+
+SOURCE_SEPARATOR = "\n\n---\n\n"
+TRIM_MARKER = "\n\n[... {omitted} tokens omitted ...]\n\n"
+MIN_SOURCE_CHARS = 100  # shorter solutions/generations are not useful reasoning sources
+TRIM_HEAD_SHARE = 0.25  # share of a trimmed source kept from its start; the rest comes from its end (the conclusion)
+
+
+class TokenCounter:
+    """Thread-safe token counter with an LRU cache keyed by a hash of the text."""
+
+    def __init__(self, tokenizer_name=None, cache_size=100_000):
+        self.tokenizer_name = tokenizer_name
+        self.cache_size = cache_size
+        self._tokenizer = None
+        self._counts = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def tokenizer(self):
+        if self.tokenizer_name and self._tokenizer is None:
+            with self._lock:
+                if self._tokenizer is None:
+                    from transformers import AutoTokenizer  # only needed when a tokenizer is configured
+                    self._tokenizer = AutoTokenizer.from_pretrained(self.tokenizer_name)
+        return self._tokenizer
+
+    def encode(self, text):
+        return self.tokenizer.encode(text, add_special_tokens=False)
+
+    def count(self, text):
+        key = hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+        with self._lock:
+            cached = self._counts.get(key)
+            if cached is not None:
+                self._counts.move_to_end(key)
+                self.hits += 1
+                return cached
+            self.misses += 1
+        tokens = len(self.encode(text)) if self.tokenizer is not None else estimate_prompt_tokens(text)
+        with self._lock:
+            self._counts[key] = tokens
+            if len(self._counts) > self.cache_size:
+                self._counts.popitem(last=False)
+        return tokens
+
+    def trim(self, text, max_tokens):
+        """Cuts the middle out of `text` so it fits `max_tokens`, marking how much was left out."""
+        total = self.count(text)
+        if total <= max_tokens:
+            return text
+        marker = TRIM_MARKER.format(omitted=total - max_tokens)
+        keep = max(max_tokens - self.count(marker), 0)
+        head = int(keep * TRIM_HEAD_SHARE)
+        tail = keep - head
+        if self.tokenizer is not None:
+            ids = self.encode(text)
+            return self.tokenizer.decode(ids[:head]) + marker + (self.tokenizer.decode(ids[-tail:]) if tail else "")
+        return text[:head * 4] + marker + (text[-tail * 4:] if tail else "")
+
+    def stats(self):
+        with self._lock:
+            return {"tokenizer": self.tokenizer_name or "estimate", "cached_texts": len(self._counts),
+                    "hits": self.hits, "misses": self.misses}
+
+
+def reasoning_candidates(problem_data):
+    """
+    (priority, text) of every usable reasoning source of a record in dataset order (solution first).
+    Priority is the trust level: the solution (0), generations verified by correctness_math_verify (1),
+    then the other generations (2).
+    """
+    candidates = []
+    solution_text = problem_data.get('solution')
+    if solution_text and isinstance(solution_text, str) and len(solution_text) > MIN_SOURCE_CHARS:
+        candidates.append((0, solution_text))
+
+    generations = problem_data.get('generations') or []
+    correctness_flags = problem_data.get('correctness_math_verify') or []
+    if len(correctness_flags) != len(generations):
+        correctness_flags = [False] * len(generations)
+    for gen_text, is_correct in zip(generations, correctness_flags):
+        if gen_text and isinstance(gen_text, str) and len(gen_text) > MIN_SOURCE_CHARS:
+            candidates.append((1 if is_correct else 2, gen_text))
+    return candidates
+
+
+class PromptBudgeter:
+    """
+    Chooses the reasoning sources of a quiz prompt under a token budget and keeps totals of what was
+    saved. `budget` covers the whole prompt; None sends every usable source, as without budgeting.
+    """
+
+    def __init__(self, counter, budget=None, include_unverified=True, min_trimmed_tokens=1024):
+        self.counter = counter
+        self.budget = budget
+        self.include_unverified = include_unverified
+        self.min_trimmed_tokens = min_trimmed_tokens
+        self._lock = threading.Lock()
+        self._totals = collections.Counter()
+
+    def select(self, problem_data, base_prompt):
+        """
+        Returns the source texts to join with SOURCE_SEPARATOR into the prompt, in dataset order.
+        `base_prompt` is the prompt rendered without sources; its tokens count against the budget.
+        """
+        all_candidates = reasoning_candidates(problem_data)
+        if self.budget is None:
+            return [text for _, text in all_candidates]
+        # Most trusted first; the stable sort keeps dataset order within a priority.
+        candidates = [(position, text) for position, (priority, text) in enumerate(all_candidates)
+                      if self.include_unverified or priority < 2]
+        candidates.sort(key=lambda candidate: all_candidates[candidate[0]][0])
+        if not candidates:
+            return []
+
+        separator_tokens = self.counter.count(SOURCE_SEPARATOR)
+        remaining = self.budget - self.counter.count(base_prompt)
+        chosen, dropped, trimmed = {}, len(all_candidates) - len(candidates), 0
+        for position, text in candidates:
+            cost = self.counter.count(text) + (separator_tokens if chosen else 0)
+            if cost <= remaining:
+                chosen[position] = text
+                remaining -= cost
+            elif remaining >= self.min_trimmed_tokens or not chosen:
+                # The most trusted source that does not fit gets the rest of the budget rather than
+                # being displaced by a shorter, less trusted one.
+                room = max(remaining - (separator_tokens if chosen else 0), self.min_trimmed_tokens)
+                chosen[position] = self.counter.trim(text, room)
+                remaining = 0
+                trimmed += 1
+            else:
+                dropped += 1
+        selected = [chosen[position] for position in sorted(chosen)]
+
+        with self._lock:
+            self._totals["records"] += 1
+            self._totals["records_reduced"] += bool(dropped or trimmed)
+            self._totals["sources_dropped"] += dropped
+            self._totals["sources_trimmed"] += trimmed
+            self._totals["source_tokens_available"] += sum(self.counter.count(text) for _, text in all_candidates)
+            self._totals["source_tokens_sent"] += sum(self.counter.count(text) for text in selected)
+        return selected
+
+    def stats(self):
+        with self._lock:
+            totals = dict(self._totals)
+        available = totals.get("source_tokens_available", 0)
+        saved = available - totals.get("source_tokens_sent", 0)
+        totals["source_tokens_saved"] = saved
+        totals["saved_percent"] = round(100.0 * saved / available, 1) if available else 0.0
+        totals["token_counts"] = self.counter.stats()
+        return totals
@@ -147,3 +147,22 @@ QUIZ_GRADING_PROMPT = """
 **Reasoner Trace:**
 {reasoner_trace_text}
 """
+
+QUIZ_BATCH_GRADING_PROMPT = """
+**Objective:** Evaluate each of the "Reasoner Traces" below against the "Quiz JSON" and provide a score for each one.
+**Instructions:**
+1.  Read each question in the Quiz JSON.
+2.  For every trace separately, find evidence in that trace to determine if the logic described in the correct option was followed. Grade each trace on its own; never let one trace influence the grading of another.
+3.  Your output MUST be a single, valid JSON array with NO other text, containing exactly one object per trace, in trace order. Each object must contain:
+    - "Trace": The trace number (integer) as labelled below.
+    - "Score": The total reward score summed from all correctly answered questions.
+    - "Correct_Questions": A list of question numbers (integers) that were answered correctly.
+    - "Wrong_Questions": A list of question numbers (integers) that were answered incorrectly.
+    - "Reason_for_Failure": A brief explanation ONLY if the score is less than 1.0.
+
+**Quiz JSON:**
+{quiz_json_text}
+
+**Reasoner Traces ({num_traces} in total):**
+{reasoner_traces_text}
+"""
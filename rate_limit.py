@@ -0,0 +1,168 @@
+import asyncio
+import collections
+import threading
+import time
+
+# --- Adaptive concurrency and rate limiting for API clients ---
+# Used by llm_client.LLMClient. Works for both thread-pool callers (generate_quizzes.py) and
+# asyncio callers (generate_traces_and_grade.py in "async" mode).
+
+
+class TokenBucket:
+    """
+    Refills at `rate_per_minute` up to `capacity`. `reserve` debits immediately and returns how
+    long the caller must wait before using what it took, so the balance may go negative.
+    """
+
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate_per_second = rate_per_minute / 60.0
+        self.capacity = capacity or rate_per_minute
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill_locked(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate_per_second)
+        self.updated = now
+
+    def reserve(self, amount):
+        with self._lock:
+            self._refill_locked()
+            self.tokens -= amount
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate_per_second
+
+    def adjust(self, amount):
+        """Debits (or refunds, if negative) tokens after the fact, e.g. once real usage is known."""
+        with self._lock:
+            self._refill_locked()
+            self.tokens = min(self.capacity, self.tokens - amount)
+
+
+class AdaptiveLimiter:
+    """
+    AIMD concurrency control: every successful request raises the in-flight limit by about one
+    per window of completed requests; a 429, a server error or latency above `latency_target`
+    cuts it by `decrease_factor` (at most once per `cooldown` seconds, so one burst of errors
+    counts once). Optional requests-per-minute and tokens-per-minute buckets are enforced
+    before a slot is taken.
+    """
+
+    CONGESTION_OUTCOMES = ("rate_limited", "server_error", "timeout")
+
+    def __init__(self, initial_concurrency=8, min_concurrency=1, max_concurrency=64,
+                 decrease_factor=0.5, cooldown=2.0, latency_target=None,
+                 requests_per_minute=None, tokens_per_minute=None):
+        self.limit = float(max(min_concurrency, min(initial_concurrency, max_concurrency)))
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.decrease_factor = decrease_factor
+        self.cooldown = cooldown
+        self.latency_target = latency_target
+        self.request_bucket = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.token_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+
+        self.in_flight = 0
+        self.latency_ewma = None
+        self.outcomes = collections.Counter()
+        self.decreases = 0
+        self.peak_limit = self.limit
+        self.lowest_limit = self.limit
+        self._last_decrease = 0.0
+        self._cond = threading.Condition()
+        self._async_waiters = collections.deque()
+
+    # --- Acquire / release ---
+
+    def _bucket_delay(self, estimated_tokens):
+        delay = 0.0
+        if self.request_bucket:
+            delay = max(delay, self.request_bucket.reserve(1))
+        if self.token_bucket and estimated_tokens:
+            delay = max(delay, self.token_bucket.reserve(estimated_tokens))
+        return delay
+
+    def acquire(self, estimated_tokens=0):
+        """Blocks the calling thread until the rate buckets and the concurrency limit allow a request."""
+        delay = self._bucket_delay(estimated_tokens)
+        if delay > 0:
+            time.sleep(delay)
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                self._cond.wait()
+            self.in_flight += 1
+
+    async def acquire_async(self, estimated_tokens=0):
+        """Async version of `acquire`; waits without blocking the event loop."""
+        delay = self._bucket_delay(estimated_tokens)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._cond:
+                if self.in_flight < int(self.limit):
+                    self.in_flight += 1
+                    return
+                waiter = loop.create_future()
+                self._async_waiters.append((loop, waiter))
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                # Pass a wake-up we may have consumed on to the next waiter.
+                with self._cond:
+                    self._wake_locked()
+                raise
+
+    def release(self, outcome, latency, used_tokens=0, estimated_tokens=0):
+        """
+        Frees the slot and feeds the result back into the limit. `outcome` is "ok" or an error
+        class from llm_client.classify_error; `used_tokens` reconciles the token bucket.
+        """
+        if self.token_bucket and used_tokens:
+            self.token_bucket.adjust(used_tokens - estimated_tokens)
+        with self._cond:
+            self.in_flight -= 1
+            self.outcomes[outcome] += 1
+            if outcome == "ok":
+                self.latency_ewma = latency if self.latency_ewma is None else 0.9 * self.latency_ewma + 0.1 * latency
+                if self.latency_target and self.latency_ewma > self.latency_target:
+                    self._decrease_locked()
+                else:
+                    self.limit = min(self.max_concurrency, self.limit + 1.0 / self.limit)
+            elif outcome in self.CONGESTION_OUTCOMES:
+                self._decrease_locked()
+            self.peak_limit = max(self.peak_limit, self.limit)
+            self._wake_locked()
+
+    def _decrease_locked(self):
+        now = time.monotonic()
+        if now - self._last_decrease < self.cooldown:
+            return
+        self._last_decrease = now
+        self.limit = max(self.min_concurrency, self.limit * self.decrease_factor)
+        self.lowest_limit = min(self.lowest_limit, self.limit)
+        self.decreases += 1
+
+    def _wake_locked(self):
+        self._cond.notify_all()
+        free_slots = int(self.limit) - self.in_flight
+        while free_slots > 0 and self._async_waiters:
+            loop, waiter = self._async_waiters.popleft()
+            loop.call_soon_threadsafe(_resolve_waiter, waiter)
+            free_slots -= 1
+
+    def stats(self):
+        with self._cond:
+            return {
+                "concurrency_limit": round(self.limit, 2),
+                "peak_concurrency_limit": round(self.peak_limit, 2),
+                "lowest_concurrency_limit": round(self.lowest_limit, 2),
+                "decreases": self.decreases,
+                "latency_ewma_seconds": round(self.latency_ewma, 3) if self.latency_ewma is not None else None,
+                "outcomes": dict(self.outcomes),
+            }
+
+
+def _resolve_waiter(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
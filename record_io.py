@@ -0,0 +1,220 @@
+import glob
+import json
+import os
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from slice_jsons import iter_lines_in_range, count_lines_in_range
+
+# --- Record I/O shared by all pipeline stages ---
+# A "records path" is one of:
+#   * a .jsonl file (the original format; supports INPUT_BYTE_RANGE shards),
+#   * a Parquet file, or a directory of part-*.parquet files (e.g. "quizzes.parquet" or "quizzes_parquet"),
+#   * an Arrow IPC file, or a directory of part-*.arrow files (e.g. "quizzes.arrow" or "quizzes_arrow").
+# Columnar formats let a stage read only the columns it needs (`columns=`); Parquet pages and
+# Arrow IPC files are memory-mapped, so unread columns are never touched.
+#
+# Nested values (dicts and lists) are stored as JSON strings in columnar files, since records such
+# as quiz outputs do not share one stable nested schema. The names of those columns are kept in the
+# schema metadata, and `iter_records` decodes them transparently.
+
+JSON_COLUMNS_METADATA_KEY = b"qmath.json_columns"
+PART_EXTENSIONS = {"parquet": ".parquet", "arrow": ".arrow"}
+
+
+def detect_format(path):
+    """Returns "jsonl", "parquet" or "arrow" for a records path."""
+    lowered = path.lower().rstrip('/\\')
+    if lowered.endswith(('.parquet', '_parquet')):
+        return "parquet"
+    if lowered.endswith(('.arrow', '.feather', '_arrow')):
+        return "arrow"
+    if os.path.isdir(path):
+        for fmt, extension in PART_EXTENSIONS.items():
+            if glob.glob(os.path.join(path, f"*{extension}")):
+                return fmt
+    return "jsonl"
+
+
+def list_part_files(path, fmt):
+    if os.path.isdir(path):
+        return sorted(glob.glob(os.path.join(path, f"*{PART_EXTENSIONS[fmt]}")))
+    return [path] if os.path.exists(path) else []
+
+
+def _json_columns(schema):
+    raw = (schema.metadata or {}).get(JSON_COLUMNS_METADATA_KEY)
+    return set(json.loads(raw)) if raw else set()
+
+
+def _rows_from_table(table, columns):
+    json_columns = _json_columns(table.schema)
+    if columns:
+        table = table.select([c for c in columns if c in table.column_names])
+    for row in table.to_pylist():
+        for name in json_columns.intersection(row):
+            if row[name] is not None:
+                row[name] = json.loads(row[name])
+        if columns:
+            for name in columns:
+                row.setdefault(name, None)
+        yield row
+
+
+def iter_records(path, columns=None, byte_range=None, batch_size=1024):
+    """
+    Yields records (dicts) from a records path. `columns` restricts the fields read (missing ones
+    come back as None); `byte_range` selects a slice_jsons.py shard and only applies to JSONL.
+    """
+    fmt = detect_format(path)
+    if fmt == "jsonl":
+        for line in iter_lines_in_range(path, byte_range):
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            yield {name: record.get(name) for name in columns} if columns else record
+        return
+
+    if byte_range is not None:
+        raise ValueError(f"Byte-range shards only apply to JSONL inputs, not {fmt} ('{path}').")
+
+    for part in list_part_files(path, fmt):
+        if fmt == "parquet":
+            parquet_file = pq.ParquetFile(part, memory_map=True)
+            available = parquet_file.schema_arrow.names
+            projection = [c for c in columns if c in available] if columns else None
+            for batch in parquet_file.iter_batches(batch_size=batch_size, columns=projection):
+                table = pa.Table.from_batches([batch]).replace_schema_metadata(parquet_file.schema_arrow.metadata)
+                yield from _rows_from_table(table, columns)
+        else:
+            with pa.memory_map(part, 'r') as source:
+                reader = pa.ipc.open_file(source)
+                for i in range(reader.num_record_batches):
+                    table = pa.Table.from_batches([reader.get_batch(i)]).replace_schema_metadata(reader.schema.metadata)
+                    yield from _rows_from_table(table, columns)
+
+
+def count_records(path, byte_range=None):
+    """Number of records, read from file metadata for columnar formats."""
+    fmt = detect_format(path)
+    if fmt == "jsonl":
+        return count_lines_in_range(path, byte_range)
+    if byte_range is not None:
+        raise ValueError(f"Byte-range shards only apply to JSONL inputs, not {fmt} ('{path}').")
+    total = 0
+    for part in list_part_files(path, fmt):
+        if fmt == "parquet":
+            total += pq.ParquetFile(part).metadata.num_rows
+        else:
+            with pa.memory_map(part, 'r') as source:
+                reader = pa.ipc.open_file(source)
+                total += sum(reader.get_batch(i).num_rows for i in range(reader.num_record_batches))
+    return total
+
+
+# --- Writers ---
+
+class JsonlRecordWriter:
+    def __init__(self, path, mode='w'):
+        self.path = path
+        self._file = open(path, mode, encoding='utf-8')
+
+    def write(self, record):
+        self._file.write(json.dumps(record) + '\n')
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ColumnarRecordWriter:
+    """
+    Writes records as numbered part files (part-00000.parquet, ...) in a directory, `rows_per_part`
+    records at a time. Each part is written to a temporary name and renamed when complete, so a
+    crash never leaves a truncated part behind and append mode (resume) just adds new parts.
+    """
+
+    def __init__(self, path, fmt, mode='w', rows_per_part=1000):
+        self.path = path
+        self.fmt = fmt
+        self.rows_per_part = rows_per_part
+        self._buffer = []
+        os.makedirs(path, exist_ok=True)
+        for leftover in glob.glob(os.path.join(path, "*.tmp")):
+            os.remove(leftover)
+        existing = list_part_files(path, fmt)
+        if mode == 'w':
+            for part in existing:
+                os.remove(part)
+            existing = []
+        self._next_part = len(existing)
+        while os.path.exists(self._part_path(self._next_part)):
+            self._next_part += 1
+
+    def _part_path(self, index):
+        return os.path.join(self.path, f"part-{index:05d}{PART_EXTENSIONS[self.fmt]}")
+
+    def write(self, record):
+        self._buffer.append(record)
+        if len(self._buffer) >= self.rows_per_part:
+            self.flush()
+
+    def _build_table(self, rows):
+        names = []
+        for row in rows:
+            names.extend(name for name in row if name not in names)
+        arrays, json_columns = {}, []
+        for name in names:
+            values = [row.get(name) for row in rows]
+            if any(isinstance(v, (dict, list)) for v in values):
+                values, array = [None if v is None else json.dumps(v) for v in values], None
+            else:
+                try:
+                    array = pa.array(values)
+                except (pa.ArrowInvalid, pa.ArrowTypeError):
+                    # Mixed scalar types in one column: keep them exactly by storing JSON.
+                    values, array = [None if v is None else json.dumps(v) for v in values], None
+            if array is None:
+                array = pa.array(values, type=pa.string())
+                json_columns.append(name)
+            arrays[name] = array
+        table = pa.table(arrays)
+        return table.replace_schema_metadata({JSON_COLUMNS_METADATA_KEY: json.dumps(json_columns)})
+
+    def flush(self):
+        if not self._buffer:
+            return
+        table = self._build_table(self._buffer)
+        final_path = self._part_path(self._next_part)
+        tmp_path = final_path + ".tmp"
+        if self.fmt == "parquet":
+            pq.write_table(table, tmp_path, compression="zstd")
+        else:
+            with pa.OSFile(tmp_path, 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        os.replace(tmp_path, final_path)
+        self._next_part += 1
+        self._buffer = []
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def open_record_writer(path, mode='w', rows_per_part=1000):
+    """Opens a writer for `path` in the format implied by its name (see module comment)."""
+    fmt = detect_format(path)
+    if fmt == "jsonl":
+        return JsonlRecordWriter(path, mode)
+    return ColumnarRecordWriter(path, fmt, mode, rows_per_part)
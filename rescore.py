@@ -0,0 +1,148 @@
+import argparse
+import collections
+import json
+import multiprocessing
+import os
+import sys
+import time
+from datetime import datetime
+
+from answer_check import extract_boxed_answer, normalize_and_compare_answers
+from run_stats import RunStatsAccumulator, write_overview
+
+# --- Offline re-scoring of run_details.jsonl ---
+# Recomputes `extracted_answer` and `is_correct` for every graded trace with the current
+# answer_check.py (no API calls), rewrites the details file atomically and regenerates
+# run_overview.json. Lines are shipped to a process pool in chunks of raw bytes, and records
+# whose answer did not change are written back byte for byte without re-serialising them.
+#
+#   python rescore.py results/run_xxx/run_details.jsonl [more run_details.jsonl ...] [-j 16]
+
+
+def rescore_record(record):
+    """Updates one record in place; returns True if `extracted_answer` or `is_correct` changed."""
+    extracted_answer = extract_boxed_answer(record.get('reason_trace'))
+    is_correct = normalize_and_compare_answers(extracted_answer, [record.get('ground_truth_answer')])
+    changed = extracted_answer != record.get('extracted_answer') or is_correct != record.get('is_correct')
+    record['extracted_answer'] = extracted_answer
+    record['is_correct'] = is_correct
+    return changed
+
+
+def rescore_chunk(lines):
+    """
+    Worker: re-scores a list of raw JSONL lines. Returns (output bytes, stats for the chunk,
+    counts of changed records and of records whose is_correct flipped).
+    """
+    stats = RunStatsAccumulator()
+    out = []
+    changed = flipped = 0
+    for line in lines:
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        was_correct = record.get('is_correct')
+        if rescore_record(record):
+            changed += 1
+            flipped += record['is_correct'] != was_correct
+            line = (json.dumps(record) + '\n').encode('utf-8')
+        elif not line.endswith(b'\n'):
+            line += b'\n'
+        out.append(line)
+        stats.add(record)
+    return b''.join(out), stats, changed, flipped
+
+
+def iter_line_chunks(path, chunk_lines):
+    with open(path, 'rb') as f:
+        chunk = []
+        for line in f:
+            chunk.append(line)
+            if len(chunk) >= chunk_lines:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+
+def rescore_details_file(pool, processes, details_file, output_file=None, chunk_lines=2000, max_chunks_in_flight=None, dry_run=False):
+    """
+    Re-scores one run_details.jsonl through `pool` (created with `processes` workers). Chunks are
+    collected in submission order, and at most `max_chunks_in_flight` (default 4 per worker) are
+    outstanding so memory stays bounded on very large files.
+    """
+    output_file = output_file or details_file
+    overview_file = os.path.join(os.path.dirname(output_file), "run_overview.json")
+    max_chunks_in_flight = max_chunks_in_flight or processes * 4
+    tmp_file = output_file + ".rescore.tmp"
+
+    stats = RunStatsAccumulator()
+    totals = collections.Counter()
+    start = time.monotonic()
+    pending = collections.deque()
+    f_out = None if dry_run else open(tmp_file, 'wb')
+    try:
+        def collect_oldest():
+            data, chunk_stats, changed, flipped = pending.popleft().get()
+            if f_out:
+                f_out.write(data)
+            stats.merge(chunk_stats)
+            totals.update(changed=changed, flipped=flipped)
+
+        for chunk in iter_line_chunks(details_file, chunk_lines):
+            pending.append(pool.apply_async(rescore_chunk, (chunk,)))
+            if len(pending) >= max_chunks_in_flight:
+                collect_oldest()
+        while pending:
+            collect_oldest()
+    except BaseException:
+        if f_out:
+            f_out.close()
+            os.remove(tmp_file)
+        raise
+    if f_out:
+        f_out.close()
+        os.replace(tmp_file, output_file)
+
+    elapsed = time.monotonic() - start
+    traces = stats.overall.traces
+    print(f"-> {details_file}: {traces} traces in {elapsed:.1f}s ({traces / elapsed * 60 if elapsed else 0:,.0f}/min), "
+          f"{totals['changed']} answers changed, {totals['flipped']} is_correct flipped, accuracy now {stats.overall.accuracy:.2f}%")
+    if dry_run:
+        return stats
+
+    run_info = None
+    if os.path.exists(overview_file):
+        with open(overview_file, 'r', encoding='utf-8') as f:
+            run_info = json.load(f).get("run_info") or {}
+        run_info["rescored"] = {"timestamp": datetime.now().strftime("%Y%m%d_%H%M%S"), "answers_changed": totals['changed'], "is_correct_flipped": totals['flipped']}
+    write_overview(stats, overview_file, run_info)
+    print(f"   Overview regenerated: {overview_file}")
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-score extracted answers in run_details.jsonl files offline and regenerate their overviews.")
+    parser.add_argument("details_files", nargs='+', help="run_details.jsonl files to re-score (rewritten in place).")
+    parser.add_argument("-o", "--output", default=None, help="Write the re-scored details here instead (single input only); the overview goes next to it.")
+    parser.add_argument("-j", "--processes", type=int, default=os.cpu_count(), help="Worker processes (default: all CPUs).")
+    parser.add_argument("--chunk-lines", type=int, default=2000, help="Records per work unit sent to a worker (default: 2000).")
+    parser.add_argument("--dry-run", action="store_true", help="Only report what would change; write nothing.")
+    args = parser.parse_args()
+
+    if args.output and len(args.details_files) > 1:
+        print("Error: --output only works with a single input file.")
+        sys.exit(1)
+    missing = [path for path in args.details_files if not os.path.exists(path)]
+    if missing:
+        print(f"Error: File not found: {', '.join(missing)}")
+        sys.exit(1)
+
+    processes = args.processes or os.cpu_count() or 1
+    with multiprocessing.Pool(processes) as pool:
+        for details_file in args.details_files:
+            rescore_details_file(pool, processes, details_file, args.output, args.chunk_lines, dry_run=args.dry_run)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+
+from slice_jsons import load_or_build_line_index, compute_shards
+from run_stats import rebuild_overview
+from record_io import detect_format
+
+# --- Multi-process shard driver ---
+# Splits an input file into byte-range shards (no copies, see slice_jsons.py) and runs one worker
+# process per shard, each with its own output file, then merges the shard outputs.
+#
+#   python run_shards.py quizzes INPUT.jsonl -n 4 -o data/with_quizzes
+#   python run_shards.py grade   INPUT_WITH_QUIZZES.jsonl -n 4 -o results/run_sharded
+#
+# Any module-level setting of the stage script can be overridden per run with --set, e.g.
+#   --set CONCURRENT_REQUESTS=20 --set EXECUTION_MODE='"sequential"'
+# (values are parsed as JSON; settings read at import time, like LLM_CACHE_PATH, are not affected).
+#
+# All shards call the same endpoints, so the stage's request limits (concurrency, initial concurrency
+# and requests/tokens per minute, including --set values) are treated as totals and divided by the
+# number of shards, with at least 1 request in flight per shard and role. --no-split-limits gives every
+# shard the full limits (e.g. when each shard is pointed at its own servers).
+
+LIMIT_INTEGER_FIELDS = ("initial_concurrency",)  # ADAPTIVE_RATE_LIMITS fields split into whole requests
+LIMIT_RATE_FIELDS = ("requests_per_minute", "tokens_per_minute")
+
+
+def parse_overrides(pairs):
+    overrides = {}
+    for pair in pairs or []:
+        name, _, raw_value = pair.partition('=')
+        try:
+            overrides[name] = json.loads(raw_value)
+        except json.JSONDecodeError:
+            overrides[name] = raw_value  # bare strings need no quoting
+    return overrides
+
+
+def apply_overrides(module, overrides):
+    for name, value in overrides.items():
+        if not hasattr(module, name):
+            raise ValueError(f"{module.__name__} has no setting named '{name}'")
+        setattr(module, name, value)
+
+
+def split_limit(value, divisor, integer=True):
+    if value is None or divisor == 1:
+        return value
+    return max(1, int(value) // divisor) if integer else value / divisor
+
+
+def split_quiz_limits(stage, divisor):
+    """Divides generate_quizzes' request limits by `divisor` and rebuilds its rate limiter."""
+    stage.CONCURRENT_REQUESTS = split_limit(stage.CONCURRENT_REQUESTS, divisor)
+    stage.INITIAL_CONCURRENCY = split_limit(stage.INITIAL_CONCURRENCY, divisor)
+    stage.REQUESTS_PER_MINUTE = split_limit(stage.REQUESTS_PER_MINUTE, divisor, integer=False)
+    stage.TOKENS_PER_MINUTE = split_limit(stage.TOKENS_PER_MINUTE, divisor, integer=False)
+    stage.client.reset_limiter(stage.rate_limiter_settings())
+    stage.RATE_LIMITER = stage.client.limiter
+
+
+def split_grade_limits(stage, divisor):
+    """Divides generate_traces_and_grade's per-role limits by `divisor` and rebuilds the clients' rate limiters."""
+    stage.CONCURRENCY_LIMITS = {key: split_limit(limit, divisor) for key, limit in stage.CONCURRENCY_LIMITS.items()}
+    stage.ADAPTIVE_RATE_LIMITS = {
+        key: {name: split_limit(value, divisor, integer=name in LIMIT_INTEGER_FIELDS)
+              if name in LIMIT_INTEGER_FIELDS + LIMIT_RATE_FIELDS else value
+              for name, value in settings.items()}
+        for key, settings in stage.ADAPTIVE_RATE_LIMITS.items()
+    }
+    stage.RATE_LIMITER_SETTINGS = stage.rate_limiter_settings()
+    for key, client in stage.API_CLIENTS.items():
+        client.reset_limiter(stage.RATE_LIMITER_SETTINGS.get(key))
+
+
+def shard_name(shard, num_shards):
+    return f"shard_{str(shard).zfill(len(str(num_shards - 1)))}"
+
+
+# --- Workers (run in child processes) ---
+
+def run_quiz_shard(input_file, byte_range, output_file, overrides, resume, limit_divisor):
+    import generate_quizzes
+    apply_overrides(generate_quizzes, overrides)
+    split_quiz_limits(generate_quizzes, limit_divisor)
+    generate_quizzes.INPUT_FILE = input_file
+    generate_quizzes.INPUT_BYTE_RANGE = byte_range
+    generate_quizzes.OUTPUT_FILE = output_file
+    generate_quizzes.RESUME = resume
+    generate_quizzes.generate_quizzes_from_jsonl()
+
+
+def run_grade_shard(input_file, byte_range, shard_dir, overrides, resume, limit_divisor):
+    import generate_traces_and_grade
+    apply_overrides(generate_traces_and_grade, overrides)
+    split_grade_limits(generate_traces_and_grade, limit_divisor)
+    generate_traces_and_grade.INPUT_FILE = input_file
+    generate_traces_and_grade.INPUT_BYTE_RANGE = byte_range
+    generate_traces_and_grade.OUTPUT_BASE_DIR = shard_dir
+    generate_traces_and_grade.OUTPUT_DETAILS_FILE = os.path.join(shard_dir, "run_details.jsonl")
+    generate_traces_and_grade.OUTPUT_OVERVIEW_FILE = os.path.join(shard_dir, "run_overview.json")
+    generate_traces_and_grade.RESUME_RUN_DIR = shard_dir if resume else None
+    generate_traces_and_grade.run_full_evaluation()
+
+
+def launch_workers(target, jobs):
+    """Starts one process per job and waits for all of them. Returns the exit codes."""
+    ctx = multiprocessing.get_context("spawn")
+    processes = [ctx.Process(target=target, args=args, name=name) for name, args in jobs]
+    for process in processes:
+        process.start()
+        print(f"-> Started {process.name} (PID {process.pid})")
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        # Children received the same Ctrl-C and are saving their partial output; wait for them.
+        print("\nKEYBOARD INTERRUPT DETECTED! Waiting for shard workers to finish writing...")
+        for process in processes:
+            process.join()
+    for process in processes:
+        status = "ok" if process.exitcode == 0 else f"exit code {process.exitcode}"
+        print(f"   - {process.name}: {status}")
+    return [process.exitcode for process in processes]
+
+
+# --- Merge steps ---
+
+def concatenate_files(paths, output_path):
+    with open(output_path, 'wb') as f_out:
+        for path in paths:
+            if os.path.exists(path):
+                with open(path, 'rb') as f_in:
+                    shutil.copyfileobj(f_in, f_out, 16 * 1024 * 1024)
+
+
+def merge_quiz_outputs(shard_files, merged_file):
+    concatenate_files(shard_files, merged_file)
+    print(f"✅ Merged {len(shard_files)} quiz shards into '{merged_file}'")
+
+
+def merge_grade_outputs(shard_dirs, output_dir):
+    """Concatenates shard run_details.jsonl files and recomputes one overview from the merged file."""
+    merged_details = os.path.join(output_dir, "run_details.jsonl")
+    merged_overview = os.path.join(output_dir, "run_overview.json")
+    concatenate_files([os.path.join(d, "run_details.jsonl") for d in shard_dirs], merged_details)
+
+    shard_summaries = []
+    for shard_dir in shard_dirs:
+        overview_path = os.path.join(shard_dir, "run_overview.json")
+        if os.path.exists(overview_path):
+            with open(overview_path, 'r', encoding='utf-8') as f:
+                shard_overview = json.load(f)
+            shard_summaries.append({"dir": shard_dir, "run_info": shard_overview.get("run_info"), "llm_cache": shard_overview.get("llm_cache")})
+        else:
+            shard_summaries.append({"dir": shard_dir, "run_info": None})
+
+    statuses = {(s["run_info"] or {}).get("status") for s in shard_summaries}
+    run_info = {"status": "Run Complete" if statuses == {"Run Complete"} else "Partial", "shards": shard_summaries}
+    rebuild_overview(merged_details, merged_overview, run_info=run_info)
+    print(f"✅ Merged {len(shard_dirs)} shards into '{merged_details}' and '{merged_overview}'")
+
+
+# --- Entry point ---
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a pipeline stage over N shards in parallel processes and merge the results.")
+    parser.add_argument("stage", choices=["quizzes", "grade"], help="'quizzes' runs generate_quizzes.py, 'grade' runs generate_traces_and_grade.py.")
+    parser.add_argument("input_file", help="Input JSONL for the stage.")
+    parser.add_argument("-n", "--num-shards", type=int, default=4, help="Number of shards / worker processes (default: 4).")
+    parser.add_argument("-o", "--output-dir", required=True, help="Directory for per-shard outputs and the merged result.")
+    parser.add_argument("--resume", action="store_true", help="Resume each shard from its existing output.")
+    parser.add_argument("--merge-only", action="store_true", help="Skip the workers and only merge existing shard outputs.")
+    parser.add_argument("--set", action="append", metavar="NAME=VALUE", help="Override a setting of the stage script (JSON value).")
+    parser.add_argument("--no-split-limits", action="store_true", help="Give every shard the stage's full request limits instead of an equal share.")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.input_file):
+        print(f"FATAL: Input file not found at '{args.input_file}'.")
+        sys.exit(1)
+    if detect_format(args.input_file) != "jsonl":
+        print(f"FATAL: Byte-range sharding needs a .jsonl input; '{args.input_file}' is columnar.")
+        sys.exit(1)
+    os.makedirs(args.output_dir, exist_ok=True)
+    overrides = parse_overrides(args.set)
+
+    offsets, _ = load_or_build_line_index(args.input_file)
+    shards = compute_shards(offsets, args.num_shards)
+    num_shards = len(shards)
+    limit_divisor = 1 if args.no_split_limits else num_shards
+    print(f"--- {args.stage}: {len(offsets) - 1} records in {num_shards} shards ---")
+    if limit_divisor > 1:
+        print(f"    Request limits are split between the shards (1/{limit_divisor} each); --no-split-limits gives each shard the full limits.")
+
+    if args.stage == "quizzes":
+        shard_files = [os.path.join(args.output_dir, f"{shard_name(s['shard'], num_shards)}_with_quizzes.jsonl") for s in shards]
+        if not args.merge_only:
+            jobs = [(shard_name(s["shard"], num_shards), (args.input_file, (s["start_byte"], s["end_byte"]), path, overrides, args.resume, limit_divisor))
+                    for s, path in zip(shards, shard_files)]
+            launch_workers(run_quiz_shard, jobs)
+        merge_quiz_outputs(shard_files, os.path.join(args.output_dir, "merged_with_quizzes.jsonl"))
+    else:
+        shard_dirs = [os.path.join(args.output_dir, shard_name(s["shard"], num_shards)) for s in shards]
+        if not args.merge_only:
+            jobs = [(shard_name(s["shard"], num_shards), (args.input_file, (s["start_byte"], s["end_byte"]), shard_dir, overrides, args.resume, limit_divisor))
+                    for s, shard_dir in zip(shards, shard_dirs)]
+            launch_workers(run_grade_shard, jobs)
+        merge_grade_outputs(shard_dirs, args.output_dir)
+
+
+if __name__ == "__main__":
+    main()
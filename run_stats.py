@@ -0,0 +1,134 @@
+import json
+import os
+import sys
+
+# --- Incremental statistics for run_overview.json ---
+# Records are folded in one at a time as they are written, so the overview never needs the
+# full run_details.jsonl (traces and grading output included) to be held in memory.
+
+
+class TraceGroupStats:
+    """Running counts and score sums for one group of graded traces."""
+
+    def __init__(self):
+        self.traces = 0
+        self.correct = 0
+        self.score_sum_correct = 0.0
+        self.score_sum_incorrect = 0.0
+
+    def add(self, is_correct, reward_score):
+        self.traces += 1
+        if is_correct:
+            self.correct += 1
+            self.score_sum_correct += reward_score
+        else:
+            self.score_sum_incorrect += reward_score
+
+    def merge(self, other):
+        self.traces += other.traces
+        self.correct += other.correct
+        self.score_sum_correct += other.score_sum_correct
+        self.score_sum_incorrect += other.score_sum_incorrect
+
+    @property
+    def accuracy(self):
+        return (self.correct / self.traces * 100) if self.traces > 0 else 0
+
+    @property
+    def avg_score_correct(self):
+        return self.score_sum_correct / self.correct if self.correct else 0
+
+    @property
+    def avg_score_incorrect(self):
+        incorrect = self.traces - self.correct
+        return self.score_sum_incorrect / incorrect if incorrect else 0
+
+    def summary(self):
+        return {
+            "traces": self.traces,
+            "traces_correctly_answered": self.correct,
+            "trace_accuracy_percent": round(self.accuracy, 2),
+            "average_reward_score_when_correct": round(self.avg_score_correct, 3),
+            "average_reward_score_when_incorrect": round(self.avg_score_incorrect, 3),
+        }
+
+
+class RunStatsAccumulator:
+    """Folds run_details.jsonl records into overall, per-generator_type and per-model statistics."""
+
+    def __init__(self):
+        self.overall = TraceGroupStats()
+        self.by_generator_type = {}
+        self.by_model = {}
+        self.problem_ids = set()
+
+    def add(self, record):
+        is_correct = bool(record.get('is_correct'))
+        reward_score = float(record.get('reward_score') or 0.0)
+        self.overall.add(is_correct, reward_score)
+        self.by_generator_type.setdefault(record.get('generator_type'), TraceGroupStats()).add(is_correct, reward_score)
+        self.by_model.setdefault(record.get('generator_model'), TraceGroupStats()).add(is_correct, reward_score)
+        self.problem_ids.add(record.get('problem_id'))
+
+    def merge(self, other):
+        """Folds in an accumulator built over another part of the same run (e.g. in a worker process)."""
+        self.overall.merge(other.overall)
+        for mine, theirs in ((self.by_generator_type, other.by_generator_type), (self.by_model, other.by_model)):
+            for key, group in theirs.items():
+                mine.setdefault(key, TraceGroupStats()).merge(group)
+        self.problem_ids.update(other.problem_ids)
+
+    def build_overview(self, run_info):
+        overall = self.overall
+        return {
+            "run_info": run_info,
+            "overall_performance": { "problems_attempted": len(self.problem_ids), "traces_generated_and_saved": overall.traces, "traces_correctly_answered": overall.correct, "trace_accuracy_percent": round(overall.accuracy, 2) },
+            "correlation_analysis": { "average_reward_score_when_correct": round(overall.avg_score_correct, 3), "average_reward_score_when_incorrect": round(overall.avg_score_incorrect, 3), "comment": "This is the most important metric. A large positive gap proves the quiz score is a good proxy for correctness." },
+            "breakdown_by_generator_type": {str(k): v.summary() for k, v in self.by_generator_type.items()},
+            "breakdown_by_model": {str(k): v.summary() for k, v in self.by_model.items()},
+        }
+
+
+def accumulate_details_file(details_file, stats=None):
+    """Streams a run_details.jsonl file into an accumulator, one line at a time."""
+    stats = stats or RunStatsAccumulator()
+    with open(details_file, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                stats.add(json.loads(line))
+    return stats
+
+
+def write_overview(stats, overview_file, run_info=None):
+    """
+    Writes `stats` to run_overview.json. If `run_info` is not given, the one already stored in
+    `overview_file` is kept, as are its other sections (llm_cache, token_usage, ...).
+    """
+    previous = {}
+    if os.path.exists(overview_file):
+        with open(overview_file, 'r', encoding='utf-8') as f:
+            previous = json.load(f)
+
+    overview_data = stats.build_overview(run_info if run_info is not None else previous.get("run_info") or {})
+    for section, value in previous.items():
+        overview_data.setdefault(section, value)
+    with open(overview_file, 'w', encoding='utf-8') as f_overview:
+        json.dump(overview_data, f_overview, indent=4)
+    return overview_data
+
+
+def rebuild_overview(details_file, overview_file, run_info=None):
+    """Regenerates run_overview.json from an existing run_details.jsonl (see write_overview)."""
+    return write_overview(accumulate_details_file(details_file), overview_file, run_info)
+
+
+if __name__ == "__main__":
+    # Usage: python run_stats.py results/run_xxx/run_details.jsonl [results/run_xxx/run_overview.json]
+    if len(sys.argv) < 2:
+        print("Usage: python run_stats.py <run_details.jsonl> [run_overview.json]")
+        sys.exit(1)
+    details_path = sys.argv[1]
+    overview_path = sys.argv[2] if len(sys.argv) > 2 else os.path.join(os.path.dirname(details_path), "run_overview.json")
+    overview = rebuild_overview(details_path, overview_path)
+    print(f"✅ Overview rebuilt from '{details_path}' -> '{overview_path}'")
+    print(json.dumps(overview["overall_performance"], indent=2))
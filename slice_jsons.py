@@ -1,105 +1,233 @@
+import argparse
+import bisect
+import json
+import mmap
 import os
 import sys
-import math
+from array import array
 
-def slice_jsonl_file():
+# --- JSONL slicer ---
+# Builds a compact line-offset index of a JSONL file in a single mmap pass, then describes each
+# shard as a (start_byte, end_byte) range in a manifest. Downstream stages read a shard straight
+# out of the original file via INPUT_BYTE_RANGE, so no physical copies are needed. Writing the
+# shards out as separate files is still available with --physical.
+
+BLANK_LINE_MAX_BYTES = 64  # indexed lines longer than this are taken to be records when counting
+
+
+def build_line_index(input_file):
     """
-    Interactively prompts the user to slice a large JSONL file into a specified
-    number of smaller, sequentially named files.
+    Returns an array('Q') of byte offsets: entry i is where line i starts, and the last entry is
+    the file size, so line i spans offsets[i]:offsets[i + 1]. Costs 8 bytes per line.
     """
-    print("--- JSONL File Slicer ---")
+    offsets = array('Q', [0])
+    with open(input_file, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return offsets
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            pos = mm.find(b'\n')
+            while pos != -1:
+                offsets.append(pos + 1)
+                pos = mm.find(b'\n', pos + 1)
+    if offsets[-1] != size:
+        offsets.append(size)  # last line has no trailing newline
+    return offsets
 
-    # 1. Get the input file from the user
-    input_file = input("Enter the path to the JSONL file you want to slice: ").strip()
 
-    if not os.path.exists(input_file):
-        print(f"\nError: File not found at '{input_file}'")
-        sys.exit(1)
-        
-    if not input_file.lower().endswith('.jsonl'):
-        print(f"\nWarning: The file does not have a .jsonl extension. Proceeding anyway.")
+def load_line_index(input_file, index_file=None):
+    """Returns the offsets in `<input_file>.idx` if that index is still valid for the input, else None."""
+    index_file = index_file or input_file + '.idx'
+    if not os.path.exists(index_file) or os.path.getmtime(index_file) < os.path.getmtime(input_file):
+        return None
+    offsets = array('Q')
+    with open(index_file, 'rb') as f:
+        offsets.frombytes(f.read())
+    if offsets and offsets[-1] == os.path.getsize(input_file):
+        return offsets
+    return None
 
-    # 2. Get the number of slices from the user, with a default
-    try:
-        num_slices_str = input("Enter the number of slices to create (default is 4): ").strip()
-        num_slices = int(num_slices_str) if num_slices_str else 4
-        if num_slices <= 0:
-            raise ValueError
-    except ValueError:
-        print("\nError: Please enter a valid positive number for the slices.")
-        sys.exit(1)
 
-    print("\nProcessing...")
+def load_or_build_line_index(input_file, index_file=None):
+    """Loads `<input_file>.idx` if it is still valid for the input, otherwise rebuilds and saves it."""
+    index_file = index_file or input_file + '.idx'
+    offsets = load_line_index(input_file, index_file)
+    if offsets is not None:
+        return offsets, index_file
 
-    # 3. Count the total lines in the file efficiently
-    print(f"-> Counting total lines in '{os.path.basename(input_file)}'...")
-    try:
-        with open(input_file, 'r', encoding='utf-8') as f:
-            total_lines = sum(1 for _ in f)
-        print(f"-> Found {total_lines} total lines (records).")
-    except Exception as e:
-        print(f"\nError: Could not read the file. Reason: {e}")
-        sys.exit(1)
+    offsets = build_line_index(input_file)
+    with open(index_file, 'wb') as f:
+        offsets.tofile(f)
+    return offsets, index_file
 
-    if total_lines < num_slices:
-        print(f"\nWarning: The file has fewer lines ({total_lines}) than the desired number of slices ({num_slices}).")
-        print("         Each slice will have at most one line.")
-        num_slices = total_lines
+
+def compute_shards(offsets, num_shards):
+    """Splits the indexed lines into `num_shards` contiguous, near-equal byte ranges."""
+    total_lines = len(offsets) - 1
+    num_shards = max(1, min(num_shards, total_lines))
+    lines_per_shard, remainder = divmod(total_lines, num_shards)
+
+    shards = []
+    start_line = 0
+    for i in range(num_shards):
+        num_lines = lines_per_shard + (1 if i < remainder else 0)
+        end_line = start_line + num_lines
+        shards.append({
+            "shard": i,
+            "start_byte": offsets[start_line],
+            "end_byte": offsets[end_line],
+            "start_line": start_line,
+            "num_lines": num_lines,
+        })
+        start_line = end_line
+    return shards
+
+
+def iter_lines_in_range(path, byte_range=None):
+    """
+    Yields the lines of `path` that start inside [start_byte, end_byte). With no range, yields
+    every line. Ranges from a slicer manifest always begin on a line boundary.
+    """
+    start, end = byte_range or (0, None)
+    with open(path, 'rb') as f:
+        f.seek(start)
+        pos = start
+        for line in f:
+            if end is not None and pos >= end:
+                break
+            pos += len(line)
+            yield line.decode('utf-8')
+
+
+def count_lines_in_range(path, byte_range=None):
+    """
+    Counts the non-blank lines iter_lines_in_range would yield (blank lines hold no record). Uses a
+    bisect over `<path>.idx` when the slicer left a valid index, reading only the lines short enough
+    to be blank; reads every line when there is no index.
+    """
+    offsets = load_line_index(path)
+    if offsets is None:
+        return sum(1 for line in iter_lines_in_range(path, byte_range) if line.strip())
+    start, end = byte_range or (0, None)
+    num_lines = len(offsets) - 1  # the last entry is the file size, not a line start
+    first = bisect.bisect_left(offsets, start, 0, num_lines)
+    stop = num_lines if end is None else bisect.bisect_left(offsets, end, 0, num_lines)
+    short = [i for i in range(first, stop) if offsets[i + 1] - offsets[i] <= BLANK_LINE_MAX_BYTES]
+    blank = 0
+    if short:
+        with open(path, 'rb') as f:
+            for i in short:
+                f.seek(offsets[i])
+                blank += not f.read(offsets[i + 1] - offsets[i]).strip()
+    return max(stop - first - blank, 0)
+
+
+def load_shard_range(manifest_file, shard):
+    """Returns the (start_byte, end_byte) of one shard from a manifest written by this script."""
+    with open(manifest_file, 'r', encoding='utf-8') as f:
+        entry = json.load(f)["shards"][shard]
+    return entry["start_byte"], entry["end_byte"]
+
+
+def shard_output_path(input_file, output_dir, shard, num_shards):
+    base_name, extension = os.path.splitext(os.path.basename(input_file))
+    # Determine padding width for sequential numbering (e.g., 01, 02 vs 1, 2)
+    padding_width = len(str(num_shards - 1))
+    slice_num_str = str(shard).zfill(padding_width)
+    total_slices_str = str(num_shards - 1).zfill(padding_width)
+    return os.path.join(output_dir, f"{base_name} {slice_num_str}-of-{total_slices_str}{extension}")
+
+
+def write_physical_shards(input_file, shards, output_dir, chunk_size=16 * 1024 * 1024):
+    """Copies each shard's byte range into its own file, in large chunks without parsing lines."""
+    paths = []
+    with open(input_file, 'rb') as f_in:
+        for entry in shards:
+            output_path = shard_output_path(input_file, output_dir, entry["shard"], len(shards))
+            print(f"-> Creating '{os.path.basename(output_path)}'...")
+            f_in.seek(entry["start_byte"])
+            remaining = entry["end_byte"] - entry["start_byte"]
+            with open(output_path, 'wb') as f_out:
+                while remaining > 0:
+                    chunk = f_in.read(min(chunk_size, remaining))
+                    if not chunk:
+                        break
+                    f_out.write(chunk)
+                    remaining -= len(chunk)
+            paths.append(output_path)
+    return paths
+
+
+def slice_jsonl_file(input_file, num_slices, output_dir=None, physical=False, index_file=None):
+    """
+    Indexes `input_file`, writes a shard manifest next to it, and optionally writes physical
+    shard files. Returns the path of the manifest.
+    """
+    output_dir = output_dir or os.path.dirname(input_file) or '.'
+    os.makedirs(output_dir, exist_ok=True)
+
+    print(f"-> Indexing '{os.path.basename(input_file)}'...")
+    offsets, index_file = load_or_build_line_index(input_file, index_file)
+    total_lines = len(offsets) - 1
+    print(f"-> Found {total_lines} total lines (records). Index: {index_file}")
 
     if total_lines == 0:
         print("\nError: The input file is empty. Nothing to slice.")
         sys.exit(1)
+    if total_lines < num_slices:
+        print(f"\nWarning: The file has fewer lines ({total_lines}) than the desired number of slices ({num_slices}).")
+        print("         Each slice will have at most one line.")
 
-    # 4. Calculate lines per slice and handle remainders
-    lines_per_slice = total_lines // num_slices
-    remainder = total_lines % num_slices
-    print(f"-> Slicing into {num_slices} files with ~{lines_per_slice} lines each.")
-    
-    # 5. Get path components for naming the output files
-    input_dir = os.path.dirname(input_file)
-    base_name, extension = os.path.splitext(os.path.basename(input_file))
-    
-    # Determine padding width for sequential numbering (e.g., 01, 02 vs 1, 2)
-    padding_width = len(str(num_slices - 1))
-
-    # 6. Perform the slicing
-    line_counter = 0
-    with open(input_file, 'r', encoding='utf-8') as f_in:
-        for i in range(num_slices):
-            # Determine the exact number of lines for this specific slice
-            num_lines_for_this_slice = lines_per_slice + (1 if i < remainder else 0)
-            
-            # Format the output file name
-            slice_num_str = str(i).zfill(padding_width)
-            total_slices_str = str(num_slices - 1).zfill(padding_width)
-            output_filename = f"{base_name} {slice_num_str}-of-{total_slices_str}{extension}"
-            output_path = os.path.join(input_dir, output_filename)
-            
-            print(f"-> Creating '{output_filename}'...")
-            
-            with open(output_path, 'w', encoding='utf-8') as f_out:
-                for _ in range(num_lines_for_this_slice):
-                    line = f_in.readline()
-                    if not line:
-                        break # Stop if we unexpectedly reach the end of the input file
-                    f_out.write(line)
-                    line_counter += 1
+    shards = compute_shards(offsets, num_slices)
+    print(f"-> Slicing into {len(shards)} shards with ~{total_lines // len(shards)} lines each.")
+
+    if physical:
+        for entry, path in zip(shards, write_physical_shards(input_file, shards, output_dir)):
+            entry["file"] = path
+
+    base_name = os.path.splitext(os.path.basename(input_file))[0]
+    manifest_file = os.path.join(output_dir, f"{base_name}.shards.json")
+    manifest = {
+        "input_file": os.path.abspath(input_file),
+        "input_size": offsets[-1],
+        "index_file": os.path.abspath(index_file),
+        "total_lines": total_lines,
+        "shards": shards,
+    }
+    with open(manifest_file, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2)
 
     print("\n-------------------------")
     print(f"✅ Slicing Complete!")
-    print(f"   - Total lines processed: {line_counter}")
-    print(f"   - Number of files created: {num_slices}")
-    print(f"   - Output files are located in: {input_dir or '.'}")
+    print(f"   - Total lines indexed: {total_lines}")
+    print(f"   - Number of shards: {len(shards)}")
+    print(f"   - Shard manifest: {manifest_file}")
+    if physical:
+        print(f"   - Shard files are located in: {output_dir}")
     print("-------------------------")
+    return manifest_file
 
-if __name__ == "__main__":
-    slice_jsonl_file()
-```
 
-### How to Use the Script
+def main():
+    parser = argparse.ArgumentParser(description="Slice a JSONL file into byte-range shards (optionally as physical files).")
+    parser.add_argument("input_file", help="Path to the JSONL file to slice.")
+    parser.add_argument("-n", "--num-slices", type=int, default=4, help="Number of shards to create (default: 4).")
+    parser.add_argument("-o", "--output-dir", default=None, help="Where to write the manifest and shard files (default: next to the input).")
+    parser.add_argument("--physical", action="store_true", help="Also write each shard out as its own .jsonl file.")
+    parser.add_argument("--index-file", default=None, help="Path of the line-offset index (default: <input>.idx).")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.input_file):
+        print(f"\nError: File not found at '{args.input_file}'")
+        sys.exit(1)
+    if args.num_slices <= 0:
+        print("\nError: Please enter a valid positive number for the slices.")
+        sys.exit(1)
+    if not args.input_file.lower().endswith('.jsonl'):
+        print(f"\nWarning: The file does not have a .jsonl extension. Proceeding anyway.")
+
+    slice_jsonl_file(args.input_file, args.num_slices, args.output_dir, args.physical, args.index_file)
+
 
-1.  **Save the file:** Save the code above into a file named `slice_jsonl.py` in your project directory.
-2.  **Run from the terminal:**
-    ```bash
-    python slice_jsonl.py
-    
+if __name__ == "__main__":
+    main()